@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import re
+import ast
 import sys
 import os
 import errno
@@ -9,10 +10,8 @@ import tempfile
 import json
 import subprocess
 import time
-import random
 import signal
 import logging
-import glob
 
 import easierocd.usb
 from easierocd.usb import (AdapterNotFound,
@@ -26,14 +25,28 @@ from easierocd.openocd import (OpenOcdError,
                                OpenOcdResetError,
                                OpenOcdCommandNotSupportedError)
 import easierocd.arm
+import easierocd.stm32
+import easierocd.image
+import easierocd.elf
+import easierocd.memorymap
+import easierocd.memcache
+import easierocd.swo
+import easierocd.profile
+import easierocd.rtt
+import easierocd.semihosting
+import easierocd.watch
 from easierocd.util import (Bag,
                             HexDict,
-                            waitpid_ignore_echild,
-                            kill_ignore_echild,
                             hex_str_literal_double_quoted)
+import easierocd.adapterspeed
+import easierocd.farm
+import easierocd.supervisor
 from easierocd.openocdcortexm import (OpenOcdCortexMDetect,
+                           work_area_from_options,
+                           parse_memory_ranges,
                            OpenOcdCortexMDetectError,
                            OpenOcdOpenFailedDuringInit,
+                           UnknownMcuError,
                            AdapterDoesntSupportTransport,
                            OpenOcdDoesntSupportTransportForAdapter)
 
@@ -47,238 +60,31 @@ def main_function(func):
     main_function_map[func.__name__.replace('_','-')] = func
     return func
 
-def path_safe_str(s):
-    '''
-    >>> path_safe_str('ST-Link/V2-1')
-    'ST-LinkV2-1'
-    >>> path_safe_str('TI ICDI')
-    'TIICDI'
-    >>> path_safe_str('LPC-Link 2')
-    'LPC-Link2'
-    '''
-    safe_chrs = set('-_.'
-                    'abcdefghijklmnopqrstuvwxyz'
-                    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-                    '0123456789')
-    out = []
-    for c in s:
-        if c in safe_chrs:
-            out.append(c)
-        else:
-            pass
-    return ''.join(out)
-
-def pid_file_path(adapter):
-    (info, device) = adapter
-    adapter_name = path_safe_str(info['name'])
-    tdir = tempfile.gettempdir()
-    return os.path.join(tdir, 'easierocd-%s-usb-%d-%d' % (
-        adapter_name, device.bus, device.address))
-
-def pid_files_cleanup(connected_adapters):
-    tdir = tempfile.gettempdir()
-    pid_files = glob.glob(os.path.join(tdir, 'easierocd-*'))
-    connected_adapter_pid_filenames = {
-        os.path.basename(pid_file_path(x)) for x in connected_adapters }
-    for i in pid_files:
-        if os.path.basename(i) not in connected_adapter_pid_filenames:
-            logging.debug('pid_files_cleanup: removing %r' % (i,))
-            try:
-                os.unlink(i)
-            except (PermissionError):
-                pass
-
-def tmux_session_name_for_adapter(adapter):
-    (info, device) = adapter
-    return 'openocd-%s-usb-%d-%d' % (path_safe_str(info['name']), device.bus, device.address)
-
-def tmux_pane_get_pty(tmux_target):
-    # $ tmux lsp -F '#{pane_tty}'
-    # /dev/pts/6
-    p = subprocess.Popen(['tmux', 'list-pane', '-t', tmux_target, '-F', '#{pane_tty}'], stdout=subprocess.PIPE)
-    out = []
-    while 1:
-        t = p.stdout.read().decode('ascii')
-        if t == '':
-            break
-        out.append(t)
-    # strip '\n' at end
-    return (''.join(out))[:-1]
-
-def tmux_sessions_cleanup(connected_adapters):
-    p = subprocess.Popen(['tmux', 'list-sessions'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    response = p.stdout.read()
-    if not response:
-        return
-
-    connected_usb_bus_addr = { (a_dev.bus, a_dev.address) for (a_info, a_dev) in connected_adapters }
-
-    # b'openocd-ST-LinkV2-1-usb-2-109: 1 windows (created Thu Oct  9 15:37:00 2014) [140x41] (attached)\n'
-    l = response.split(b'\n')
-    for i in l:
-        try:
-            session_name = i.split()[0][:-1].decode('ascii') # strip ':' at end
-        except IndexError:
-            continue
-
-        m = re.search(r'-usb-(?P<bus>[\d]*)-(?P<addr>[\d]*)', session_name)
-        if m:
-            d = m.groupdict()
-            session_bus_addr = (int(d['bus']), int(d['addr']))
-            if session_bus_addr not in connected_usb_bus_addr:
-                r = subprocess.call(['tmux', 'kill-session', '-t', session_name])
-                if r != 0:
-                    logging.warning('tmux kill-session -t %s failed' % (session_name,))
-                continue
-
-# OpenOCD control: one process per debug adapter
-
-def openocd_start(adapter):
-    '-> (pid, tcl_port)'
-    (info, device) = adapter
-    logging.debug('openocd_start: USB 0x%04x:0x%04x' % (device.idVendor, device.idProduct))
-    sname = tmux_session_name_for_adapter(adapter)
-
-    tmux_stderr = tempfile.TemporaryFile(mode='w+')
-    # The pause helper is just a program for tmux to wait on that doesn't touch STDIN/STDOUT/STDERR
-    # what I really want is for tmux to have a 'reptyr -l' like "just wait on the pty" mode
-    # bin/easiocd -> libexec/pause
-    pause_helper_exe = os.path.join(os.path.split(os.path.split(sys.argv[0])[0])[0], 'libexec', 'pause')
-    r = subprocess.call(['tmux', 'new-session', '-d', '-s', sname, pause_helper_exe], stderr=tmux_stderr)
-    tmux_stderr.seek(0)
-    m = tmux_stderr.read()
-
-    if r != 0 and r != 1:
-        raise EasierOcdError('tmux: "%s"\n' % (m,))
-    if r == 1:
-        # 'duplicate session: T'
-        if m.startswith('duplicate session: '):
-            # since we don't shutdown tmux explicitly, just assume this tmux session is usable
-            pass
-        else:
-            raise EasierOcdError('tmux: "%s"\n' % (m,))
-
-    tmux_pty_fd = os.open(tmux_pane_get_pty(sname), os.O_RDWR)
-
-    (gdb_port, telnet_port, tcl_port) = (3333, 4444, 6666)
-    openocd_exe = os.environ.get('OPENOCD', 'openocd')
-    while 1:
-        openocd_cmd = [openocd_exe,
-                       # '-l', '/tmp/easierocd-openocd.log',
-                       '-c', 'tcl_port %d' % (tcl_port,),
-                       '-c', 'gdb_port %d' % (gdb_port,),
-                       '-c', 'telnet_port %d' % (telnet_port,),
-                       '-c', 'noinit']
-        # openocd_stderr = tempfile.TemporaryFile(mode='w+')
-        openocd_process = subprocess.Popen(openocd_cmd,
-                                           stdin=tmux_pty_fd, stdout=tmux_pty_fd, stderr=tmux_pty_fd,
-                                          start_new_session=True)
-        time.sleep(0.01)
-        r = openocd_process.poll()
-        if r is None:
-            break
-        # TODO: make OpenOCD support local sockets and Windows Named Pipes
-        tcl_port = random.randrange(1025, 65535)
-        (gdb_port, telnet_port) = (tcl_port + 1, tcl_port + 2)
-
-    logging.debug('openocd_start: pid: %d, tcl_port: %d' % (openocd_process.pid, tcl_port))
-    return (openocd_process.pid, tcl_port)
-
-def _start_openocd_rpc_write_pid(fd, adapter):
-    '-> openocd_rpc'
-
-    while 1:
-        (pid, tcl_port) = openocd_start(adapter)
-
-        # OpenOcdRpc isn't immediately ready to accept connections on the tcl_port
-        # make 'n_tries' large enough so that "gdb -x utils/debug-eocd-multi-process.gdb"
-        # (eocd-gdb. openocd, multi process debugging) works
-        n_tries = 30
-        conn_refused = None
-        o = None
-        for i in range(n_tries):
-            try:
-                o = easierocd.openocd.OpenOcdRpc(port=tcl_port, pid=pid)
-            except ConnectionRefusedError as e:
-                conn_refused = e
-                time.sleep(0.01)
-            else:
-                break
-        if o is None:
-            raise conn_refused
-
-        # The process that responds on tcl_port isn't necessarily the openocd process
-        # we started
-        if o.getpid() != pid:
-            o.close()
-            continue
-
-        break
-
-    ctrl_data = dict(openocd_pid=pid, tcl_port=tcl_port)
-    os.write(fd, json.dumps(ctrl_data).encode('ascii'))
-    os.write(fd, b'\n')
-    os.close(fd)
-    return o
+# OpenOCD control: one process per debug adapter, owned by the supervisor (see easierocd.supervisor)
 
 (OPENOCD_ALREADY_STARTED,
  OPENOCD_NEWLY_STARTED) = range(2)
 
 def openocd_rpc_for_adapter(adapter):
-    '-> (openodc_rpc, openocd_already_started_or_not)'
-
-    def _pid_file_exists():
-        # check if daemon is running, if not, cleanup
-        # TODO: wrap other os.open failtures (e.g. PERM) in custom exception
-        # for better error messages intead of tracebacks
-        fd = os.open(pid_fname, os.O_RDONLY)
-        data = os.read(fd, 4096)
-        os.close(fd)
-        try:
-            ctrl_data = json.loads(data.decode('ascii'))
-        except ValueError:
-            # TODO: wrap os.unlink failtures (e.g. EPERM) in custom exception
-            os.unlink(pid_fname)
-            fd = os.open(pid_fname, os.O_EXCL|os.O_CREAT|os.O_RDWR)
-            return (_start_openocd_rpc_write_pid(fd, adapter), OPENOCD_NEWLY_STARTED)
-        else:
-            (pid, tcl_port) = (ctrl_data['openocd_pid'], ctrl_data['tcl_port'])
-
-            try:
-                orpc = easierocd.openocd.OpenOcdRpc(port=tcl_port, pid=pid)
-            except (ConnectionRefusedError, ConnectionResetError):
-                # FIXME: check if process with 'pid' is openocd, if true, kill
-                os.unlink(pid_fname)
-                fd = os.open(pid_fname, os.O_EXCL|os.O_CREAT|os.O_RDWR)
-                return (_start_openocd_rpc_write_pid(fd, adapter), OPENOCD_NEWLY_STARTED)
-
-            # The OpenOCD process we're connected to could in fact be started by someone else and 
-            # driving a different debug adapter.
-            try:
-                openocd_pid = orpc.getpid()
-            except (OpenOcdError, ConnectionResetError, ConnectionRefusedError):
-                openocd_pid = None
-
-            if openocd_pid != pid:
-                # tcl_port taken over by another OpenOCD process
-                # which may not be driving the debug adapter we want
-                orpc.close()
-                os.unlink(pid_fname)
-                fd = os.open(pid_fname, os.O_EXCL|os.O_CREAT|os.O_RDWR)
-                return (_start_openocd_rpc_write_pid(fd, adapter), OPENOCD_NEWLY_STARTED)
-            else:
-                return (orpc, OPENOCD_ALREADY_STARTED)
+    '''
+    -> (openodc_rpc, openocd_already_started_or_not)
 
-    (info, device) = adapter
-    # TODO: patch OpenOCD to use local sockets and Windows named pipes.
-    # Use localhost TCP for now
-    pid_fname = pid_file_path(adapter)
+    The connection goes through the adapter's command broker
+    '''
     try:
-        fd = os.open(pid_fname, os.O_EXCL|os.O_CREAT|os.O_RDWR)
-    except FileExistsError:
-        return _pid_file_exists()
-    else:
-        return (_start_openocd_rpc_write_pid(fd, adapter), OPENOCD_NEWLY_STARTED)
+        ep = easierocd.supervisor.endpoint(adapter)
+    except easierocd.supervisor.SupervisorError as e:
+        raise OpenOcdSetupError(e.args[0])
+    o = easierocd.openocd.OpenOcdRpc(path=ep['broker'], pid=ep['pid'])
+    if ep['new']:
+        return (o, OPENOCD_NEWLY_STARTED)
+    return (o, OPENOCD_ALREADY_STARTED)
+
+def openocd_stop(adapter, openocd_rpc=None):
+    'Stop the OpenOCD daemon for "adapter" and wait for it to exit'
+    if openocd_rpc is not None:
+        openocd_rpc.close()
+    easierocd.supervisor.stop(adapter)
 
 def print_adapters_list(adapters):
     out = []
@@ -335,10 +141,7 @@ def intrusive_cortex_m_probe_and_setup(options, adapter, openocd_rpc):
         try_jtag = True
     except (ConnectionError):
         # protocol or connection error
-        assert(o.pid is not None)
-        kill_ignore_echild(o.pid, signal.SIGTERM)
-        subprocess.call(['tmux', 'kill-session', '-t', tmux_session_name_for_adapter(adapter)])
-        time.sleep(0.01)
+        openocd_stop(adapter, o)
         (o, openocd_newly_started_or_not) = openocd_rpc_for_adapter(adapter)
         mdetect = OpenOcdCortexMDetect(options, adapter, o)
         adapter = mdetect.openocd_init_for_detection(openocd_transport)
@@ -374,9 +177,9 @@ def intrusive_cortex_m_probe_and_setup(options, adapter, openocd_rpc):
             dap_info = None
         else:
             # protocol or connection error
-            assert(o.pid is not None)
-            kill_ignore_echild(o.pid, signal.SIGTERM)
-            subprocess.call(['tmux', 'kill-session', '-t', tmux_session_name_for_adapter(adapter)])
+            openocd_stop(adapter, o)
+            (o, openocd_newly_started_or_not) = openocd_rpc_for_adapter(adapter)
+            mdetect = OpenOcdCortexMDetect(options, adapter, o)
             adapter = mdetect.openocd_init_for_detection(openocd_transport)
             o.reset_init()
             try:
@@ -392,25 +195,66 @@ def intrusive_cortex_m_probe_and_setup(options, adapter, openocd_rpc):
     # mcu_info: silicon vendor, MCU family, make, revision etc
     try:
         mcu_info = mdetect.detect_mcu(dap_info)
+    except UnknownMcuError as e:
+        openocd_stop(adapter, o)
+        raise CortexMProbeFatalError(e.args[0])
     except OpenOcdCortexMDetectError:
-        o.openocd_shutdown()
-        waitpid_ignore_echild(o.pid)
-        raise
+        openocd_stop(adapter, o)
+        raise CortexMProbeFatalError('failed to read the MCU identification registers')
 
     logging.info('mcu_info: %r' % (HexDict(mcu_info),))
 
     # Don't attempt to 'init' OpenOCD twice, shutdown then re-launch instead
-    o.openocd_shutdown()
-    waitpid_ignore_echild(o.pid)
+    openocd_stop(adapter, o)
 
     (o, openocd_newly_started_or_not) = openocd_rpc_for_adapter(adapter)
     mdetect = OpenOcdCortexMDetect(options, adapter, o)
     mdetect.openocd_init_for_cortex_m(openocd_transport, dap_info, mcu_info)
     # OpenOCD gdbserver is up after 'init'
+    adapter_speed_setup(options, adapter, mcu_info, mdetect)
     return (dap_info, mcu_info, o)
 
-def openocd_setup(options):
-    '-> (adapter, dap_info, mcu_info, openocd_rpc)'
+def adapter_speed_setup(options, adapter, mcu_info, mdetect):
+    '''
+    options.adapter_khz:
+        None: use the remembered stable speed for this adapter and MCU, if any
+        'auto': find the fastest stable speed and remember it
+        integer string: use that speed
+    '''
+    o = mdetect.orpc
+    adapterspeed = easierocd.adapterspeed
+    # validation bursts go through RAM that OpenOCD's flash algorithms are allowed to clobber anyway
+    (ram_addr, ram_size) = work_area_from_options(options, mcu_info)
+    store = adapterspeed.AdapterSpeedStore()
+    key = adapterspeed.board_key(adapter, mcu_info)
+    requested = getattr(options, 'adapter_khz', None)
+
+    if requested is None:
+        khz = store.get(key)
+        if khz is None:
+            return
+        if adapterspeed.apply_remembered(o, ram_addr, khz):
+            mdetect.set_adapter_khz(khz)
+            logging.info('adapter speed: using remembered %d kHz' % (khz,))
+        else:
+            logging.warning('adapter speed: remembered %d kHz is unstable, forgetting it' % (khz,))
+            store.forget(key)
+    elif requested == 'auto':
+        try:
+            khz = adapterspeed.tune(o, ram_addr)
+        except OpenOcdError as e:
+            raise OpenOcdSetupError('adapter speed tuning failed: %s' % (e.cmd,))
+        mdetect.set_adapter_khz(khz)
+        store.put(key, khz)
+    else:
+        try:
+            khz = int(requested)
+        except ValueError:
+            raise OpenOcdSetupError('%r is not a valid adapter speed' % (requested,))
+        mdetect.set_adapter_khz(khz)
+
+def choose_adapter(options):
+    '-> adapter selected by the options, the environment or the user'
 
     if options.adapter_usb_vid_pid is not None:
         # VID:PID (hexadecimal)
@@ -474,13 +318,25 @@ def openocd_setup(options):
                                         "Use command line options or environment variables to choose one from:\n" +
                                         multiple_adapter_msg(adapters))
 
-    # The debug adapter to be used is fixed after this point
+    return adapter
 
-    # Doing pid file and tmux session cleanups here is bit hackish
-    adapters = easierocd.usb.connected_debug_adapters()
-    pid_files_cleanup(adapters)
-    tmux_sessions_cleanup(adapters)
-    
+def adapter_from_specifier(spec):
+    '''
+    "BUS:ADDR" (decimal) or a USB serial number -> adapter
+    '''
+    m = re.match(r'^([\d]+):([\d]+)$', spec)
+    try:
+        if m:
+            return easierocd.usb.adapter_by_usb_bus_addr((int(m.group(1)), int(m.group(2))))
+        return easierocd.usb.adapter_by_usb_serial(spec.encode('ascii').decode('unicode-escape'))
+    except AdapterNotFound:
+        raise OpenOcdSetupError("Can't find adapter %r" % (spec,))
+    except AdapterNotSupported:
+        raise OpenOcdSetupError('Adapter %r is not supported' % (spec,))
+    except MultipleAdaptersMatchCriteria as e:
+        raise OpenOcdSetupError(('More than one adapter matches %r!\n' % (spec,)) + e.args[0])
+
+def check_adapter_serial_unique(adapter):
     # If multiple debug adapters have the same serial number as the choosen one
     # raise MultipleAdaptersMatchCriteria here
     adapter_serial_number = getattr(adapter[1], 'serial_number')
@@ -496,6 +352,15 @@ def openocd_setup(options):
                                          'that makes it impossible to use multiple ST-Links on the same machine.\n'
                                          'Please upgrade ST-Link\'s firmware from: ' + msg)
 
+def openocd_setup(options):
+    '-> (adapter, dap_info, mcu_info, openocd_rpc)'
+    adapter = choose_adapter(options)
+    # The debug adapter to be used is fixed after this point
+    check_adapter_serial_unique(adapter)
+    return openocd_setup_for_adapter(options, adapter)
+
+def openocd_setup_for_adapter(options, adapter):
+    '-> (adapter, dap_info, mcu_info, openocd_rpc)'
     (o, openocd_newly_started_or_not) = openocd_rpc_for_adapter(adapter)
     logging.debug('openocd_newly_started_or_not: %d' % (openocd_newly_started_or_not,))
 
@@ -538,6 +403,9 @@ def openocd_setup(options):
         assert(dap_info is not None)
         try:
             mcu_info = mdetect.detect_mcu(dap_info)
+        except UnknownMcuError as e:
+            # the link works, resetting and probing again would read the same registers
+            raise CortexMProbeFatalError(e.args[0])
         except OpenOcdCortexMDetectError:
             logging.debug('openocd_setup: detect_mcu: OpenOcdCortexMDetectError')
             openocd_connnection_unusable = True
@@ -545,8 +413,7 @@ def openocd_setup(options):
     logging.debug('target_names: %r, poll_info: %r, dap_info: %r, mcu_info: %r' % (target_names, poll_info, dap_info, mcu_info))
     if openocd_connnection_unusable:
         logging.debug('Restarting OpenOCD to re-do all the config including probing')
-        o.openocd_shutdown()
-        waitpid_ignore_echild(o.pid)
+        openocd_stop(adapter, o)
         (o, openocd_newly_started_or_not) = openocd_rpc_for_adapter(adapter)
         do_intrusive_probe = True
     else:
@@ -557,21 +424,195 @@ def openocd_setup(options):
         assert(dap_info is not None)
         assert(mcu_info is not None)
         logging.debug('Reusing OpenOCD daemon config, skipping probe')
-        return (adapter, dap_info, mcu_info, o)
+        # the daemon keeps the adapter speed selected when it was set up, only redo explicit requests
+        if getattr(options, 'adapter_khz', None) is not None:
+            adapter_speed_setup(options, adapter, mcu_info, mdetect)
     else:
         # hard coding assumption that ARM Cortex-M is debug target
         logging.debug('Attempting OpenOCD intrusive Cotex-M probe')
         (dap_info, mcu_info, o) = intrusive_cortex_m_probe_and_setup(options, adapter, o)
 
+    o.memory_map = easierocd.memorymap.memory_map_for_mcu(mcu_info)
     return (adapter, dap_info, mcu_info, o)
 
-@main_function
-def eocd_setup(args):
+ADAPTER_OPTIONS_USAGE = ('\t--eocd-adapter-usb-serial   SERIAL\n'
+                         '\t--eocd-adapter-usb-bus-addr BUS:ADDR\n'
+                         '\t--eocd-adapter-usb-vid-pid  VID:PID\n'
+                         '\t--eocd-adapter-khz auto|KHZ: "auto" finds and remembers the fastest stable adapter speed\n'
+                         '\t--eocd-work-area-reserve ADDR:SIZE[,ADDR:SIZE...]: RAM the OpenOCD work area must not use\n'
+                         '\t--eocd-work-area-backup: preserve RAM contents used by flash loaders and algorithms\n'
+                         '\t--eocd-memory-cache: keep flash (and RAM while halted) read from the target in host memory\n'
+                         '\t--eocd-non-interactive\n')
+
+ADAPTER_ENVIRONMENT_USAGE = ('\tEOCD_ADAPTER_USB_SERIAL: use debug adapter with specified USB serial\n'
+                             '\tEOCD_ADAPTER_USB_BUS_ADDR: use debug adapter with" specified USB bus and adddress number\n'
+                             '\tEOCD_ADAPTER_USB_VID_PID: use debug adapter with" specified USB vendor and product ID\n'
+                             '\tEOCD_ADAPTER_KHZ: same as --eocd-adapter-khz\n'
+                             '\tEOCD_WORK_AREA_RESERVE: same as --eocd-work-area-reserve\n'
+                             '\tEOCD_WORK_AREA_BACKUP: same as --eocd-work-area-backup\n'
+                             '\tEOCD_MEMORY_CACHE: same as --eocd-memory-cache\n'
+                             '\tEOCD_NON_INTERACTIVE: non-interactive mode. Never prompt\n')
+
+_ADAPTER_OPTIONS_WITH_ARGUMENT = {
+    '--eocd-adapter-usb-serial': 'adapter_usb_serial',
+    '--eocd-adapter-usb-bus-addr': 'adapter_usb_bus_addr',
+    '--eocd-adapter-usb-vid-pid': 'adapter_usb_vid_pid',
+    '--eocd-adapter-khz': 'adapter_khz',
+    '--eocd-work-area-reserve': 'work_area_reserve',
+}
+
+def adapter_options_from_environment():
+    options = Bag()
+    options.adapter_usb_serial = os.environ.get('EOCD_ADAPTER_USB_SERIAL')
+    options.adapter_usb_bus_addr = os.environ.get('EOCD_ADAPTER_USB_BUS_ADDR')
+    options.adapter_usb_vid_pid = os.environ.get('EOCD_ADAPTER_USB_VID_PID')
+    options.adapter_khz = os.environ.get('EOCD_ADAPTER_KHZ')
+    options.work_area_reserve = os.environ.get('EOCD_WORK_AREA_RESERVE')
+    options.work_area_backup = os.environ.get('EOCD_WORK_AREA_BACKUP', False)
+    options.memory_cache = os.environ.get('EOCD_MEMORY_CACHE', False)
+    options.non_interactive = os.environ.get('EOCD_NON_INTERACTIVE', False)
+    return options
+
+def parse_adapter_option(options, args, i):
+    '-> index of the argument after the option at args[i] or None if it is not an adapter option'
+    a = args[i]
+    if a == '--eocd-non-interactive':
+        options.non_interactive = True
+        return i + 1
+    if a == '--eocd-work-area-backup':
+        options.work_area_backup = True
+        return i + 1
+    if a == '--eocd-memory-cache':
+        options.memory_cache = True
+        return i + 1
+    attr = _ADAPTER_OPTIONS_WITH_ARGUMENT.get(a)
+    if attr is None:
+        return None
+    try:
+        setattr(options, attr, args[i+1])
+    except IndexError:
+        sys.stderr.write('%s: %s requires an argument\n' % (program_name(), a))
+        sys.exit(2)
+    return i + 2
+
+def parse_command_options(options, args, value_options, flag_options, print_usage_exit):
     '''
-    # easierocd-setup 
-    Interactively choose and save which 
+    Parse "args" into "options", adapter options included
+    value_options: { option: (options attribute, conversion function raising ValueError on bad values) }
+    flag_options: { option: (options attribute, value) }
+    -> [ argument not starting with "-", ...]
     '''
-    pass
+    (i, positional) = (0, [])
+    while i < len(args):
+        a = args[i]
+        if a in set(['-h', '--help']):
+            print_usage_exit()
+        elif a in flag_options:
+            (attr, value) = flag_options[a]
+            setattr(options, attr, value)
+            i += 1
+        elif a in value_options:
+            try:
+                v = args[i+1]
+            except IndexError:
+                sys.stderr.write('%s: %s requires an argument\n' % (program_name(), a))
+                sys.exit(2)
+            (attr, conv) = value_options[a]
+            try:
+                setattr(options, attr, conv(v))
+            except ValueError:
+                sys.stderr.write('%s: %r is not a valid value for %s\n' % (program_name(), v, a))
+                sys.exit(2)
+            i += 2
+        elif not a.startswith('-'):
+            positional.append(a)
+            i += 1
+        else:
+            j = parse_adapter_option(options, args, i)
+            if j is None:
+                print_usage_exit()
+            i = j
+    return positional
+
+def adapter_options_finalize(options):
+    if isinstance(options.non_interactive, str):
+        options.non_interactive = bool(ast.literal_eval(options.non_interactive))
+    assert(isinstance(options.non_interactive, bool))
+    if isinstance(options.work_area_backup, str):
+        options.work_area_backup = bool(ast.literal_eval(options.work_area_backup))
+    if isinstance(options.memory_cache, str):
+        options.memory_cache = bool(ast.literal_eval(options.memory_cache))
+    if options.work_area_reserve:
+        try:
+            parse_memory_ranges(options.work_area_reserve)
+        except ValueError:
+            sys.stderr.write('%s: %r is not a valid list of ADDR:SIZE ranges\n' % (program_name(), options.work_area_reserve))
+            sys.exit(2)
+
+def setup_or_exit(options):
+    '-> (adapter, dap_info, mcu_info, openocd_rpc)'
+    try:
+        (adapter, dap_info, mcu_info, o) = openocd_setup(options)
+    except OpenOcdSetupError as e:
+        sys.stderr.write(program_name())
+        sys.stderr.write(': ')
+        sys.stderr.write(e.args[0])
+        sys.stderr.write('\n')
+        sys.exit(3)
+    if getattr(options, 'memory_cache', False):
+        o = easierocd.memcache.MemoryCache(o)
+    return (adapter, dap_info, mcu_info, o)
+
+@main_function
+def eocd_setup(args):
+    '# Start the OpenOCD daemon for a debug adapter, detect and configure the target, then exit'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS]\n'
+                         'Set up the OpenOCD daemon for a debug adapter ahead of time so that later commands\n'
+                         'find it ready\n'
+                         'OPTIONS:\n' % (program_name(),) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    i = 0
+    while i < len(args):
+        if args[i] in set(['-h', '--help']):
+            print_usage_exit()
+        j = parse_adapter_option(options, args, i)
+        if j is None:
+            print_usage_exit()
+        i = j
+    adapter_options_finalize(options)
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+    print('%s: %s, gdb port %d' % (adapter_str(adapter), mcu_info.get('dev'), o.gdb_port()))
+    o.close()
+
+@main_function
+def eocd_supervisor(args):
+    '# Run the easierocd supervisor in the foreground, e.g. from a session autostart entry'
+
+    def print_usage_exit():
+        sys.stderr.write('%s [--prewarm] [--idle-timeout SECONDS]\n'
+                         'Run the process that owns the OpenOCD daemons. Other commands start it on demand,\n'
+                         'run it explicitly to change its options. A supervisor that is already running keeps its own,\n'
+                         'stop it first with eocd-stop (this also stops the OpenOCD daemons).\n'
+                         '\t--prewarm: set up the OpenOCD daemon as soon as a debug adapter is plugged in\n'
+                         '\t--idle-timeout SECONDS: stop OpenOCD daemons unused for this long\n'
+                         'Environemnt Variables\n'
+                         '\tEOCD_PREWARM: same as --prewarm, also for supervisors started on demand\n'
+                         '\tEOCD_IDLE_TIMEOUT: same as --idle-timeout, also for supervisors started on demand\n' % (
+                             program_name(),))
+        sys.exit(2)
+
+    if set(args) & set(['-h', '--help']):
+        print_usage_exit()
+    return easierocd.supervisor.main(args)
 
 @main_function
 def eocd_gdb(args):
@@ -581,29 +622,19 @@ def eocd_gdb(args):
     def print_usage_exit():
         sys.stderr.write('easierocd-gdb [OPTIONS] GDB_ARUGMENTS...\n'
                          'OPTIONS:\n'
-                         '\t--eocd-gdb-file ELF\n'
-                         '\t--eocd-adapter-usb-serial   SERIAL\n'
-                         '\t--eocd-adapter-usb-bus-addr BUS:ADDR\n'
-                         '\t--eocd-adapter-usb-vid-pid  VID:PID\n'
-                         '\t--eocd-non-interactive\n'
+                         '\t--eocd-gdb-file ELF\n' +
+                         ADAPTER_OPTIONS_USAGE +
                          'Any unkown options are passed to GDB\n'
                          'Option names start with "eocd-" to avoid clashes with GDB\n'
                          'Environemnt Variables\n'
                          '\tGDB: use "$GDB" as the gdb executable\n'
-                         '\tHOST: use "$HOST-gdb" as the GDB executable\n'
-                         '\tEOCD_ADAPTER_USB_SERIAL: use debug adapter with specified USB serial\n'
-                         '\tEOCD_ADAPTER_USB_BUS_ADDR: use debug adapter with" specified USB bus and adddress number\n'
-                         '\tEOCD_ADAPTER_USB_VID_PID: use debug adapter with" specified USB vendor and product ID\n'
-                         '\tEOCD_NON_INTERACTIVE: non-interactive mode. Never prompt\n'
+                         '\tHOST: use "$HOST-gdb" as the GDB executable\n' +
+                         ADAPTER_ENVIRONMENT_USAGE
                          )
         sys.exit(2)
 
-    options = Bag()
+    options = adapter_options_from_environment()
     options.gdb_file = None
-    options.adapter_usb_serial = os.environ.get('EOCD_ADAPTER_USB_SERIAL')
-    options.adapter_usb_bus_addr = os.environ.get('EOCD_ADAPTER_USB_BUS_ADDR')
-    options.adapter_usb_vid_pid = os.environ.get('EOCD_ADAPTER_USB_VID_PID')
-    options.non_interactive = os.environ.get('EOCD_NON_INTERACTIVE', False)
 
     (i, gdb_args) = (0, [])
 
@@ -611,8 +642,6 @@ def eocd_gdb(args):
         a = args[i]
         if a in set(['-h', '--help']):
             print_usage_exit()
-        elif a == '--eocd-non-interactive':
-            options.non_interactive = True
         elif a == '--eocd-gdb-file':
             try:
                 options.gdb_file = args[i+1]
@@ -620,47 +649,23 @@ def eocd_gdb(args):
                 sys.stderr.write('%s: --eocd-gdb-file requires an argument\n' % (program_name(),))
                 sys.exit(2)
             i += 1
-        elif a == '--eocd-adapter-usb-bus-addr':
-            try:
-                options.adapter_usb_bus_addr = args[i+1]
-            except IndexError:
-                sys.stderr.write('%s: --eocd-adapter-usb-bus-addr requires an argument\n' % (program_name(),))
-                sys.exit(2)
-            i += 1
-        elif a == '--eocd-adapter-usb-serial':
-            try:
-                options.adapter_usb_serial = args[i+1]
-            except IndexError:
-                sys.stderr.write('%s: --eocd-adapter-usb-serial requires an argument\n' % (program_name(),))
-                sys.exit(2)
-            i += 1
-        elif a == '--eocd-adapter-usb-vid-pid':
-            try:
-                options.adapter_usb_vid_pid = args[i+1]
-            except IndexError:
-                sys.stderr.write('%s: --eocd-adapter-usb-vid-pid requires an argument\n' % (program_name(),))
-                sys.exit(2)
-            i += 1
         else:
+            j = parse_adapter_option(options, args, i)
+            if j is not None:
+                i = j
+                continue
             gdb_args.append(a)
         i += 1
 
-    if isinstance(options.non_interactive, str):
-        options.non_interactive = bool(ast.literal_eval(options.non_interactive))
-    assert(isinstance(options.non_interactive, bool))
-            
-    try:
-        (adapter, dap_info, mcu_info, o) = openocd_setup(options)
-    except OpenOcdSetupError as e:
-        sys.stderr.write(program_name())
-        sys.stderr.write(': ')
-        sys.stderr.write(e.args[0])
-        sys.stderr.write('\n')
-        sys.exit(3)
+    adapter_options_finalize(options)
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
 
     o.set_arm_semihosting(True)
-    # TODO: Free up TCL port? Think about concurrent debug & program
-    # o.close()
+    gdb_port = o.gdb_port()
+    # TCL commands go through the adapter's broker (easierocd.broker) so eocd-program
+    # and monitors can share the daemon with this gdb session
+    o.close()
 
     gdb_cmd = os.environ.get('GDB')
     if gdb_cmd is None:
@@ -684,7 +689,7 @@ def eocd_gdb(args):
                 # OpenOCD doesn't support gdb nonstop mode yet
                 # set non-stop 1
                 # set target-async 1
-                '-ex', 'target extended-remote :%d' % (o.gdb_port(),),
+                '-ex', 'target extended-remote :%d' % (gdb_port,),
                 # TODO: implement gdb non-stop mode in OpenOCD
                 '-ex', 'monitor halt',
                ] + gdb_args
@@ -716,20 +721,720 @@ def eocd_gdb(args):
     else:
         sys.exit(3)
 
-@main_function
-def eocd_program(args):
-    help_msg = 'program flash memory'
-    options = Bag()
-    o = OpenOcdRpc() # FIXME: ...
+class ProgramError(EasierOcdError):
+    pass
+
+def flash_program_plan_for_mcu(o, mcu_info, image):
+    '-> easierocd.stm32.FlashPlan'
+    if mcu_info.get('silicon_vendor') != 'st':
+        raise ProgramError('flash programming is only supported on STM32 for now')
+    if mcu_info.get('flash_size') is None:
+        raise ProgramError("can't determine the flash size of %s" % (mcu_info['dev'],))
+    family = mcu_info['stm32_family']
+    sectors = easierocd.stm32.flash_sectors(family, mcu_info['dev_id'], mcu_info['flash_size'])
+    try:
+        return easierocd.stm32.flash_program_plan(image, sectors,
+                                                  write_align=easierocd.stm32.flash_write_align(family),
+                                                  bank_size=easierocd.stm32.flash_bank_size(family, mcu_info['dev_id']))
+    except easierocd.stm32.FlashPlanError as e:
+        raise ProgramError(e.args[0])
+
+def program_image(o, mcu_info, image, verify=True):
+    '-> easierocd.stm32.FlashPlan that was carried out'
     # run reset-init handlers which might to switch the MCU to a higher clock
     # to speed up flash programming
-    (adapter, dap_info, mcu_info, o) = openocd_setup(options)
     o.reset_init()
+    plan = flash_program_plan_for_mcu(o, mcu_info, image)
+    logging.info('program: erasing %d bytes, writing %d bytes' % (plan.erase_bytes(), plan.write_bytes()))
+    # through easierocd.memcache.MemoryCache this also drops the cached flash contents
+    plan.execute(o)
+    if verify:
+        for (addr, data) in plan.writes:
+            if o.read_mem(addr, len(data)) != data:
+                raise ProgramError('verify failed in 0x%x-0x%x' % (addr, addr + len(data)))
+    return plan
+
+def adapter_str(adapter):
+    (info, d) = adapter
+    s = '%s %03d:%03d' % (info['name'], d.bus, d.address)
+    serial = getattr(d, 'serial_number', None)
+    if serial is not None:
+        s += ' ' + hex_str_literal_double_quoted(serial)
+    return s
+
+def gang_adapters(options):
+    '-> [ adapter, ...] selected by --all or --adapters'
+    if options.gang_adapters == 'all':
+        adapters = easierocd.usb.connected_debug_adapters()
+        if not adapters:
+            raise OpenOcdSetupError('no supported debug adapters found')
+    else:
+        adapters = [ adapter_from_specifier(spec) for spec in options.gang_adapters.split(',') if spec ]
+    seen = set()
+    for a in adapters:
+        k = (a[1].bus, a[1].address)
+        if k in seen:
+            raise OpenOcdSetupError('adapter %s selected more than once' % (adapter_str(a),))
+        seen.add(k)
+    for a in adapters:
+        check_adapter_serial_unique(a)
+    return adapters
+
+def gang_program_one(options, adapter, image):
+    '-> result Bag, never raises for per board failures'
+    r = Bag()
+    (r.adapter, r.ok, r.error, r.bytes, r.seconds) = (adapter, False, None, 0, 0.0)
+    t0 = time.time()
+    try:
+        (adapter, dap_info, mcu_info, o) = openocd_setup_for_adapter(options, adapter)
+        r.mcu = mcu_info.get('dev')
+        t = time.time()
+        plan = program_image(o, mcu_info, image, options.verify)
+        r.seconds = time.time() - t
+        r.bytes = plan.write_bytes()
+        if options.reset:
+            o.reset()
+        r.ok = True
+    except (OpenOcdSetupError, EasierOcdError, OpenOcdError, OpenOcdCortexMDetectError,
+            TargetCommunicationError, ConnectionError, OSError) as e:
+        r.error = (e.args[0] if e.args else repr(e))
+        if not r.seconds:
+            r.seconds = time.time() - t0
+    return r
+
+def gang_program(options, image):
+    '''
+    Program every adapter selected in "options" concurrently
+    -> [ result Bag, ...] in adapter order
+    '''
+    import concurrent.futures
+
+    adapters = gang_adapters(options)
+    # parse lazily loaded formats (Intel HEX) once, workers then only read the shared image
+    image.chunks()
+    jobs = options.gang_jobs or len(adapters)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(gang_program_one, options, a, image) for a in adapters ]
+        return [ f.result() for f in futures ]
+
+def print_gang_report(results, wall_time):
+    passed = 0
+    total_bytes = 0
+    for r in results:
+        if r.ok:
+            passed += 1
+            total_bytes += r.bytes
+            print('PASS %s: %s: %d bytes in %.2fs (%.1f KiB/s)' % (
+                adapter_str(r.adapter), r.mcu, r.bytes, r.seconds, r.bytes / 1024.0 / max(r.seconds, 1e-6)))
+        else:
+            print('FAIL %s: %s' % (adapter_str(r.adapter), r.error))
+    print('%d/%d passed in %.2fs wall time (aggregate %.1f KiB/s)' % (
+        passed, len(results), wall_time, total_bytes / 1024.0 / max(wall_time, 1e-6)))
+    return passed == len(results)
+
+@main_function
+def eocd_program(args):
+    '# Program flash memory, erasing only the sectors touched by the image'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS] IMAGE\n'
+                         'Program IMAGE (ELF, Intel HEX or raw binary) into flash memory\n'
+                         'OPTIONS:\n'
+                         '\t--format elf|ihex|bin\n'
+                         '\t--base-addr ADDR: load address of raw binary images (default 0x%x)\n'
+                         '\t--no-verify\n'
+                         '\t--no-reset: leave the target halted after programming\n'
+                         '\t--all: program the boards on all connected debug adapters concurrently\n'
+                         '\t--adapters BUS:ADDR|SERIAL[,...]: program the boards on the listed debug adapters concurrently\n'
+                         '\t--jobs N: program at most N boards at a time (default: all of them)\n' % (
+                             program_name(), easierocd.stm32.FLASH_BASE) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.image_format, options.base_addr, options.verify, options.reset) = (None, easierocd.stm32.FLASH_BASE, True, True)
+    (options.gang_adapters, options.gang_jobs) = (None, None)
+    image_path = None
+
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in set(['-h', '--help']):
+            print_usage_exit()
+        elif a == '--all':
+            options.gang_adapters = 'all'
+            i += 1
+        elif a in set(['--format', '--base-addr', '--adapters', '--jobs']):
+            try:
+                v = args[i+1]
+            except IndexError:
+                sys.stderr.write('%s: %s requires an argument\n' % (program_name(), a))
+                sys.exit(2)
+            if a == '--format':
+                options.image_format = v
+            elif a == '--adapters':
+                options.gang_adapters = v
+            elif a == '--jobs':
+                try:
+                    options.gang_jobs = int(v)
+                    if options.gang_jobs < 1:
+                        raise ValueError
+                except ValueError:
+                    sys.stderr.write('%s: %r is not a valid number of jobs\n' % (program_name(), v))
+                    sys.exit(2)
+            else:
+                try:
+                    options.base_addr = int(v, 0)
+                except ValueError:
+                    sys.stderr.write('%s: %r is not a valid address\n' % (program_name(), v))
+                    sys.exit(2)
+            i += 2
+        elif a == '--no-verify':
+            options.verify = False
+            i += 1
+        elif a == '--no-reset':
+            options.reset = False
+            i += 1
+        elif image_path is None and not a.startswith('-'):
+            image_path = a
+            i += 1
+        else:
+            j = parse_adapter_option(options, args, i)
+            if j is None:
+                print_usage_exit()
+            i = j
+
+    if image_path is None:
+        print_usage_exit()
+    adapter_options_finalize(options)
+
+    try:
+        image = easierocd.image.load_image(image_path, options.image_format, options.base_addr)
+    except (OSError, easierocd.image.ImageError, easierocd.elf.ElfError) as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        sys.exit(2)
+
+    if options.gang_adapters is not None:
+        # several boards at once, never prompt from worker threads
+        options.non_interactive = True
+        t = time.time()
+        try:
+            results = gang_program(options, image)
+        except OpenOcdSetupError as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e.args[0]))
+            sys.exit(3)
+        if not print_gang_report(results, time.time() - t):
+            sys.exit(1)
+        return
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+
+    t = time.time()
+    try:
+        plan = program_image(o, mcu_info, image, options.verify)
+    except (ProgramError, OpenOcdError, ConnectionError) as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e.args[0] if e.args else e))
+        sys.exit(1)
+    t = time.time() - t
+    print('programmed %d bytes in %.2fs (%.1f KiB/s)' % (plan.write_bytes(), t, plan.write_bytes() / 1024.0 / max(t, 1e-6)))
+
+    if options.reset:
+        o.reset()
     # OpenOCD's 'program' command terminates the daemon when done so we can't use it
 
+@main_function
+def eocd_farm(args):
+    '# Run test jobs on every board attached to this machine'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS] IMAGE...\n'
+                         'Run each IMAGE as a test job on a board: program, reset and wait for the pass or fail marker\n'
+                         'in the output. Jobs are spread over all connected debug adapters.\n'
+                         'OPTIONS:\n'
+                         '\t--require TAG: only run on MCUs with this tag, e.g. "stm32f4" or "st" (repeatable)\n'
+                         '\t--timeout SECONDS: per job (default 60)\n'
+                         '\t--retries N: attempts after target communication errors (default 2)\n'
+                         '\t--repeat N: run every image N times\n'
+                         '\t--pass-marker TEXT (default "PASS")\n'
+                         '\t--fail-marker TEXT (default "FAIL")\n'
+                         '\t--format elf|ihex|bin\n'
+                         '\t--base-addr ADDR: load address of raw binary images (default 0x%x)\n' % (
+                             program_name(), easierocd.stm32.FLASH_BASE) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.image_format, options.base_addr) = (None, easierocd.stm32.FLASH_BASE)
+    job_args = dict(requires=[], timeout=60.0, retries=2, pass_marker=b'PASS', fail_marker=b'FAIL')
+    repeat = 1
+    image_paths = []
+
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in set(['-h', '--help']):
+            print_usage_exit()
+        elif a in set(['--require', '--timeout', '--retries', '--repeat', '--pass-marker', '--fail-marker',
+                       '--format', '--base-addr']):
+            try:
+                v = args[i+1]
+            except IndexError:
+                sys.stderr.write('%s: %s requires an argument\n' % (program_name(), a))
+                sys.exit(2)
+            try:
+                if a == '--require':
+                    job_args['requires'].append(v)
+                elif a == '--timeout':
+                    job_args['timeout'] = float(v)
+                elif a == '--retries':
+                    job_args['retries'] = int(v)
+                elif a == '--repeat':
+                    repeat = int(v)
+                elif a == '--pass-marker':
+                    job_args['pass_marker'] = v.encode('utf-8')
+                elif a == '--fail-marker':
+                    job_args['fail_marker'] = v.encode('utf-8')
+                elif a == '--format':
+                    options.image_format = v
+                else:
+                    options.base_addr = int(v, 0)
+            except ValueError:
+                sys.stderr.write('%s: %r is not a valid value for %s\n' % (program_name(), v, a))
+                sys.exit(2)
+            i += 2
+        elif not a.startswith('-'):
+            image_paths.append(a)
+            i += 1
+        else:
+            j = parse_adapter_option(options, args, i)
+            if j is None:
+                print_usage_exit()
+            i = j
+
+    if not image_paths:
+        print_usage_exit()
+    adapter_options_finalize(options)
+    options.non_interactive = True
+
+    images = []
+    for path in image_paths:
+        try:
+            image = easierocd.image.load_image(path, options.image_format, options.base_addr)
+            image.chunks()
+        except (OSError, easierocd.image.ImageError, easierocd.elf.ElfError) as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e))
+            sys.exit(2)
+        images.append((path, image))
+
+    adapters = easierocd.usb.connected_debug_adapters()
+    if not adapters:
+        sys.stderr.write('%s: no supported debug adapters found\n' % (program_name(),))
+        sys.exit(3)
+
+    def program(o, mcu_info, image):
+        program_image(o, mcu_info, image)
+
+    scheduler = easierocd.farm.Scheduler(lambda adapter: openocd_setup_for_adapter(options, adapter),
+                                         program, easierocd.supervisor.DaemonOutput, adapters)
+    for n in range(repeat):
+        for (path, image) in images:
+            scheduler.submit(easierocd.farm.Job(image, name=os.path.basename(path), **job_args))
+
+    t = time.time()
+    jobs = scheduler.run()
+    t = time.time() - t
+
+    passed = 0
+    for job in jobs:
+        line = '%s %s' % (job.result.upper(), job.name)
+        if job.worker is not None:
+            line += ' on %s in %.2fs' % (job.worker, job.seconds)
+        if job.attempts > 1:
+            line += ' (%d attempts)' % (job.attempts,)
+        if job.error is not None and job.result != job.PASS:
+            line += ': %s' % (job.error,)
+        print(line)
+        passed += (job.result == job.PASS)
+    print('%d/%d passed in %.2fs' % (passed, len(jobs), t))
+    if passed != len(jobs):
+        sys.exit(1)
+
+PROFILE_METHODS = ('swo', 'pcsr')
+
+def profile_swo(options, adapter, mcu_info, o, ingest, follow):
+    if options.cpu_hz is None:
+        sys.stderr.write('%s: --cpu-hz is required to capture SWO\n' % (program_name(),))
+        sys.exit(2)
+    if mcu_info.get('cpu') in ('cortex-m0', 'cortex-m0p'):
+        sys.stderr.write('%s: %s has no SWO, try --method pcsr\n' % (program_name(), mcu_info.get('dev')))
+        sys.exit(1)
+    if not adapter[0].get('default_target_supports_swo'):
+        sys.stderr.write("%s: %s doesn't capture SWO, try --method pcsr\n" % (program_name(), adapter[0]['name']))
+        sys.exit(1)
+    with easierocd.swo.SwoCapture(o, options.cpu_hz, options.swo_hz, pc_sample_hz=options.sample_rate,
+                                  stm32=(mcu_info.get('silicon_vendor') == 'st')) as path:
+        ingest(easierocd.swo.trace_chunks(path, follow=follow))
+
+def profile_pcsr(o, histogram, timeline_path, done):
+    sampler = easierocd.profile.PcsrSampler(o)
+    timeline = open(timeline_path, 'w') if timeline_path is not None else None
+    try:
+        for (times, pcs) in sampler.batches(done):
+            histogram.add(pcs)
+            if timeline is not None:
+                for (t, pc) in zip(times, pcs):
+                    timeline.write('%.6f 0x%08x\n' % (t, pc))
+    finally:
+        if timeline is not None:
+            timeline.close()
+    if sampler.halted:
+        logging.info('%d samples taken while the core was halted were left out' % (sampler.halted,))
+
+@main_function
+def eocd_profile(args):
+    '# Statistical profile of the running firmware from PC samples, the core is never halted'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS]\n'
+                         'Sample the PC of the running core and report where the time goes\n'
+                         'OPTIONS:\n'
+                         '\t--eocd-gdb-file ELF: firmware, for function names\n'
+                         '\t--method swo|pcsr: DWT periodic PC sampling over SWO, or reading DWT_PCSR through\n'
+                         '\t  the debug port (any adapter, lower rate). Default: swo if the adapter captures SWO\n'
+                         '\t  and --cpu-hz is given\n'
+                         '\t--cpu-hz HZ: core clock (required for SWO, it times SWO)\n'
+                         '\t--swo-hz HZ: SWO bit rate (default 2000000)\n'
+                         '\t--sample-rate HZ: PC samples per second (default 10000)\n'
+                         '\t--duration SECONDS (default 5)\n'
+                         '\t--trace-file FILE|-|tcp:HOST:PORT|unix:PATH: profile a recorded SWO capture instead\n'
+                         '\t--folded FILE: also write folded stacks, input for flame graph tools\n'
+                         '\t--timeline FILE: write "SECONDS PC" lines, host time of each sample (pcsr only)\n'
+                         '\t--top N: functions to list (default 30)\n' % (program_name(),) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.gdb_file, options.trace_file, options.folded, options.timeline, options.method) = (None, None, None, None, None)
+    (options.cpu_hz, options.swo_hz, options.sample_rate, options.duration, options.top) = (None, 2000000, 10000, 5.0, 30)
+    value_options = {
+        '--eocd-gdb-file': ('gdb_file', str),
+        '--trace-file': ('trace_file', str),
+        '--folded': ('folded', str),
+        '--timeline': ('timeline', str),
+        '--method': ('method', str),
+        '--cpu-hz': ('cpu_hz', lambda v: int(float(v))),
+        '--swo-hz': ('swo_hz', lambda v: int(float(v))),
+        '--sample-rate': ('sample_rate', lambda v: int(float(v))),
+        '--duration': ('duration', float),
+        '--top': ('top', int),
+    }
+
+    if parse_command_options(options, args, value_options, {}, print_usage_exit):
+        print_usage_exit()
+    adapter_options_finalize(options)
+    if options.method not in (None,) + PROFILE_METHODS:
+        sys.stderr.write('%s: unknown sampling method %r\n' % (program_name(), options.method))
+        sys.exit(2)
+
+    elf = None
+    if options.gdb_file is not None:
+        try:
+            elf = easierocd.elf.ElfFile(options.gdb_file)
+        except (OSError, easierocd.elf.ElfError) as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e))
+            sys.exit(2)
+
+    histogram = easierocd.profile.histogram_for_elf(elf)
+    decoder = easierocd.swo.ItmDecoder()
+
+    def ingest(chunks):
+        for d in chunks:
+            decoder.feed(d)
+            histogram.add(decoder.take_pc_samples())
+
+    if options.trace_file is not None:
+        t = time.time()
+        try:
+            ingest(easierocd.swo.trace_chunks(options.trace_file))
+        except (OSError, ValueError) as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e))
+            sys.exit(2)
+    else:
+        (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+        method = options.method
+        if method is None:
+            method = 'swo' if adapter[0].get('default_target_supports_swo') and options.cpu_hz is not None else 'pcsr'
+        t = time.time()
+        deadline = t + options.duration
+        try:
+            if method == 'pcsr':
+                profile_pcsr(o, histogram, options.timeline, lambda: time.time() > deadline)
+            else:
+                profile_swo(options, adapter, mcu_info, o, ingest, lambda: time.time() < deadline)
+        except OpenOcdError as e:
+            sys.stderr.write('%s: %s sampling failed: %s\n' % (program_name(), method, e))
+            sys.exit(1)
+    t = time.time() - t
+    histogram.add_sleep(decoder.sleep_samples)
+
+    for line in easierocd.profile.report(histogram, elf, options.top, options.folded):
+        print(line)
+    line = '%d samples in %.2fs (%.0f/s)' % (histogram.total, t, histogram.total / max(t, 1e-6))
+    if decoder.bytes_in:
+        stats = decoder.stats()
+        line += ', SWO: %d overflows, %d bytes not decoded' % (stats['overflows'], stats['errors'])
+    print(line)
+
+def rtt_control_block(options, mcu_info, o, elf):
+    '-> RTT control block address: --address, the ELF symbol or a search of RAM'
+    if options.address is not None:
+        return options.address
+    if elf is not None:
+        a = easierocd.rtt.control_block_from_elf(elf)
+        if a is not None:
+            return a
+    ranges = easierocd.rtt.scan_ranges(o.memory_map or [])
+    if not ranges and mcu_info.get('sram_size'):
+        start = mcu_info.get('sram_base', easierocd.openocdcortexm.CORTEX_M_SRAM_ORIGIN)
+        ranges = [(start, start + min(mcu_info['sram_size'], easierocd.rtt.MAX_SCAN_BYTES))]
+    return easierocd.rtt.find_control_block(o, ranges)
+
+@main_function
+def eocd_rtt(args):
+    '# Console over RTT ring buffers in target RAM, the core keeps running'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS]\n'
+                         'Connect stdin/stdout to the firmware\'s RTT buffer 0\n'
+                         'OPTIONS:\n'
+                         '\t--eocd-gdb-file ELF: firmware, the control block is its "_SEGGER_RTT" symbol\n'
+                         '\t--address ADDR: control block address (default: ELF symbol or search of RAM)\n'
+                         '\t--socket-dir DIR: serve each buffer N on the Unix socket DIR/rtt-N as well\n'
+                         '\t--no-stdio: only serve sockets\n' % (program_name(),) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.gdb_file, options.address, options.socket_dir, options.stdio) = (None, None, None, True)
+    value_options = {
+        '--eocd-gdb-file': ('gdb_file', str),
+        '--address': ('address', lambda v: int(v, 0)),
+        '--socket-dir': ('socket_dir', str),
+    }
+
+    if parse_command_options(options, args, value_options, {'--no-stdio': ('stdio', False)}, print_usage_exit):
+        print_usage_exit()
+    adapter_options_finalize(options)
+    if not options.stdio and options.socket_dir is None:
+        sys.stderr.write('%s: --no-stdio needs --socket-dir\n' % (program_name(),))
+        sys.exit(2)
+
+    elf = None
+    if options.gdb_file is not None:
+        try:
+            elf = easierocd.elf.ElfFile(options.gdb_file)
+        except (OSError, easierocd.elf.ElfError) as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e))
+            sys.exit(2)
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+    try:
+        rtt = easierocd.rtt.RttChannel(o, rtt_control_block(options, mcu_info, o, elf))
+        server = easierocd.rtt.RttServer(rtt, stdio=options.stdio, socket_dir=options.socket_dir)
+    except (OpenOcdError, easierocd.rtt.RttError, OSError) as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        sys.exit(1)
+    logging.info('RTT control block at 0x%x: %s' % (rtt.address, ', '.join(repr(b) for b in rtt.buffers())))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    except (OpenOcdError, easierocd.rtt.RttError) as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        return 1
+    finally:
+        server.close()
+
+@main_function
+def eocd_semihost(args):
+    '# Service the firmware\'s semihosting calls: console, files in a sandbox directory, exit code'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS]\n'
+                         'Run the firmware and service its ARM semihosting calls until it exits,\n'
+                         'exit with its exit code\n'
+                         'OPTIONS:\n'
+                         '\t--root DIR: files the firmware opens are in DIR (default: current directory)\n'
+                         '\t--output FILE|-|tcp:HOST:PORT|unix:PATH: console output (default: stdout)\n'
+                         '\t--cmdline ARGS: command line the firmware gets from SYS_GET_CMDLINE\n'
+                         '\t--reset: reset the target first, otherwise attach to the running firmware\n'
+                         '\t--timeout SECONDS: give up after this long\n' % (program_name(),) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.root, options.output, options.cmdline, options.reset, options.timeout) = ('.', '-', '', False, None)
+    value_options = {
+        '--root': ('root', str),
+        '--output': ('output', str),
+        '--cmdline': ('cmdline', str),
+        '--timeout': ('timeout', float),
+    }
+
+    if parse_command_options(options, args, value_options, {'--reset': ('reset', True)}, print_usage_exit):
+        print_usage_exit()
+    adapter_options_finalize(options)
+    if not os.path.isdir(options.root):
+        sys.stderr.write('%s: %s is not a directory\n' % (program_name(), options.root))
+        sys.exit(2)
+
+    try:
+        output = easierocd.semihosting.open_output(options.output)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('%s: %s: %s\n' % (program_name(), options.output, e))
+        sys.exit(2)
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+    service = easierocd.semihosting.SemihostingService(o, options.root, output, cmdline=options.cmdline)
+    deadline = None if options.timeout is None else time.time() + options.timeout
+    try:
+        if options.reset:
+            # semihosting is ours and halts are listened for before the firmware's first call
+            service.start()
+            o.reset()
+        exit_code = service.serve(lambda: deadline is not None and time.time() > deadline)
+    except KeyboardInterrupt:
+        return 130
+    except OpenOcdError as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        return 1
+    finally:
+        service.close()
+    if exit_code is None:
+        sys.stderr.write('%s: timed out after %d calls\n' % (program_name(), service.calls))
+        return 124
+    return exit_code
+
+@main_function
+def eocd_watch(args):
+    '# Sample variables of the running firmware into time series, the core is never halted'
+    logging.basicConfig(level=logging.INFO)
+
+    def print_usage_exit():
+        sys.stderr.write('%s [OPTIONS] VARIABLE...\n'
+                         'Sample variables while the firmware runs\n'
+                         'VARIABLE: SYMBOL[+OFFSET][:TYPE] (needs --eocd-gdb-file) or ADDR:TYPE\n'
+                         '\tTYPE: %s, symbols default to the unsigned type of their size\n'
+                         'OPTIONS:\n'
+                         '\t--eocd-gdb-file ELF: firmware, for symbols\n'
+                         '\t--rate HZ: samples per second, 0 for as fast as possible (default 1000)\n'
+                         '\t--duration SECONDS (default 10)\n'
+                         '\t--capacity N: samples kept, the oldest go first (default 1000000)\n'
+                         '\t--mmap FILE: keep samples in a memory mapped FILE rather than in memory\n'
+                         '\t--csv FILE|-: write the samples as CSV (the default, to stdout)\n'
+                         '\t--npz FILE: write the samples as a NumPy .npz file\n' % (
+                             program_name(), ' '.join(easierocd.watch.TYPES)) +
+                         ADAPTER_OPTIONS_USAGE +
+                         'Environemnt Variables\n' +
+                         ADAPTER_ENVIRONMENT_USAGE)
+        sys.exit(2)
+
+    options = adapter_options_from_environment()
+    (options.gdb_file, options.mmap, options.csv, options.npz) = (None, None, None, None)
+    (options.rate, options.duration, options.capacity) = (1000.0, 10.0, 1000000)
+    value_options = {
+        '--eocd-gdb-file': ('gdb_file', str),
+        '--rate': ('rate', float),
+        '--duration': ('duration', float),
+        '--capacity': ('capacity', int),
+        '--mmap': ('mmap', str),
+        '--csv': ('csv', str),
+        '--npz': ('npz', str),
+    }
+
+    specs = parse_command_options(options, args, value_options, {}, print_usage_exit)
+    adapter_options_finalize(options)
+    if not specs or options.capacity <= 0:
+        print_usage_exit()
+    if options.csv is None and options.npz is None:
+        options.csv = '-'
+
+    elf = None
+    if options.gdb_file is not None:
+        try:
+            elf = easierocd.elf.ElfFile(options.gdb_file)
+        except (OSError, easierocd.elf.ElfError) as e:
+            sys.stderr.write('%s: %s\n' % (program_name(), e))
+            sys.exit(2)
+    try:
+        variables = [ easierocd.watch.parse_variable(x, elf) for x in specs ]
+    except easierocd.watch.WatchError as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        sys.exit(2)
+
+    (adapter, dap_info, mcu_info, o) = setup_or_exit(options)
+    store = easierocd.watch.RingStore(variables, options.capacity, options.mmap)
+    sampler = easierocd.watch.VariableSampler(o, variables)
+    t = time.time()
+    deadline = t + options.duration
+    failed = False
+    try:
+        for (times, columns) in sampler.batches(lambda: time.time() > deadline, options.rate or None):
+            store.append(times, columns)
+    except KeyboardInterrupt:
+        pass
+    except (OpenOcdError, ConnectionError) as e:
+        # what has been sampled is still written out
+        sys.stderr.write('%s: sampling failed: %s\n' % (program_name(), str(e) or 'OpenOCD connection closed'))
+        failed = True
+    t = time.time() - t
+
+    try:
+        if options.csv == '-':
+            store.export_csv(sys.stdout)
+        elif options.csv is not None:
+            with open(options.csv, 'w', newline='') as f:
+                store.export_csv(f)
+        if options.npz is not None:
+            store.export_npz(options.npz)
+    except (OSError, easierocd.watch.WatchError) as e:
+        sys.stderr.write('%s: %s\n' % (program_name(), e))
+        return 1
+    finally:
+        store.close()
+    sys.stderr.write('%d samples in %.2fs (%.0f/s), %d dropped\n' % (
+        store.count, t, store.count / max(t, 1e-6), store.dropped))
+    if failed:
+        return 1
+
 @main_function
 def eocd_stop(args):
-    help_msg = 'stop all background processes'
+    '# Stop all background processes: the OpenOCD daemons, their brokers and the supervisor'
+
+    def print_usage_exit():
+        sys.stderr.write('%s\nStops all OpenOCD daemons and the easierocd supervisor\n' % (program_name(),))
+        sys.exit(2)
+
+    if args:
+        print_usage_exit()
+
+    if not easierocd.supervisor.shutdown():
+        print('nothing running')
 
 @main_function
 def eocd_list(args):
@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+
+# Adapter clock tuning
+#
+# OpenOCD target config files use the most conservative adapter speed (see documentation/openocd-adapter-speed).
+# Here we raise the speed step by step after 'init', check each step with a write/read/compare burst
+# through target RAM and back off on the first error.
+# The best stable speed is remembered per debug adapter (USB serial) and MCU (ID code)
+# so that later sessions start at that speed directly.
+
+import os
+import json
+import errno
+import logging
+import tempfile
+
+from easierocd.openocd import (OpenOcdError, TargetCommunicationError)
+from easierocd.util import hex_str_literal_double_quoted
+from easierocd.statestore import LockedState
+
+# Speed OpenOCD is configured with before anything is known about the target
+DEFAULT_ADAPTER_KHZ = 300
+
+# Candidate speeds. Adapters round down to what they support, e.g. ST-Link/V2: 4000, 1800, 950, 480 ...
+ADAPTER_KHZ_STEPS = [300, 500, 1000, 2000, 4000, 8000, 12000, 24000]
+
+# burst used to validate a speed
+VALIDATE_BYTES = 1024
+VALIDATE_ROUNDS = 3
+
+# Cortex-M CPUID register, constant for the part so it makes a good read check
+CPUID_ADDR = 0xe000ed00
+
+def store_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'easierocd', 'adapter-speed.json')
+
+def board_key(adapter, mcu_info):
+    '''
+    -> key identifying the (debug adapter, MCU) pair or None when the adapter has no serial number
+
+    >>> from easierocd.util import Bag
+    >>> d = Bag(); d.serial_number = '0669FF'
+    >>> board_key(({'name': 'ST-Link/V2-1'}, d), {'idcode': 0x10036419})
+    'ST-Link/V2-1 "0669FF" 0x10036419'
+    '''
+    (info, device) = adapter
+    serial = getattr(device, 'serial_number', None)
+    if not serial:
+        return None
+    return '%s %s 0x%08x' % (info['name'], hex_str_literal_double_quoted(serial), mcu_info.get('idcode', 0))
+
+class AdapterSpeedStore(object):
+    '''
+    JSON file mapping board_key() -> best stable adapter speed in kHz
+
+    >>> import tempfile
+    >>> s = AdapterSpeedStore(os.path.join(tempfile.mkdtemp(), 'easierocd', 'adapter-speed.json'))
+    >>> s.put('a', 4000); s.put('b', 1800); s.forget('a')
+    >>> (s.get('a'), s.get('b'))
+    (None, 1800)
+    '''
+    def __init__(self, path=None):
+        if path is None:
+            path = store_path()
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logging.warning('adapter speed store %s: %s' % (self.path, e))
+            return {}
+        except ValueError:
+            logging.warning('adapter speed store %s: corrupt, ignoring' % (self.path,))
+            return {}
+
+    def get(self, key):
+        if key is None:
+            return None
+        return self._load().get(key)
+
+    def put(self, key, khz):
+        if key is None:
+            return
+        with self._locked():
+            d = self._load()
+            d[key] = khz
+            self._save(d)
+
+    def forget(self, key):
+        with self._locked():
+            d = self._load()
+            if key in d:
+                del d[key]
+                self._save(d)
+
+    def _locked(self):
+        'gang programming and farm workers update the store concurrently, serialize read-modify-write'
+        self._makedirs()
+        return LockedState(self.path + '.lock')
+
+    def _makedirs(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _save(self, d):
+        # write then rename so readers never see a partial file
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.adapter-speed-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+def link_ok(openocd_rpc, ram_addr, pattern, expected_cpuid):
+    '-> True if a write/read/compare burst through target RAM succeeds at the current speed'
+    o = openocd_rpc
+    try:
+        if o.read_word(CPUID_ADDR) != expected_cpuid:
+            return False
+        for i in range(VALIDATE_ROUNDS):
+            p = pattern[i:] + pattern[:i]
+            o.write_mem(ram_addr, p)
+            if o.read_mem(ram_addr, len(p)) != p:
+                return False
+    except (OpenOcdError, TargetCommunicationError, ValueError) as e:
+        logging.debug('adapter speed: validation failed: %r' % (e,))
+        return False
+    return True
+
+def tune(openocd_rpc, ram_addr, start_khz=DEFAULT_ADAPTER_KHZ, max_khz=None):
+    '''
+    Raise adapter speed step by step until validation fails
+    -> best speed in kHz that passed validation
+
+    Target RAM at [ram_addr, ram_addr + VALIDATE_BYTES) is saved and restored
+    and the target is halted for the duration.
+    '''
+    o = openocd_rpc
+    with _halted_and_ram_preserved(o, ram_addr):
+        pattern = bytearray(os.urandom(VALIDATE_BYTES))
+        expected_cpuid = o.read_word(CPUID_ADDR)
+        best = o.adapter_khz(start_khz)
+        if not link_ok(o, ram_addr, pattern, expected_cpuid):
+            raise OpenOcdError('adapter speed: no stable speed', best)
+
+        for khz in ADAPTER_KHZ_STEPS:
+            if khz <= best or (max_khz is not None and khz > max_khz):
+                continue
+            actual = o.adapter_khz(khz)
+            if actual <= best:
+                # adapter maxed out, further requests get rounded down
+                break
+            if not link_ok(o, ram_addr, pattern, expected_cpuid):
+                logging.info('adapter speed: %d kHz unstable, backing off to %d kHz' % (actual, best))
+                break
+            best = actual
+
+        o.adapter_khz(best)
+        if not link_ok(o, ram_addr, pattern, expected_cpuid):
+            raise OpenOcdError('adapter speed: %d kHz unstable after backing off' % (best,), best)
+    logging.info('adapter speed: %d kHz' % (best,))
+    return best
+
+def apply_remembered(openocd_rpc, ram_addr, khz):
+    '-> True if the remembered speed "khz" passes validation and is now in effect'
+    o = openocd_rpc
+    with _halted_and_ram_preserved(o, ram_addr):
+        pattern = bytearray(os.urandom(VALIDATE_BYTES))
+        expected_cpuid = o.read_word(CPUID_ADDR)
+        o.adapter_khz(khz)
+        if link_ok(o, ram_addr, pattern, expected_cpuid):
+            return True
+        o.adapter_khz(DEFAULT_ADAPTER_KHZ)
+    return False
+
+class _halted_and_ram_preserved(object):
+    def __init__(self, openocd_rpc, ram_addr):
+        (self.o, self.ram_addr) = (openocd_rpc, ram_addr)
+
+    def __enter__(self):
+        o = self.o
+        self.was_running = (o.poll().state == 'running')
+        if self.was_running:
+            o.halt()
+        self.saved = o.read_mem(self.ram_addr, VALIDATE_BYTES)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        o = self.o
+        try:
+            o.write_mem(self.ram_addr, self.saved)
+            if self.was_running:
+                o.resume()
+        except (OpenOcdError, TargetCommunicationError):
+            if exc_type is None:
+                raise
+        return False
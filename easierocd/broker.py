@@ -0,0 +1,355 @@
+from __future__ import absolute_import
+
+# Per debug adapter command broker
+#
+# OpenOCD copes badly with more than one TCL RPC connection (documentation/BUGS-2nd-tcl-rpc-connection)
+# and every new connection costs a round of probing. The broker owns the only TCL connection to the
+# adapter's OpenOCD daemon and serves any number of local clients (gdb helpers, programming, monitors)
+# over a Unix socket. Brokers run as threads of the supervisor (see easierocd.supervisor).
+#
+# Clients speak the OpenOCD TCL RPC protocol, OpenOcdRpc(path=...) works unchanged.
+# Commands starting with "eocd_broker" are handled by the broker itself:
+#   eocd_broker priority interactive|background
+#   eocd_broker begin       no other client's commands run until "commit" (or "abort"),
+#   eocd_broker commit      the owner disconnecting or idling for TRANSACTION_TIMEOUT
+#   eocd_broker ping        -> "pong"
+#   eocd_broker notifications on
+#                           turn this connection into a side channel that receives OpenOCD's
+#                           asynchronous target notifications (see OpenOcdRpc.notifications())
+#
+# The upstream connection has OpenOCD's "tcl_notifications" on while anyone is subscribed,
+# notifications are told apart from command replies and fanned out to the subscribers.
+#
+# Scheduling: one command at a time (OpenOCD is single threaded anyway), interactive clients first,
+# the least recently served client within a priority class. After INTERACTIVE_BURST interactive commands
+# one waiting background command runs so monitors make progress without stalling gdb.
+
+import os
+import time
+import socket
+import logging
+import selectors
+import collections
+
+from easierocd.openocd import (OpenOcdRpc, is_notification)
+
+PRIORITIES = {'interactive': 0, 'background': 1}
+(INTERACTIVE, BACKGROUND) = (0, 1)
+
+INTERACTIVE_BURST = 8
+TRANSACTION_TIMEOUT = 10.0
+
+# Reconnecting to OpenOCD is attempted at most this often
+RECONNECT_INTERVAL = 0.5
+
+# Replies to clients that don't read them for this long get the client dropped
+CLIENT_SEND_TIMEOUT = 5.0
+
+IDLE_CHECK_INTERVAL = 1.0
+
+BROKER_COMMAND_PREFIX = b'eocd_broker'
+
+def split_messages(buf):
+    r'''
+    -> ([ complete message, ...], rest of "buf")
+
+    >>> split_messages(bytearray(b'ocd_poll\x1aocd_mdw 0x0\x1aocd_h'))
+    ([b'ocd_poll', b'ocd_mdw 0x0'], bytearray(b'ocd_h'))
+    '''
+    parts = buf.split(OpenOcdRpc.SEPARATOR)
+    return ([ bytes(x) for x in parts[:-1] ], parts[-1])
+
+class _Client(object):
+    __slots__ = ('sock', 'rbuf', 'pending', 'priority', 'last_served', 'name', 'subscribed')
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.rbuf = bytearray()
+        self.pending = collections.deque()
+        self.priority = INTERACTIVE
+        self.last_served = 0
+        self.name = name
+        self.subscribed = False
+
+class Broker(object):
+    '''
+    upstream(): -> (openocd_pid, tcl_port) of the OpenOCD daemon to talk to, None when there is none
+    '''
+    def __init__(self, sock_path, upstream):
+        self.sock_path = sock_path
+        self.upstream = upstream
+        self.orpc = None
+        self.last_connect = 0.0
+        # replies read from upstream, notifications are split off as they arrive
+        self.up_buf = bytearray()
+        self.up_replies = collections.deque()
+        self.clients = {}
+        self.seq = 0
+        self.interactive_streak = 0
+        (self.txn_owner, self.txn_deadline) = (None, 0.0)
+        self.n_clients = 0
+        # when the last command ran, see easierocd.supervisor idle timeouts
+        self.last_activity = time.time()
+
+        self.sel = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(sock_path)
+        except FileNotFoundError:
+            pass
+        self.listener.bind(sock_path)
+        self.listener.listen(16)
+        self.listener.setblocking(False)
+        self.sel.register(self.listener, selectors.EVENT_READ)
+        self.sock_ino = os.stat(sock_path).st_ino
+
+    # upstream
+
+    def connect_upstream(self):
+        '-> OpenOcdRpc or None'
+        u = self.upstream()
+        if self.orpc is not None:
+            if u is not None and u[0] == self.orpc.pid:
+                return self.orpc
+            # OpenOCD was restarted, don't send the command into the old connection
+            self.drop_upstream()
+        if u is None:
+            return None
+        wait = self.last_connect + RECONNECT_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_connect = time.time()
+        (pid, tcl_port) = u
+        try:
+            o = OpenOcdRpc(port=tcl_port, pid=pid)
+            # the port could have been taken over by another process
+            if o.getpid() != pid:
+                o.close()
+                return None
+        except (OSError, ConnectionError, ValueError) as e:
+            logging.debug('broker: connecting to OpenOCD on port %d: %r' % (tcl_port, e))
+            return None
+        logging.debug('broker: connected to OpenOCD pid %d, port %d' % (pid, tcl_port))
+        self.orpc = o
+        self.up_buf = bytearray()
+        self.up_replies.clear()
+        self.sel.register(o.conn, selectors.EVENT_READ, self)
+        if any(c.subscribed for c in self.clients.values()):
+            try:
+                self.upstream_call(b'tcl_notifications on')
+            except (OSError, ConnectionError):
+                self.drop_upstream()
+                return None
+        return o
+
+    def drop_upstream(self):
+        if self.orpc is not None:
+            self.sel.unregister(self.orpc.conn)
+            try:
+                self.orpc.close()
+            except OSError:
+                pass
+            self.orpc = None
+
+    def upstream_read(self):
+        'read what OpenOCD has sent, forward notifications, queue replies'
+        d = self.orpc.conn.recv(OpenOcdRpc.BUFSIZE)
+        if not d:
+            raise ConnectionError
+        self.up_buf += d
+        (msgs, self.up_buf) = split_messages(self.up_buf)
+        for m in msgs:
+            if is_notification(m):
+                for c in list(self.clients.values()):
+                    if c.subscribed:
+                        self.reply(c, m)
+            else:
+                self.up_replies.append(m)
+
+    def upstream_call(self, cmd):
+        '-> reply to "cmd" from OpenOCD'
+        # replies nobody waits for can't be matched to a command any more
+        self.up_replies.clear()
+        self.orpc.send_msg(cmd)
+        while not self.up_replies:
+            self.upstream_read()
+        return self.up_replies.popleft()
+
+    # clients
+
+    def accept(self):
+        try:
+            (sock, addr) = self.listener.accept()
+        except BlockingIOError:
+            return
+        self.n_clients += 1
+        c = _Client(sock, 'client%d' % (self.n_clients,))
+        sock.setblocking(False)
+        self.clients[sock] = c
+        self.sel.register(sock, selectors.EVENT_READ, c)
+
+    def drop_client(self, c):
+        if c.sock not in self.clients:
+            return
+        del self.clients[c.sock]
+        self.sel.unregister(c.sock)
+        c.sock.close()
+        if self.txn_owner is c:
+            logging.debug('broker: %s disconnected in a transaction' % (c.name,))
+            self.txn_owner = None
+
+    def client_readable(self, c):
+        try:
+            d = c.sock.recv(OpenOcdRpc.BUFSIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            d = b''
+        if not d:
+            self.drop_client(c)
+            return
+        c.rbuf += d
+        (msgs, c.rbuf) = split_messages(c.rbuf)
+        c.pending.extend(msgs)
+
+    def reply(self, c, r):
+        c.sock.settimeout(CLIENT_SEND_TIMEOUT)
+        try:
+            c.sock.sendall(r + OpenOcdRpc.SEPARATOR)
+        except OSError:
+            self.drop_client(c)
+            return
+        c.sock.setblocking(False)
+
+    # scheduling
+
+    def next_client(self):
+        '-> client whose next command runs now or None'
+        if self.txn_owner is not None:
+            if time.time() > self.txn_deadline:
+                logging.warning('broker: %s: transaction timed out' % (self.txn_owner.name,))
+                self.txn_owner = None
+            else:
+                return self.txn_owner if self.txn_owner.pending else None
+
+        ready = [ c for c in self.clients.values() if c.pending ]
+        if not ready:
+            return None
+        interactive = [ c for c in ready if c.priority == INTERACTIVE ]
+        background = [ c for c in ready if c.priority != INTERACTIVE ]
+        if interactive and (not background or self.interactive_streak < INTERACTIVE_BURST):
+            candidates = interactive
+        else:
+            candidates = background
+        return min(candidates, key=lambda c: c.last_served)
+
+    def run_one(self, c):
+        cmd = c.pending.popleft()
+        self.last_activity = time.time()
+        self.seq += 1
+        c.last_served = self.seq
+        if c.priority == INTERACTIVE:
+            self.interactive_streak += 1
+        else:
+            self.interactive_streak = 0
+        if self.txn_owner is c:
+            self.txn_deadline = time.time() + TRANSACTION_TIMEOUT
+
+        if cmd.startswith(BROKER_COMMAND_PREFIX):
+            self.reply(c, self.broker_command(c, cmd))
+            return
+
+        o = self.connect_upstream()
+        if o is None:
+            # same as OpenOCD going away under a direct connection
+            self.drop_client(c)
+            return
+        try:
+            r = self.upstream_call(cmd)
+        except (OSError, ConnectionError) as e:
+            logging.debug('broker: OpenOCD connection lost: %r' % (e,))
+            self.drop_upstream()
+            self.drop_client(c)
+            return
+        self.reply(c, r)
+
+    def broker_command(self, c, cmd):
+        args = cmd.split()[1:]
+        if args == [b'ping']:
+            return b'pong'
+        if len(args) == 2 and args[0] == b'priority':
+            p = PRIORITIES.get(args[1].decode('ascii', 'replace'))
+            if p is None:
+                return b'unknown priority ' + args[1]
+            c.priority = p
+            return b''
+        if args == [b'begin']:
+            if self.txn_owner is not None:
+                # can't happen, other clients aren't scheduled during a transaction
+                return b'transaction already in progress'
+            (self.txn_owner, self.txn_deadline) = (c, time.time() + TRANSACTION_TIMEOUT)
+            return b''
+        if args in ([b'commit'], [b'abort']):
+            if self.txn_owner is c:
+                self.txn_owner = None
+            return b''
+        if args == [b'notifications', b'on']:
+            first = not any(x.subscribed for x in self.clients.values())
+            c.subscribed = True
+            if first and self.orpc is not None:
+                try:
+                    self.upstream_call(b'tcl_notifications on')
+                except (OSError, ConnectionError):
+                    self.drop_upstream()
+            elif self.orpc is None:
+                # notifications get turned on as part of connecting
+                self.connect_upstream()
+            return b''
+        return b'invalid command name "' + cmd + b'"'
+
+    def still_needed(self):
+        # removed or replaced socket: another broker took over or the adapter went away
+        try:
+            if os.stat(self.sock_path).st_ino != self.sock_ino:
+                return False
+        except FileNotFoundError:
+            return False
+        return self.orpc is not None or self.upstream() is not None
+
+    def serve_forever(self):
+        last_check = time.time()
+        while True:
+            c = self.next_client()
+            timeout = 0 if c is not None else IDLE_CHECK_INTERVAL
+            for (key, events) in self.sel.select(timeout):
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.data is self:
+                    try:
+                        self.upstream_read()
+                    except (OSError, ConnectionError):
+                        self.drop_upstream()
+                else:
+                    self.client_readable(key.data)
+            c = self.next_client()
+            if c is not None:
+                self.run_one(c)
+
+            now = time.time()
+            if now - last_check >= IDLE_CHECK_INTERVAL:
+                last_check = now
+                if not self.still_needed():
+                    logging.debug('broker: %s: no longer needed, exiting' % (self.sock_path,))
+                    return
+
+    def close(self):
+        for c in list(self.clients.values()):
+            self.drop_client(c)
+        self.drop_upstream()
+        self.sel.unregister(self.listener)
+        self.listener.close()
+        try:
+            if os.stat(self.sock_path).st_ino == self.sock_ino:
+                os.unlink(self.sock_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+
+# Raise the MCU clock before programming and bulk memory access
+#
+# Flash driver throughput and the usable adapter speed are both bound by the core clock,
+# most MCUs come out of reset running from a slow internal oscillator.
+# The per family recipes live with the device data (see easierocd.stm32.clock_boost_recipe()).
+#
+# A recipe is applied by OpenOCD's 'reset-init' event handler (reset_init_handler_tcl()), the next
+# reset puts the clocks back. Nothing boosts a running target: the firmware owns its clocks then.
+
+import easierocd.stm32 as stm32
+from easierocd.openocd import register_ops_tcl
+
+def recipe_for_mcu(mcu_info):
+    '-> clock boost recipe or None'
+    if mcu_info.get('silicon_vendor') != 'st':
+        return None
+    return stm32.clock_boost_recipe(mcu_info['stm32_family'], mcu_info['dev_id'])
+
+def reset_init_handler_tcl(recipe):
+    '''
+    -> body of a 'reset-init' event handler that boosts the clock and raises the adapter speed
+       to the recipe's or the selected speed (see EASIEROCD_ADAPTER_KHZ), whichever is faster
+
+    >>> r = {'adapter_khz': 2000, 'ops': [('write', 0x40023808, 0x1)]}
+    >>> print(reset_init_handler_tcl(r))
+    mww 0x40023808 0x1
+    if {$::EASIEROCD_ADAPTER_KHZ < 2000} {adapter_khz 2000} else {adapter_khz $::EASIEROCD_ADAPTER_KHZ}
+    '''
+    return '%s\nif {$::EASIEROCD_ADAPTER_KHZ < %d} {adapter_khz %d} else {adapter_khz $::EASIEROCD_ADAPTER_KHZ}' % (
+        register_ops_tcl(recipe['ops']), recipe['adapter_khz'], recipe['adapter_khz'])
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+
+# Device database
+#
+# What easierocd knows about MCUs (ID codes, memory sizes, flash geometry and driver, OpenOCD target
+# files, clock boost recipes) is data in devices.json next to this file. It is loaded on first use
+# and indexed for dict lookups.
+#
+# Numbers may be written as "0x..." strings. Families hold what their devices share, device entries
+# override family values of the same name.
+# More files are loaded on top of the built-in one, their families and devices add to or replace the
+# built-in ones with the same key:
+#   $XDG_CONFIG_HOME/easierocd/devices.json
+#   $EOCD_DEVICE_DB, os.pathsep separated list of files
+
+import os
+import re
+import json
+import logging
+import threading
+
+BUILTIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.json')
+
+_HEX_RE = re.compile(r'^0x[0-9a-fA-F]+$')
+
+class DeviceDbError(Exception):
+    pass
+
+def _numbers(v):
+    '''
+    "0x..." strings -> int, in dict keys as well
+
+    >>> _numbers({'id': '0x413', 'revisions': {'0x1000': 'Rev A'}, 'ops': [['set', '0x40023800', '0x1']]})
+    {'id': 1043, 'revisions': {4096: 'Rev A'}, 'ops': [['set', 1073887232, 1]]}
+    '''
+    if isinstance(v, dict):
+        return dict((_numbers(k), _numbers(x)) for (k, x) in v.items())
+    if isinstance(v, list):
+        return [ _numbers(x) for x in v ]
+    if isinstance(v, str) and _HEX_RE.match(v):
+        return int(v, 16)
+    return v
+
+def overlay_paths():
+    config_dir = os.environ.get('XDG_CONFIG_HOME', os.path.join(os.path.expanduser('~'), '.config'))
+    paths = [ os.path.join(config_dir, 'easierocd', 'devices.json') ]
+    paths.extend(x for x in os.environ.get('EOCD_DEVICE_DB', '').split(os.pathsep) if x)
+    return paths
+
+class DeviceDb(object):
+    '''
+    >>> d = DeviceDb()
+    >>> d.add({'families': {'stm32f4': {'vendor': 'st', 'write_align': 2}},
+    ...        'devices': [{'vendor': 'st', 'id': '0x413', 'family': 'stm32f4', 'name': 'STM32F40x'}]})
+    >>> d.device('st', 0x413)['write_align']
+    2
+    >>> d.device('st', 0x999) is None
+    True
+    '''
+    def __init__(self):
+        self.families = {}
+        self.aliases = {}
+        # (vendor, id) -> device entry with the family's values filled in
+        self.devices = {}
+        self._raw_devices = {}
+
+    def load(self, path):
+        try:
+            with open(path, 'r') as f:
+                d = json.load(f)
+        except ValueError as e:
+            raise DeviceDbError('%s: %s' % (path, e))
+        self.add(d)
+
+    def add(self, d):
+        d = _numbers(d)
+        self.aliases.update(d.get('family_aliases', {}))
+        for (name, fam) in d.get('families', {}).items():
+            fam = dict(fam)
+            fam['family'] = name
+            self.families[name] = fam
+        for dev in d.get('devices', []):
+            self._raw_devices[(dev['vendor'], dev['id'])] = dev
+        # families may have changed under devices added earlier
+        self.devices = {}
+        for (k, dev) in self._raw_devices.items():
+            merged = dict(self.families.get(dev.get('family'), {}))
+            merged.update(dev)
+            self.devices[k] = merged
+
+    def family(self, name):
+        '-> family entry or None'
+        return self.families.get(self.aliases.get(name, name))
+
+    def device(self, vendor, dev_id):
+        '-> device entry (family values included) or None'
+        return self.devices.get((vendor, dev_id))
+
+    def vendor_devices(self, vendor):
+        return [ d for ((v, i), d) in self.devices.items() if v == vendor ]
+
+_db = None
+_db_lock = threading.Lock()
+
+def db():
+    '-> DeviceDb, loaded on first use'
+    global _db
+    with _db_lock:
+        if _db is None:
+            d = DeviceDb()
+            d.load(BUILTIN_PATH)
+            for p in overlay_paths():
+                if os.path.exists(p):
+                    logging.debug('device database: loading %s' % (p,))
+                    d.load(p)
+            _db = d
+        return _db
+
+def family(name):
+    return db().family(name)
+
+def device(vendor, dev_id):
+    return db().device(vendor, dev_id)
@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+
+# Minimal ELF32 reader, just enough to load firmware images and look up symbols.
+# The file is mmap'ed and segment contents are handed out as memoryviews into the mapping,
+# nothing is copied.
+
+import os
+import mmap
+import struct
+import bisect
+import collections
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+(ELFDATA2LSB, ELFDATA2MSB) = (1, 2)
+
+# e_type
+ET_EXEC = 2
+# e_machine
+EM_ARM = 40
+# p_type
+PT_LOAD = 1
+# p_flags
+PF_X = 0x1
+# sh_type
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+# symbol types, low nibble of st_info
+(STT_NOTYPE, STT_OBJECT, STT_FUNC) = (0, 1, 2)
+
+ProgramHeader = collections.namedtuple('ProgramHeader',
+    'type offset vaddr paddr filesz memsz flags align')
+
+SectionHeader = collections.namedtuple('SectionHeader',
+    'name type flags addr offset size link info addralign entsize')
+
+# value: address, the Thumb bit of functions cleared
+Symbol = collections.namedtuple('Symbol', 'name value size type')
+
+class ElfError(Exception):
+    pass
+
+def is_elf(buf):
+    '''
+    >>> is_elf(b'\\x7fELF\\x01\\x01\\x01')
+    True
+    >>> is_elf(b':020000040800F2')
+    False
+    '''
+    return bytes(buf[:4]) == ELF_MAGIC
+
+class ElfFile(object):
+    '''
+    ELF32 file, mmap'ed read only
+
+    Cortex-M toolchains only produce ELF32, ELF64 is rejected.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 52:
+                raise ElfError('%s: too short to be an ELF file' % (path,))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self._mmap)
+        self._parse_header()
+        self._sections = None
+
+    def _parse_header(self):
+        b = self.buf
+        if not is_elf(b):
+            raise ElfError('%s: not an ELF file' % (self.path,))
+        (ei_class, ei_data) = (b[4], b[5])
+        if ei_class != ELFCLASS32:
+            raise ElfError('%s: only ELF32 is supported' % (self.path,))
+        if ei_data == ELFDATA2LSB:
+            self.endian = '<'
+        elif ei_data == ELFDATA2MSB:
+            self.endian = '>'
+        else:
+            raise ElfError('%s: invalid ELF data encoding %d' % (self.path, ei_data))
+
+        (self.e_type, self.e_machine, self.e_version, self.e_entry,
+         self.e_phoff, self.e_shoff, self.e_flags, self.e_ehsize,
+         self.e_phentsize, self.e_phnum, self.e_shentsize, self.e_shnum,
+         self.e_shstrndx) = struct.unpack_from(self.endian + 'HHIIIIIHHHHHH', b, 16)
+
+    def program_headers(self):
+        '-> [ ProgramHeader, ...]'
+        fmt = struct.Struct(self.endian + 'IIIIIIII')
+        out = []
+        for i in range(self.e_phnum):
+            out.append(ProgramHeader._make(fmt.unpack_from(self.buf, self.e_phoff + i * self.e_phentsize)))
+        return out
+
+    def sections(self):
+        '-> [ SectionHeader, ...] with names resolved'
+        if self._sections is not None:
+            return self._sections
+        fmt = struct.Struct(self.endian + 'IIIIIIIIII')
+        raw = [ fmt.unpack_from(self.buf, self.e_shoff + i * self.e_shentsize)
+                for i in range(self.e_shnum) ]
+        out = []
+        if raw and self.e_shstrndx < len(raw):
+            strtab_off = raw[self.e_shstrndx][4]
+            for r in raw:
+                out.append(SectionHeader._make((self.cstring(strtab_off + r[0]),) + r[1:]))
+        self._sections = out
+        return out
+
+    def cstring(self, offset):
+        end = self._mmap.find(b'\x00', offset)
+        if end < 0:
+            end = len(self.buf)
+        return bytes(self.buf[offset:end]).decode('ascii', 'replace')
+
+    def load_segments(self):
+        '''
+        -> [ ProgramHeader, ...] for the segments with file contents
+
+        Callers should place segments at the physical (load) address so that initialized data
+        destined for RAM ends up at its flash copy, the way the startup code expects it.
+        '''
+        out = []
+        for ph in self.program_headers():
+            if ph.type != PT_LOAD or ph.filesz == 0:
+                continue
+            if ph.offset + ph.filesz > len(self.buf):
+                raise ElfError('%s: segment at 0x%x extends past end of file' % (self.path, ph.paddr))
+            out.append(ph)
+        return out
+
+    def symbols(self):
+        '-> [ Symbol, ...] of functions and data objects from .symtab'
+        out = []
+        fmt = struct.Struct(self.endian + 'IIIBBH')
+        sections = self.sections()
+        for sh in sections:
+            if sh.type != SHT_SYMTAB or sh.entsize == 0 or sh.link >= len(sections):
+                continue
+            strtab_off = sections[sh.link].offset
+            for off in range(sh.offset, sh.offset + sh.size - sh.entsize + 1, sh.entsize):
+                (st_name, st_value, st_size, st_info, st_other, st_shndx) = fmt.unpack_from(self.buf, off)
+                t = st_info & 0xf
+                if t not in (STT_FUNC, STT_OBJECT) or st_shndx == 0:
+                    continue
+                if t == STT_FUNC and self.e_machine == EM_ARM:
+                    # Thumb bit
+                    st_value &= ~1
+                out.append(Symbol(self.cstring(strtab_off + st_name), st_value, st_size, t))
+        return out
+
+    def symbol(self, name):
+        '-> Symbol called "name" or None'
+        for sym in self.symbols():
+            if sym.name == name:
+                return sym
+        return None
+
+class SymbolIndex(object):
+    '''
+    Address -> symbol lookups, a bisect over the sorted symbol start addresses
+
+    >>> i = SymbolIndex([Symbol('main', 0x08000100, 0x40, STT_FUNC), Symbol('Reset_Handler', 0x08000000, 0x20, STT_FUNC)])
+    >>> i.lookup(0x08000120).name
+    'main'
+    >>> i.lookup(0x08000030) is None
+    True
+    '''
+    def __init__(self, symbols):
+        # the largest of the symbols at an address comes last and wins,
+        # zero sized symbols (assembly labels) cover up to the next symbol
+        self.symbols = sorted(symbols, key=lambda s: (s.value, s.size))
+        self.starts = [ s.value for s in self.symbols ]
+
+    def lookup(self, addr):
+        '-> Symbol containing "addr" or None'
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        s = self.symbols[i]
+        if s.size == 0 or addr < s.value + s.size:
+            return s
+        return None
+
+    def functions(self):
+        return SymbolIndex([ s for s in self.symbols if s.type == STT_FUNC ])
@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+# Hardware-in-the-loop test farm
+#
+# Every attached debug adapter is a worker slot. A worker sets its board up once (OpenOCD daemon,
+# DAP and MCU detection) and keeps the connection between jobs, so a job only pays for
+# programming, reset and the test run itself.
+# Jobs wait in one queue and are routed to workers whose capability tags (taken from the detected MCU)
+# include everything the job requires, e.g. the STM32 family.
+#
+# Setup, programming and output capture live with the command line tools, they are passed in:
+#   setup(adapter) -> (adapter, dap_info, mcu_info, openocd_rpc)
+#   program(openocd_rpc, mcu_info, image)
+#   output_source(adapter) -> object with clear() and read() -> bytes received since the last read()
+
+import time
+import logging
+import threading
+import collections
+
+import easierocd.usb
+from easierocd.openocd import TargetCommunicationError
+
+# Errors worth retrying the job for, the worker is set up again before the retry
+TRANSIENT_ERRORS = (TargetCommunicationError, ConnectionError)
+
+# How often output is checked for the pass/fail markers
+OUTPUT_POLL_INTERVAL = 0.05
+
+def mcu_tags(mcu_info):
+    '''
+    -> set of capability tags for the MCU
+
+    >>> sorted(mcu_tags({'silicon_vendor': 'st', 'stm32_family': 'stm32f4', 'dev': 'STM32F40x/STM32F41x'}))
+    ['st', 'stm32f4', 'stm32f40x/stm32f41x']
+    '''
+    tags = set()
+    for k in ('silicon_vendor', 'family', 'stm32_family', 'dev'):
+        v = mcu_info.get(k)
+        if v:
+            tags.add(v.lower())
+    return tags
+
+class JobTimeout(Exception):
+    pass
+
+class Job(object):
+    '''
+    Program "image", reset and collect output until "pass_marker" or "fail_marker" shows up
+
+    requires: capability tags a worker must have, e.g. ['stm32f4']
+    retries: how many more attempts after a transient target communication error
+    '''
+    # result
+    (PENDING, PASS, FAIL, ERROR, TIMEOUT) = ('pending', 'pass', 'fail', 'error', 'timeout')
+
+    def __init__(self, image, name=None, requires=(), timeout=60.0, retries=2,
+                 pass_marker=b'PASS', fail_marker=b'FAIL', semihosting=True):
+        self.image = image
+        self.name = name
+        self.requires = set(x.lower() for x in requires)
+        (self.timeout, self.retries) = (timeout, retries)
+        (self.pass_marker, self.fail_marker) = (pass_marker, fail_marker)
+        self.semihosting = semihosting
+
+        self.result = self.PENDING
+        self.attempts = 0
+        self.output = b''
+        self.error = None
+        self.worker = None
+        self.seconds = 0.0
+
+    def done(self):
+        return self.result != self.PENDING
+
+    def __repr__(self):
+        return 'Job(%r, result=%r)' % (self.name, self.result)
+
+class Worker(object):
+    'One debug adapter and the board attached to it'
+    def __init__(self, scheduler, adapter):
+        self.scheduler = scheduler
+        self.adapter = adapter
+        self.name = '%s %03d:%03d' % (adapter[0]['name'], adapter[1].bus, adapter[1].address)
+        self.openocd_rpc = None
+        self.mcu_info = None
+        self.tags = set()
+        self.output = None
+        (self.ready, self.broken) = (False, False)
+
+    def setup(self):
+        s = self.scheduler
+        (self.adapter, dap_info, self.mcu_info, self.openocd_rpc) = s.setup(self.adapter)
+        self.tags = mcu_tags(self.mcu_info)
+        if self.output is None:
+            self.output = s.output_source(self.adapter)
+
+    def can_run(self, job):
+        return job.requires <= self.tags
+
+    def run_job(self, job):
+        '-> job result, TRANSIENT_ERRORS propagate'
+        (o, s) = (self.openocd_rpc, self.scheduler)
+        deadline = time.time() + job.timeout
+
+        o.reset_halt()
+        o.set_arm_semihosting(job.semihosting)
+        s.program(o, self.mcu_info, job.image)
+        if time.time() > deadline:
+            raise JobTimeout
+        self.output.clear()
+        o.reset()
+
+        out = bytearray()
+        while True:
+            out += self.output.read()
+            if job.fail_marker and job.fail_marker in out:
+                job.output = bytes(out)
+                return Job.FAIL
+            if job.pass_marker and job.pass_marker in out:
+                job.output = bytes(out)
+                return Job.PASS
+            if time.time() > deadline:
+                job.output = bytes(out)
+                raise JobTimeout
+            time.sleep(OUTPUT_POLL_INTERVAL)
+
+    def loop(self):
+        s = self.scheduler
+        try:
+            self.setup()
+        except Exception as e:
+            logging.warning('farm: %s: setup failed: %s' % (self.name, e))
+            self.broken = True
+            s.worker_gone(self)
+            return
+        logging.info('farm: %s: ready, tags: %s' % (self.name, ' '.join(sorted(self.tags))))
+        s.worker_ready(self)
+
+        while True:
+            job = s.next_job(self)
+            if job is None:
+                return
+            job.worker = self.name
+            job.attempts += 1
+            t = time.time()
+            try:
+                job.result = self.run_job(job)
+            except JobTimeout:
+                job.result = Job.TIMEOUT
+            except TRANSIENT_ERRORS as e:
+                job.error = e
+                logging.info('farm: %s: %r: transient error, attempt %d: %s' % (self.name, job.name, job.attempts, e))
+                if job.attempts <= job.retries:
+                    try:
+                        self.setup()
+                    except Exception as e:
+                        logging.warning('farm: %s: setup failed: %s' % (self.name, e))
+                        self.broken = True
+                    s.requeue(job)
+                    if self.broken:
+                        s.worker_gone(self)
+                        return
+                    continue
+                job.result = Job.ERROR
+            except Exception as e:
+                # anything else is a problem with the job or the board, not the farm
+                job.error = e
+                job.result = Job.ERROR
+            job.seconds = time.time() - t
+            s.job_done(job)
+
+class Scheduler(object):
+    '''
+    s = Scheduler(setup, program, output_source)
+    s.submit(Job(image, requires=['stm32f4']))
+    s.run()  # -> [ job, ...] once every job is done
+    '''
+    def __init__(self, setup, program, output_source, adapters=None):
+        (self.setup, self.program, self.output_source) = (setup, program, output_source)
+        if adapters is None:
+            adapters = easierocd.usb.connected_debug_adapters()
+        self.workers = [ Worker(self, a) for a in adapters ]
+        self.jobs = []
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        # workers still being set up, their tags are unknown so far
+        self.pending_workers = len(self.workers)
+
+    def submit(self, job):
+        with self.cond:
+            if job.name is None:
+                job.name = 'job%d' % (len(self.jobs),)
+            self.jobs.append(job)
+            self.queue.append(job)
+            self.cond.notify_all()
+
+    def requeue(self, job):
+        with self.cond:
+            # retries go to the front, they were first in line already
+            self.queue.appendleft(job)
+            self.cond.notify_all()
+
+    def job_done(self, job):
+        logging.info('farm: %s: %r: %s' % (job.worker, job.name, job.result))
+        with self.cond:
+            self.cond.notify_all()
+
+    def worker_ready(self, worker):
+        with self.cond:
+            worker.ready = True
+            self.pending_workers -= 1
+            self._fail_unroutable()
+            self.cond.notify_all()
+
+    def worker_gone(self, worker):
+        with self.cond:
+            if not worker.ready:
+                self.pending_workers -= 1
+            (worker.ready, worker.broken) = (False, True)
+            self._fail_unroutable()
+            self.cond.notify_all()
+
+    def _fail_unroutable(self):
+        # called with self.cond held: once every worker is known, jobs no worker can run are failed
+        if self.pending_workers > 0:
+            return
+        capable = [ w for w in self.workers if not w.broken ]
+        keep = collections.deque()
+        for job in self.queue:
+            if any(w.can_run(job) for w in capable):
+                keep.append(job)
+            else:
+                job.result = Job.ERROR
+                job.error = 'no adapter with tags: %s' % (' '.join(sorted(job.requires)),)
+        self.queue = keep
+
+    def next_job(self, worker):
+        '-> first queued job "worker" can run, None when all jobs are done'
+        with self.cond:
+            while True:
+                for job in self.queue:
+                    if worker.can_run(job):
+                        self.queue.remove(job)
+                        return job
+                # jobs being run elsewhere may still come back for a retry
+                if self.pending_workers == 0 and not any(worker.can_run(j) for j in self.jobs if not j.done()):
+                    return None
+                self.cond.wait()
+
+    def run(self):
+        '-> [ job, ...] in submission order'
+        threads = []
+        for w in self.workers:
+            t = threading.Thread(target=w.loop, name='farm ' + w.name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        with self.cond:
+            if not self.workers:
+                self.pending_workers = 0
+                self._fail_unroutable()
+        for t in threads:
+            t.join()
+        return list(self.jobs)
@@ -0,0 +1,236 @@
+from __future__ import absolute_import
+
+# MCU identification
+#
+# Everything that can tell parts apart is read in one batched, fault tolerant read
+# (OpenOcdRpc.read_words()): the Cortex-M CPUID, the ROM table's peripheral ID and first entries,
+# the ID register of every family in the device database (see "id_reg" in easierocd/devices.json),
+# the STM32 flash size registers and the nRF51 FICR code memory geometry.
+# Registers that don't exist on the connected part simply fault and read as None.
+#
+# resolve() then walks DECISION_TABLE, the first vendor whose ID register holds an ID known to the
+# device database wins. See documentation/cortex-M-autodetection
+
+import easierocd.devicedb as devicedb
+import easierocd.stm32 as stm32
+import easierocd.stellaris as stellaris
+
+# System Control Block, ARMv7-M B3.2.3
+CPUID_ADDR = 0xe000ed00
+
+CORTEX_M_PARTNOS = {
+    0xc20: 'cortex-m0',
+    0xc60: 'cortex-m0p',
+    0xc21: 'cortex-m1',
+    0xc23: 'cortex-m3',
+    0xc24: 'cortex-m4',
+    0xc27: 'cortex-m7',
+}
+
+# Cortex-M ROM table: entries (SCS, DWT, FPB, ITM, TPIU, ETM) and the peripheral ID registers
+ROM_TABLE_BASE = 0xe00ff000
+ROM_TABLE_ENTRIES = 6
+ROM_TABLE_PIDR4 = ROM_TABLE_BASE + 0xfd0
+ROM_TABLE_PIDR0 = ROM_TABLE_BASE + 0xfe0
+
+# JEP106 designer codes, (continuation count << 7) | identity code
+JEP106_VENDORS = {
+    0x23b: 'arm',
+    0x020: 'st',
+    0x017: 'ti',
+    0x015: 'nxp',
+    0x144: 'nordic',
+}
+
+# nRF51 Factory Information Configuration Registers
+NRF51_FICR_CODEPAGESIZE = 0x10000010
+NRF51_FICR_CODESIZE = 0x10000014
+
+class IdentifyError(Exception):
+    pass
+
+def cpuid_decode(v):
+    '''
+    >>> sorted(cpuid_decode(0x410fc241).items())
+    [('cpu', 'cortex-m4'), ('implementer', 65), ('partno', 3108), ('revision', 1), ('variant', 0)]
+    '''
+    implementer = (v >> 24) & 0xff
+    variant = (v >> 20) & 0xf
+    partno = (v >> 4) & 0xfff
+    revision = (v >> 0) & 0xf
+    return dict(implementer=implementer, variant=variant, partno=partno, revision=revision,
+                cpu=CORTEX_M_PARTNOS.get(partno) if implementer == 0x41 else None)
+
+def pidr_designer(pidr4, pidr1, pidr2):
+    '''
+    -> JEP106 designer code from CoreSight peripheral ID registers, None for legacy IDs
+
+    >>> hex(pidr_designer(0x04, 0xb4, 0x0b))
+    '0x23b'
+    >>> hex(pidr_designer(0x00, 0x00, 0x0a))
+    '0x20'
+    '''
+    if not pidr2 & 0x8:
+        return None
+    return ((pidr4 & 0xf) << 7) | ((pidr2 & 0x7) << 4) | ((pidr1 >> 4) & 0xf)
+
+def _family_id_regs(vendor):
+    return sorted(set(f['id_reg'] for f in devicedb.db().families.values()
+                      if f.get('vendor') == vendor and 'id_reg' in f))
+
+def identification_addrs():
+    '-> [ address, ...] to read for resolve()'
+    addrs = [CPUID_ADDR, ROM_TABLE_PIDR4, ROM_TABLE_PIDR0, ROM_TABLE_PIDR0 + 4, ROM_TABLE_PIDR0 + 8]
+    addrs.extend(ROM_TABLE_BASE + 4 * i for i in range(ROM_TABLE_ENTRIES))
+    for f in devicedb.db().families.values():
+        if 'id_reg' in f:
+            addrs.append(f['id_reg'])
+        if f.get('vendor') == 'ti' and 'id_reg' in f:
+            # DID1 follows DID0
+            addrs.append(f['id_reg'] + 4)
+        if 'flash_size_reg' in f:
+            # F_SIZE is a halfword, read the word around it
+            addrs.append(f['flash_size_reg'] & ~3)
+    for d in devicedb.db().vendor_devices('st'):
+        if 'flash_size_reg' in d:
+            addrs.append(d['flash_size_reg'] & ~3)
+    addrs.extend([NRF51_FICR_CODEPAGESIZE, NRF51_FICR_CODESIZE])
+    # keep the order stable, duplicates are read once
+    return sorted(set(addrs))
+
+def _halfword(words, addr):
+    w = words.get(addr & ~3)
+    if w is None:
+        return None
+    return (w >> (8 * (addr & 2))) & 0xffff
+
+def resolve_st(words, cpu):
+    # F0 and L0 (Cortex-M0/M0+) have DBGMCU on APB, the others on the PPB. Try the likely one first,
+    # the device's "id_reg" has to match either way.
+    m0 = cpu in ('cortex-m0', 'cortex-m0p')
+    regs = sorted(_family_id_regs('st'), key=lambda a: (a == stm32.DBGMCU_IDCODE_ADDR_STM32L0F0) != m0)
+    for a in regs:
+        v = words.get(a)
+        if v in (None, 0, 0xffffffff):
+            continue
+        m = stm32.dbgmcu_idcode_decode(v)
+        d = stm32.device(m['dev_id'])
+        if d is None or d.get('id_reg') != a:
+            continue
+        m['idcode'] = v
+        m['family'] = m['stm32_family'] = d['family']
+        m['sram_size'] = d.get('sram_size')
+        m['flash_size'] = None
+        try:
+            reg = stm32.flash_size_reg_addr(d['family'], m['dev_id'])
+        except ValueError:
+            return m
+        f_size = _halfword(words, reg)
+        if f_size is not None and (f_size not in (0, 0xffff) or m['dev_id'] == 0x436):
+            m['flash_size'] = stm32.flash_size_decode(m['dev_id'], f_size)
+        return m
+    return None
+
+def resolve_ti(words, cpu):
+    for a in _family_id_regs('ti'):
+        (did0, did1) = (words.get(a), words.get(a + 4))
+        if did0 is None or did1 is None or stellaris.did0_decode(did0)['ver'] != 1:
+            continue
+        d = stellaris.device(did0, did1)
+        if d is None or d.get('id_reg') != a:
+            continue
+        rev = stellaris.did0_decode(did0)
+        return dict(dev_id=stellaris.device_id(did0, did1), dev=d['name'], did0=did0, did1=did1,
+                    rev='%c%d' % (ord('A') + rev['major'], rev['minor']),
+                    family=d['family'], flash_size=d.get('flash_size'), sram_size=d.get('sram_size'))
+    return None
+
+def resolve_nxp(words, cpu):
+    for a in _family_id_regs('nxp'):
+        v = words.get(a)
+        d = devicedb.device('nxp', v) if v is not None else None
+        if d is None or d.get('id_reg') != a:
+            continue
+        return dict(dev_id=v, dev=d['name'], family=d['family'],
+                    flash_size=d.get('flash_size'), sram_size=d.get('sram_size'))
+    return None
+
+def resolve_nordic(words, cpu):
+    for a in _family_id_regs('nordic'):
+        v = words.get(a)
+        if v is None:
+            continue
+        # CONFIGID: HWID in the low halfword
+        hwid = v & 0xffff
+        d = devicedb.device('nordic', hwid)
+        if d is None or d.get('id_reg') != a:
+            continue
+        flash_size = d.get('flash_size')
+        (page_size, pages) = (words.get(NRF51_FICR_CODEPAGESIZE), words.get(NRF51_FICR_CODESIZE))
+        if page_size and pages and page_size * pages <= 0x100000:
+            flash_size = page_size * pages
+        return dict(dev_id=hwid, dev=d['name'], family=d['family'],
+                    flash_size=flash_size, sram_size=d.get('sram_size'))
+    return None
+
+# in order, ST's DBGMCU is the least ambiguous ID register
+DECISION_TABLE = [
+    ('st', resolve_st),
+    ('ti', resolve_ti),
+    ('nxp', resolve_nxp),
+    ('nordic', resolve_nordic),
+]
+
+def resolve(words):
+    '''
+    {address: word or None, ...} read from identification_addrs() -> mcu_info
+
+    >>> words = dict.fromkeys(identification_addrs())
+    >>> words.update({CPUID_ADDR: 0x410fc241, stm32.DBGMCU_IDCODE_ADDR: 0x10076413, 0x1fff7a20: 0x04000000})
+    >>> m = resolve(words)
+    >>> (m['silicon_vendor'], m['family'], m['cpu'], m['flash_size'], m['rev'])
+    ('st', 'stm32f4', 'cortex-m4', 1048576, 'Rev 1')
+    >>> words = dict.fromkeys(identification_addrs())
+    >>> words.update({CPUID_ADDR: 0x410cc200, 0x1000005c: 0xffff001d, NRF51_FICR_CODEPAGESIZE: 1024, NRF51_FICR_CODESIZE: 128})
+    >>> m = resolve(words)
+    >>> (m['silicon_vendor'], m['dev'], m['flash_size'])
+    ('nordic', 'nRF51822 QFAA CA/C0', 131072)
+    >>> resolve(dict.fromkeys(identification_addrs(), 0x12345678))
+    Traceback (most recent call last):
+    ...
+    easierocd.identify.IdentifyError: unknown MCU: CPUID 0x12345678, ROM table designer 0x407, ID registers 0x1000005c=0x12345678 0x40015800=0x12345678 0x400483f4=0x12345678 0x400fe000=0x12345678 0xe0042000=0x12345678
+    '''
+    cpuid = words.get(CPUID_ADDR)
+    cpu = cpuid_decode(cpuid)['cpu'] if cpuid is not None else None
+    (pidr4, pidr1, pidr2) = (words.get(ROM_TABLE_PIDR4), words.get(ROM_TABLE_PIDR0 + 4), words.get(ROM_TABLE_PIDR0 + 8))
+    designer = None
+    if None not in (pidr4, pidr1, pidr2):
+        designer = pidr_designer(pidr4, pidr1, pidr2)
+    rom_vendor = JEP106_VENDORS.get(designer)
+
+    for (vendor, resolver) in DECISION_TABLE:
+        if rom_vendor not in (None, 'arm', vendor):
+            # the ROM table names another silicon vendor
+            continue
+        m = resolver(words, cpu)
+        if m is not None:
+            m['silicon_vendor'] = vendor
+            f = devicedb.family(m['family'])
+            if 'sram_base' in f:
+                m['sram_base'] = f['sram_base']
+            m['cpu'] = cpu
+            m['cpuid'] = cpuid
+            m['rom_table_designer'] = designer
+            m['rom_table_entries'] = [ words.get(ROM_TABLE_BASE + 4 * i) for i in range(ROM_TABLE_ENTRIES) ]
+            return m
+
+    id_regs = sorted(set(a for v in ('st', 'ti', 'nxp', 'nordic') for a in _family_id_regs(v)))
+    raise IdentifyError('unknown MCU: CPUID %s, ROM table designer %s, ID registers %s' % (
+        'unreadable' if cpuid is None else '0x%x' % (cpuid,),
+        rom_vendor or ('unknown' if designer is None else '0x%x' % (designer,)),
+        ' '.join('0x%x=%s' % (a, 'x' if words.get(a) is None else '0x%x' % (words[a],)) for a in id_regs)))
+
+def identify(openocd_rpc):
+    '-> mcu_info, IdentifyError for parts missing from the device database. One round trip.'
+    addrs = identification_addrs()
+    return resolve(dict(zip(addrs, openocd_rpc.read_words(addrs))))
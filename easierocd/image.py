@@ -0,0 +1,331 @@
+from __future__ import absolute_import
+
+# In memory model of firmware images: a sparse map of address -> bytes
+#
+# ELF and raw binary inputs are mmap'ed and kept as memoryviews into the mapping.
+# Intel HEX is parsed on first use.
+# Overlapping data is resolved by "last added wins" and adjacent pieces taken from
+# the same underlying buffer are merged without copying.
+
+import os
+import mmap
+import bisect
+import binascii
+
+from easierocd.elf import (ElfFile, is_elf)
+
+class ImageError(Exception):
+    pass
+
+class _Chunk(object):
+    'Contiguous run of image bytes: base[offset:offset+size] placed at start'
+    __slots__ = ('start', 'base', 'offset', 'size')
+
+    def __init__(self, start, base, offset, size):
+        (self.start, self.base, self.offset, self.size) = (start, base, offset, size)
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def view(self, start=None, end=None):
+        'memoryview of [start, end) in target addresses'
+        if start is None:
+            start = self.start
+        if end is None:
+            end = self.end
+        o = self.offset + (start - self.start)
+        return self.base[o:o + (end - start)]
+
+    def __repr__(self):
+        return '_Chunk(0x%x, size=0x%x)' % (self.start, self.size)
+
+def _as_byte_view(data):
+    mv = memoryview(data)
+    if mv.format != 'B' or mv.ndim != 1:
+        mv = mv.cast('B')
+    return mv
+
+class SparseImage(object):
+    '''
+    >>> im = SparseImage()
+    >>> im.add(0x100, b'abcd')
+    >>> im.add(0x104, b'efgh')
+    >>> im.add(0x102, b'XY')
+    >>> im.segments()
+    [(256, 264)]
+    >>> bytes(im.read(0x100, 8))
+    b'abXYefgh'
+    >>> [ (hex(a), bytes(v)) for (a, v) in im.aligned_blocks(4) ]
+    [('0x100', b'abXY'), ('0x104', b'efgh')]
+    >>> [ (hex(a), bytes(v)) for (a, v) in im.aligned_blocks(16) ]
+    [('0x100', b'abXYefgh\\xff\\xff\\xff\\xff\\xff\\xff\\xff\\xff')]
+    '''
+    def __init__(self):
+        self._starts = []
+        self._chunks = []
+        # sources whose parsing is deferred until the image is first looked at
+        self._pending = []
+        self.entry = None
+
+    # building
+
+    def add(self, addr, data):
+        'Place "data" at "addr", replacing anything already there'
+        self._materialize()
+        self._add_view(addr, _as_byte_view(data))
+
+    def _add_view(self, addr, mv, base=None, offset=0):
+        if base is None:
+            base = mv
+        size = len(mv)
+        if size == 0:
+            return
+        end = addr + size
+        (starts, chunks) = (self._starts, self._chunks)
+
+        # first chunk that may overlap or touch [addr, end)
+        i = bisect.bisect_right(starts, addr) - 1
+        if i < 0 or chunks[i].end < addr:
+            i += 1
+        j = i
+        replacement = []
+        while j < len(chunks) and chunks[j].start <= end:
+            c = chunks[j]
+            if c.start < addr:
+                replacement.append(_Chunk(c.start, c.base, c.offset, min(c.end, addr) - c.start))
+            if c.end > end:
+                o = c.offset + (end - c.start)
+                replacement.append(_Chunk(end, c.base, o, c.end - end))
+            j += 1
+
+        new = _Chunk(addr, base, offset, size)
+        pieces = [ x for x in replacement if x.end <= addr ] + [new] + [ x for x in replacement if x.start >= end ]
+        merged = []
+        for c in pieces:
+            if merged and self._mergeable(merged[-1], c):
+                p = merged[-1]
+                merged[-1] = _Chunk(p.start, p.base, p.offset, p.size + c.size)
+            else:
+                merged.append(c)
+        chunks[i:j] = merged
+        starts[i:j] = [ c.start for c in merged ]
+
+    @staticmethod
+    def _mergeable(a, b):
+        # zero copy merge is only possible for views of the same buffer that are also adjacent in it
+        return (a.end == b.start and a.base is b.base and a.offset + a.size == b.offset)
+
+    def add_file(self, path, fmt=None, base_addr=None):
+        '''
+        fmt: 'elf', 'ihex', 'bin' or None to guess from file contents and extension
+        base_addr: load address for raw binaries
+        '''
+        if fmt is None:
+            fmt = guess_image_format(path)
+        if fmt == 'elf':
+            self._add_elf(path)
+        elif fmt == 'ihex':
+            self._materialize()
+            self._pending.append(path)
+        elif fmt == 'bin':
+            if base_addr is None:
+                raise ImageError('%s: raw binary images need a load address' % (path,))
+            self._add_bin(path, base_addr)
+        else:
+            raise ImageError('unknown image format %r' % (fmt,))
+
+    def _add_elf(self, path):
+        self._materialize()
+        e = ElfFile(path)
+        for ph in e.load_segments():
+            self._add_view(ph.paddr, e.buf[ph.offset:ph.offset + ph.filesz], base=e.buf, offset=ph.offset)
+        if self.entry is None:
+            self.entry = e.e_entry
+
+    def _add_bin(self, path, base_addr):
+        self._materialize()
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(m)
+        self._add_view(base_addr, mv)
+
+    def _materialize(self):
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        for path in pending:
+            with open(path, 'rb') as f:
+                for (addr, data) in ihex_runs(f, path):
+                    self._add_view(addr, memoryview(data))
+
+    # querying
+
+    def chunks(self):
+        self._materialize()
+        return self._chunks
+
+    def __iter__(self):
+        '-> (address, memoryview) for each contiguous piece of the image'
+        for c in self.chunks():
+            yield (c.start, c.view())
+
+    def segments(self):
+        '-> [ (start, end), ...] address ranges with data, adjacent pieces merged'
+        out = []
+        for c in self.chunks():
+            if out and out[-1][1] == c.start:
+                out[-1] = (out[-1][0], c.end)
+            else:
+                out.append((c.start, c.end))
+        return out
+
+    def __len__(self):
+        return sum(c.size for c in self.chunks())
+
+    def __bool__(self):
+        return bool(self.chunks())
+
+    __nonzero__ = __bool__
+
+    def min_addr(self):
+        return self.chunks()[0].start
+
+    def max_addr(self):
+        'one past the last address with data'
+        return self.chunks()[-1].end
+
+    def _first_chunk_index(self, addr):
+        chunks = self.chunks()
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0 or chunks[i].end <= addr:
+            i += 1
+        return i
+
+    def overlaps(self, start, end):
+        'whether the image has any data in [start, end)'
+        i = self._first_chunk_index(start)
+        return i < len(self._chunks) and self._chunks[i].start < end
+
+    def read(self, addr, size, fill=0xff):
+        '-> memoryview, zero copy when [addr, addr+size) lies within one piece'
+        chunks = self.chunks()
+        end = addr + size
+        i = self._first_chunk_index(addr)
+        if i < len(chunks):
+            c = chunks[i]
+            if c.start <= addr and end <= c.end:
+                return c.view(addr, end)
+        out = bytearray([fill]) * size
+        while i < len(chunks) and chunks[i].start < end:
+            c = chunks[i]
+            (s, e) = (max(c.start, addr), min(c.end, end))
+            out[s - addr:e - addr] = c.view(s, e)
+            i += 1
+        return memoryview(out)
+
+    def blocks(self, layout, fill=0xff):
+        '''
+        layout: iterable of (address, size) in ascending address order, e.g. flash sectors
+        -> (address, memoryview) for each block that contains image data, padded with "fill"
+        '''
+        for (addr, size) in layout:
+            if self.overlaps(addr, addr + size):
+                yield (addr, self.read(addr, size, fill))
+
+    def aligned_blocks(self, block_size, fill=0xff):
+        '-> (address, memoryview) for each "block_size" aligned block that contains image data'
+        return self.blocks(aligned_layout(self.segments(), block_size), fill)
+
+def aligned_layout(ranges, block_size):
+    '''
+    ranges: [ (start, end), ...] in ascending order
+    -> (address, block_size) for every aligned block touching the ranges, each yielded once
+
+    >>> list(aligned_layout([(0x10, 0x12), (0x1e, 0x22)], 0x10))
+    [(16, 16), (32, 16)]
+    '''
+    last = None
+    for (start, end) in ranges:
+        a = start - (start % block_size)
+        if last is not None and a <= last:
+            a = last + block_size
+        while a < end:
+            yield (a, block_size)
+            last = a
+            a += block_size
+
+def guess_image_format(path):
+    '''
+    -> 'elf', 'ihex' or 'bin'
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if is_elf(head):
+        return 'elf'
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.hex', '.ihex', '.ihx') or head[:1] == b':':
+        return 'ihex'
+    return 'bin'
+
+def ihex_runs(lines, name='<ihex>'):
+    r'''
+    Parse Intel HEX records, coalescing consecutive data records into one bytearray
+    -> (address, bytearray) for each contiguous run
+
+    >>> list(ihex_runs([b':0400000001020304F2\n', b':0400040005060708DE\n', b':00000001FF\n']))
+    [(0, bytearray(b'\x01\x02\x03\x04\x05\x06\x07\x08'))]
+    >>> list(ihex_runs([b':020000040800F2\n', b':02000000AABB99\n']))
+    [(134217728, bytearray(b'\xaa\xbb'))]
+    >>> list(ihex_runs([b':02000000AABB98\n']))
+    Traceback (most recent call last):
+    ...
+    easierocd.image.ImageError: <ihex>:1: checksum mismatch
+    '''
+    (upper, run_addr, run) = (0, None, None)
+    for (lineno, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1] != b':':
+            raise ImageError('%s:%d: record does not start with ":"' % (name, lineno))
+        try:
+            rec = binascii.unhexlify(line[1:])
+        except (binascii.Error, TypeError):
+            raise ImageError('%s:%d: invalid hex digits' % (name, lineno))
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise ImageError('%s:%d: bad record length' % (name, lineno))
+        if sum(rec) & 0xff:
+            raise ImageError('%s:%d: checksum mismatch' % (name, lineno))
+        (count, offset, rtype) = (rec[0], (rec[1] << 8) | rec[2], rec[3])
+        data = rec[4:4 + count]
+        if rtype == 0x00:
+            addr = upper + offset
+            if run is not None and run_addr + len(run) == addr:
+                run += data
+            else:
+                if run is not None:
+                    yield (run_addr, run)
+                (run_addr, run) = (addr, bytearray(data))
+        elif rtype == 0x01:
+            break
+        elif rtype == 0x02:
+            upper = ((data[0] << 8) | data[1]) << 4
+        elif rtype == 0x04:
+            upper = ((data[0] << 8) | data[1]) << 16
+        elif rtype in (0x03, 0x05):
+            # start address records, not part of the memory image
+            pass
+        else:
+            raise ImageError('%s:%d: unknown record type 0x%02x' % (name, lineno, rtype))
+    if run is not None:
+        yield (run_addr, run)
+
+def load_image(path, fmt=None, base_addr=None):
+    '-> SparseImage'
+    im = SparseImage()
+    im.add_file(path, fmt, base_addr)
+    return im
@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+# Host side cache of target memory
+#
+# MemoryCache sits in front of an OpenOcdRpc and otherwise behaves like it. The cache policy
+# follows the kind of easierocd.memorymap region:
+#   CACHE_FLASH: flash, ROM, ROM tables. Kept until erased or programmed through the cache.
+#   CACHE_RAM:   kept only while the target stays halted, needs target notifications (broker connections)
+#   CACHE_NONE:  peripherals and unmapped addresses, always read from the target
+# Cached memory is held in PAGE_SIZE pages, the least recently used ones are evicted beyond "max_bytes".
+#
+# Target notifications (see OpenOcdRpc.notifications()) tell about other clients too: RAM is dropped
+# when anyone resumes, steps or resets the target, flash when gdb erases or writes it ('load').
+# Other changes made behind the cache's back (gdb writing RAM while the target stays halted,
+# TCL 'flash' commands of other clients, firmware writing its own flash) aren't seen,
+# invalidate() drops what is cached.
+
+import struct
+import collections
+
+from easierocd.openocd import OpenOcdError
+import easierocd.memorymap as memorymap
+
+(CACHE_FLASH, CACHE_RAM, CACHE_NONE) = ('flash', 'ram', 'none')
+
+PAGE_SIZE = 1024
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+CACHE_POLICY = {
+    memorymap.FLASH: CACHE_FLASH,
+    memorymap.ROM: CACHE_FLASH,
+    memorymap.RAM: CACHE_RAM,
+}
+
+class MemoryCache(object):
+    '''
+    o = MemoryCache(openocd_rpc)
+    o.read_mem(0x08000000, 256)   # from the target
+    o.read_mem(0x08000000, 256)   # from host memory
+
+    memory_map: easierocd.memorymap.MemoryMap, by default the OpenOcdRpc's or the architectural one
+    '''
+    def __init__(self, openocd_rpc, memory_map=None, max_bytes=DEFAULT_MAX_BYTES, page_size=PAGE_SIZE):
+        self.o = openocd_rpc
+        if memory_map is None:
+            memory_map = getattr(openocd_rpc, 'memory_map', None) or memorymap.cortex_m_memory_map()
+        self.memory_map = memory_map
+        self.max_pages = max(1, max_bytes // page_size)
+        self.page_size = page_size
+        # page address -> (bytes, policy), least recently used first
+        self.pages = collections.OrderedDict()
+        # None: not known yet, asked for on the first RAM read
+        self.halted = None
+        self.notification_seq = None
+        # set from the notification thread when gdb changed flash
+        self.flash_changed = False
+        self.subscribed = False
+        (self.hits, self.misses) = (0, 0)
+
+    def __getattr__(self, name):
+        # everything without caching concerns goes straight to the OpenOcdRpc
+        return getattr(self.o, name)
+
+    def policy(self, addr):
+        '''
+        -> (policy, end of the region "addr" is in)
+
+        >>> c = MemoryCache(None)
+        >>> c.policy(0x08000100)
+        ('flash', 536870912)
+        >>> c.policy(0x40021000)[0]
+        'none'
+        '''
+        r = self.memory_map.find(addr)
+        if r is None:
+            return (CACHE_NONE, self.memory_map.next_start(addr))
+        return (CACHE_POLICY.get(r.kind, CACHE_NONE), r.end)
+
+    # target state
+
+    def _notifications(self):
+        '-> TargetNotifications of the OpenOcdRpc, None on OpenOCD\'s TCP port without them'
+        o = self.o
+        if getattr(o, '_notifications', None) is None and getattr(o, 'path', None) is None:
+            return None
+        n = o.notifications()
+        if not self.subscribed:
+            o.add_event_callback(self._on_event)
+            self.subscribed = True
+        return n
+
+    def _on_event(self, kind, name):
+        if kind == 'event' and name.startswith('gdb-flash-'):
+            self.flash_changed = True
+
+    def _check_flash(self):
+        self._notifications()
+        if self.flash_changed:
+            self.flash_changed = False
+            self.drop(CACHE_FLASH)
+
+    def _ram_cacheable(self):
+        n = self._notifications()
+        if n is None:
+            # nobody would tell when other clients resume the target
+            return False
+        if n.seq != self.notification_seq:
+            # the target changed state since we last looked
+            self.notification_seq = n.seq
+            self.drop(CACHE_RAM)
+            self.halted = None
+        if self.halted is None:
+            self.halted = (self.o.poll().state == 'halted')
+        return self.halted
+
+    def _state_change(self, halted):
+        self.drop(CACHE_RAM)
+        self.halted = halted
+
+    def halt(self):
+        self._state_change(None)
+        self.o.halt()
+
+    def resume(self):
+        self._state_change(False)
+        self.o.resume()
+
+    def step(self):
+        self._state_change(None)
+        self.o.step()
+        self.halted = True
+
+    def reset(self):
+        self._state_change(False)
+        self.o.reset()
+
+    def reset_halt(self):
+        self._state_change(None)
+        self.o.reset_halt()
+        self.halted = True
+
+    def reset_init(self):
+        self._state_change(None)
+        self.o.reset_init()
+        self.halted = True
+
+    # invalidation
+
+    def drop(self, policy):
+        for a in [ a for (a, (d, p)) in self.pages.items() if p == policy ]:
+            del self.pages[a]
+
+    def invalidate(self, addr=None, size=None):
+        'drop cached pages overlapping addr..addr+size, everything without arguments'
+        if addr is None:
+            self.pages.clear()
+            return
+        ps = self.page_size
+        for a in range(addr - addr % ps, addr + size, ps):
+            self.pages.pop(a, None)
+
+    def write_mem(self, addr, bytearray_in):
+        self.invalidate(addr, len(bytearray_in))
+        self.o.write_mem(addr, bytearray_in)
+
+    def write_mem_many(self, writes, ops=()):
+        for (a, d) in writes:
+            self.invalidate(a, len(d))
+        for op in ops:
+            self.invalidate(op[1], 4)
+        self.o.write_mem_many(writes, ops)
+
+    def write_words(self, addr_value_pairs):
+        for (a, v) in addr_value_pairs:
+            self.invalidate(a, 4)
+        self.o.write_words(addr_value_pairs)
+
+    def run_register_ops(self, ops):
+        for op in ops:
+            self.invalidate(op[1], 4)
+        self.o.run_register_ops(ops)
+
+    def flash_erase_sector(self, bank, first, last):
+        self.drop(CACHE_FLASH)
+        self.o.flash_erase_sector(bank, first, last)
+
+    def flash_write_bank(self, bank, bytes_in, offset):
+        self.drop(CACHE_FLASH)
+        self.o.flash_write_bank(bank, bytes_in, offset)
+
+    # reads
+
+    def _fill(self, first, last, policy):
+        'make sure pages first..last (page addresses) are cached, missing ones are read in one go'
+        ps = self.page_size
+        missing = [ a for a in range(first, last + ps, ps) if a not in self.pages ]
+        self.hits += (last - first) // ps + 1 - len(missing)
+        self.misses += len(missing)
+        if missing:
+            views = self.o.read_many([ (a, ps) for a in missing ], gap=0)
+            for (a, v) in zip(missing, views):
+                self.pages[a] = (bytes(v), policy)
+        for a in range(first, last + ps, ps):
+            self.pages.move_to_end(a)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    def read_mem_into(self, addr, bytearray_out):
+        n = len(bytearray_out)
+        (done, ps) = (0, self.page_size)
+        while done < n:
+            a = addr + done
+            (policy, end) = self.policy(a)
+            chunk = min(n - done, end - a)
+            (first, last) = (a - a % ps, (a + chunk - 1) - (a + chunk - 1) % ps)
+            if policy == CACHE_RAM and not self._ram_cacheable():
+                policy = CACHE_NONE
+            elif policy == CACHE_FLASH:
+                self._check_flash()
+            if (last - first) // ps + 1 > self.max_pages:
+                # would only evict everything else
+                policy = CACHE_NONE
+            if policy == CACHE_NONE:
+                b = bytearray(chunk)
+                self.o.read_mem_into(a, b)
+                bytearray_out[done:done + chunk] = b
+            else:
+                self._fill(first, last, policy)
+                pos = a
+                while pos < a + chunk:
+                    p = pos - pos % ps
+                    m = min(p + ps, a + chunk)
+                    bytearray_out[done + pos - a:done + m - a] = self.pages[p][0][pos - p:m - p]
+                    pos = m
+            done += chunk
+
+    def read_mem(self, addr, byte_count):
+        b = bytearray(byte_count)
+        self.read_mem_into(addr, b)
+        return b
+
+    def read_word(self, addr):
+        if self.policy(addr)[0] == CACHE_NONE:
+            return self.o.read_word(addr)
+        return struct.unpack('<I', self.read_mem(addr, 4))[0]
+
+    def read_words(self, addrs):
+        out = [None] * len(addrs)
+        direct = []
+        for (i, a) in enumerate(addrs):
+            if self.policy(a)[0] == CACHE_NONE:
+                direct.append(i)
+                continue
+            try:
+                out[i] = struct.unpack('<I', self.read_mem(a, 4))[0]
+            except OpenOcdError:
+                # faults are reported per word, as by OpenOcdRpc.read_words()
+                direct.append(i)
+        if direct:
+            for (i, v) in zip(direct, self.o.read_words([ addrs[i] for i in direct ])):
+                out[i] = v
+        return out
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, cached_bytes=len(self.pages) * self.page_size)
@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+
+# Target address space
+#
+# A MemoryMap is a sorted list of non-overlapping regions indexed by their start addresses,
+# lookups are a bisect. Given one (OpenOcdRpc.memory_map) the RPC layer refuses accesses outside of
+# every region before OpenOCD gets to fail on them, keeps coalesced reads from running into
+# unmapped space and reads peripherals word by word. easierocd.memcache takes its cache policies
+# from the region kinds.
+#
+# Maps built from device data are completed with the architectural regions (cortex_m_memory_map())
+# around what the data describes: external memory (FSMC/FMC SDRAM), bit-band aliases and RAM beyond
+# the smallest size of a dev_id stay reachable. Only addresses past the 32 bit address space are refused.
+
+import bisect
+
+import easierocd.stm32 as stm32
+import easierocd.devicedb as devicedb
+
+(FLASH, ROM, RAM, PERIPHERAL, PPB) = ('flash', 'rom', 'ram', 'peripheral', 'ppb')
+
+ADDRESS_SPACE_END = 0x100000000
+
+# private peripheral bus, the Cortex-M ROM table sits at its top
+PPB_REGION = (0xe0000000, 0xe00ff000)
+ROM_TABLE_REGION = (0xe00ff000, 0xe0100000)
+
+class MemoryMapError(ValueError):
+    pass
+
+class Region(object):
+    '''
+    >>> Region('sram', 0x20000000, 0x20020000, RAM)
+    Region('sram', 0x20000000, 0x20020000, 'ram')
+    '''
+    __slots__ = ('name', 'start', 'end', 'kind')
+
+    def __init__(self, name, start, end, kind):
+        (self.name, self.start, self.end, self.kind) = (name, start, end, kind)
+
+    def size(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return 'Region(%r, 0x%x, 0x%x, %r)' % (self.name, self.start, self.end, self.kind)
+
+class MemoryMap(object):
+    '''
+    >>> m = MemoryMap([Region('flash', 0x08000000, 0x08100000, FLASH), Region('sram', 0x20000000, 0x20030000, RAM)])
+    >>> m.find(0x20000100).name
+    'sram'
+    >>> m.find(0x30000000) is None
+    True
+    >>> [ (r.name, hex(a), n) for (r, a, n) in m.split(0x080ffffe, 4) ]
+    Traceback (most recent call last):
+    ...
+    easierocd.memorymap.MemoryMapError: 0x8100000: not in the memory map
+    '''
+    def __init__(self, regions):
+        self.regions = sorted(regions, key=lambda r: r.start)
+        for (a, b) in zip(self.regions, self.regions[1:]):
+            if a.end > b.start:
+                raise MemoryMapError('%r overlaps %r' % (a, b))
+        self.starts = [ r.start for r in self.regions ]
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __repr__(self):
+        return 'MemoryMap(%r)' % (self.regions,)
+
+    def find(self, addr):
+        '-> Region containing "addr", None if it is unmapped'
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.regions[i].end:
+            return self.regions[i]
+        return None
+
+    def next_start(self, addr):
+        '-> start of the first region above "addr", ADDRESS_SPACE_END if there is none'
+        i = bisect.bisect_right(self.starts, addr)
+        if i < len(self.regions):
+            return self.starts[i]
+        return ADDRESS_SPACE_END
+
+    def split(self, addr, size):
+        '-> [ (region, addr, size), ...] covering addr..addr+size, MemoryMapError if any of it is unmapped'
+        out = []
+        end = addr + size
+        while addr < end:
+            r = self.find(addr)
+            if r is None:
+                raise MemoryMapError('0x%x: not in the memory map' % (addr,))
+            n = min(end, r.end) - addr
+            out.append((r, addr, n))
+            addr += n
+        return out
+
+    def check(self, addr, size):
+        if size > 0:
+            self.split(addr, size)
+
+def cortex_m_memory_map():
+    '''
+    ARMv7-M architectural memory map (B3.1), for targets nothing more is known about
+
+    >>> cortex_m_memory_map().find(0xe000ed00)
+    Region('ppb', 0xe0000000, 0xe00ff000, 'ppb')
+    '''
+    return MemoryMap([
+        Region('code', 0x00000000, 0x20000000, FLASH),
+        Region('sram', 0x20000000, 0x40000000, RAM),
+        Region('peripheral', 0x40000000, 0x60000000, PERIPHERAL),
+        Region('external_ram', 0x60000000, 0xa0000000, RAM),
+        Region('external_device', 0xa0000000, 0xe0000000, PERIPHERAL),
+        Region('ppb', PPB_REGION[0], PPB_REGION[1], PPB),
+        Region('rom_table', ROM_TABLE_REGION[0], ROM_TABLE_REGION[1], ROM),
+        Region('vendor_sys', 0xe0100000, ADDRESS_SPACE_END, PERIPHERAL),
+    ])
+
+# System memory, OTP and option bytes of all STM32 families fall in here
+STM32_SYSTEM_MEMORY = (0x1ff00000, 0x20000000)
+
+def with_architectural_regions(regions):
+    '''
+    -> MemoryMap of "regions" plus the parts of cortex_m_memory_map() they leave uncovered.
+    Partly covered architectural regions are named "..._other", uncovered code space is RAM:
+    it may be writable by the firmware (e.g. data EEPROM), so it is only cached while halted.
+
+    >>> m = with_architectural_regions([Region('sram', 0x20000000, 0x20008000, RAM)])
+    >>> [ (r.name, hex(r.start), r.kind) for r in m ][:4]
+    [('code', '0x0', 'ram'), ('sram', '0x20000000', 'ram'), ('sram_other', '0x20008000', 'ram'), ('peripheral', '0x40000000', 'peripheral')]
+    '''
+    regions = sorted(regions, key=lambda r: r.start)
+    out = list(regions)
+    for a in cortex_m_memory_map():
+        kind = RAM if a.kind == FLASH else a.kind
+        pos = a.start
+        pieces = []
+        for r in regions:
+            if r.end <= pos or r.start >= a.end:
+                continue
+            if r.start > pos:
+                pieces.append((pos, r.start))
+            pos = max(pos, r.end)
+        if pos < a.end:
+            pieces.append((pos, a.end))
+        for (start, end) in pieces:
+            whole = (start, end) == (a.start, a.end)
+            out.append(Region(a.name if whole else a.name + '_other', start, end, kind))
+    return MemoryMap(out)
+
+def _stm32_memory_map(mcu_info):
+    regions = []
+    flash_size = mcu_info.get('flash_size')
+    if flash_size:
+        # boot memory is aliased at 0, flash after a normal boot
+        regions.append(Region('boot_alias', 0, flash_size, FLASH))
+        regions.append(Region('flash', stm32.FLASH_BASE, stm32.FLASH_BASE + flash_size, FLASH))
+    else:
+        regions.append(Region('code', 0, stm32.CCM_BASE, FLASH))
+    ccm = stm32.ccm_size(mcu_info.get('dev_id'))
+    if ccm:
+        regions.append(Region('ccm', stm32.CCM_BASE, stm32.CCM_BASE + ccm, RAM))
+    regions.append(Region('system_memory', STM32_SYSTEM_MEMORY[0], STM32_SYSTEM_MEMORY[1], ROM))
+    sram_size = mcu_info.get('sram_size')
+    regions.append(Region('sram', 0x20000000, 0x20000000 + (sram_size or 0x20000000), RAM))
+    # vendor specific, e.g. STM32L0/L1 data EEPROM
+    family = devicedb.family(mcu_info.get('stm32_family') or mcu_info.get('family')) or {}
+    regions.extend(Region(name, start, end, kind) for (name, start, end, kind) in family.get('regions', []))
+    return with_architectural_regions(regions)
+
+def memory_map_for_mcu(mcu_info):
+    '''
+    -> MemoryMap from detection results and the device database, architectural regions where sizes are unknown
+
+    >>> m = memory_map_for_mcu({'silicon_vendor': 'st', 'dev_id': 0x413, 'flash_size': 1024*1024, 'sram_size': 128*1024})
+    >>> [ (r.name, hex(r.start), hex(r.end)) for r in m if r.kind in (FLASH, RAM) and not r.name.endswith('_other') ]
+    [('boot_alias', '0x0', '0x100000'), ('flash', '0x8000000', '0x8100000'), ('ccm', '0x10000000', '0x10010000'), ('sram', '0x20000000', '0x20020000'), ('external_ram', '0x60000000', '0xa0000000')]
+    >>> m = memory_map_for_mcu({'silicon_vendor': 'st', 'stm32_family': 'stm32l1', 'dev_id': 0x416, 'flash_size': 128*1024, 'sram_size': 16*1024})
+    >>> (m.find(0x08080000).name, m.find(0x20004000).name, m.find(0x22000000).name)
+    ('data_eeprom', 'sram_other', 'sram_other')
+    >>> m = memory_map_for_mcu({'silicon_vendor': 'nxp', 'family': 'lpc11xx', 'flash_size': 32*1024, 'sram_size': 8*1024})
+    >>> [ (r.name, hex(r.start), hex(r.end)) for r in m if r.kind != PERIPHERAL and not r.name.endswith('_other') ][:3]
+    [('flash', '0x0', '0x8000'), ('sram', '0x10000000', '0x10002000'), ('boot_rom', '0x1fff0000', '0x1fff4000')]
+    '''
+    if mcu_info.get('silicon_vendor') == 'st':
+        return _stm32_memory_map(mcu_info)
+    family = devicedb.family(mcu_info.get('family'))
+    (flash_size, sram_size) = (mcu_info.get('flash_size'), mcu_info.get('sram_size'))
+    if family is None or not flash_size or not sram_size:
+        return cortex_m_memory_map()
+    flash_base = family.get('flash_base', 0)
+    sram_base = family.get('sram_base', 0x20000000)
+    regions = [
+        Region('flash', flash_base, flash_base + flash_size, FLASH),
+        Region('sram', sram_base, sram_base + sram_size, RAM),
+    ]
+    # vendor specific: boot ROMs, factory information and user configuration
+    regions.extend(Region(name, start, end, kind) for (name, start, end, kind) in family.get('regions', []))
+    return with_architectural_regions(regions)
@@ -8,6 +8,9 @@ import tempfile
 import sys
 import time
 import errno
+import array
+import bisect
+import threading
 
 class OpenOcdError(Exception):
     # FIXME: when the debug adapter is disconnecte
@@ -37,7 +40,9 @@ class TargetMemoryAccessError(OpenOcdError):
 
 class OpenOcdValueError(ValueError, OpenOcdError):
     def __init__(self, *args):
-        super(ValueError, self).__init__(*args)
+        # OpenOcdError.__init__() wants (cmd, response)
+        ValueError.__init__(self, *args)
+        (self.cmd, self.response) = (None, args[0] if args else None)
 
     def __str__(self):
         return '%s' % (self.args,)
@@ -50,18 +55,511 @@ class OpenOcdResetError(OpenOcdError):
 class OpenOcdCommandNotSupportedError(OpenOcdError):
     pass
 
+# Batched register access
+#
+# Register operations are turned into one TCL script and evaluated by OpenOCD in a single round trip.
+# ops: [ ('write', addr, value),          *addr = value
+#        ('set', addr, mask),             *addr |= mask
+#        ('clear', addr, mask),           *addr &= ~mask
+#        ('modify', addr, mask, value),   *addr = (*addr & ~mask) | value
+#        ('wait', addr, mask, value),     until (*addr & mask) == value
+#      ]
+
+WAIT_TRIES = 1000
+
+def register_ops_tcl(ops):
+    r'''
+    >>> print(register_ops_tcl([('write', 0x40023c00, 0x702), ('set', 0x40023800, 0x1)]))
+    mww 0x40023c00 0x702
+    mem2array _eocd 32 0x40023800 1; mww 0x40023800 [expr {$_eocd(0) | 0x1}]
+    >>> print(register_ops_tcl([('wait', 0x40023800, 0x2, 0x2)]))
+    set _eocd_n 0; while {1} {mem2array _eocd 32 0x40023800 1; if {($_eocd(0) & 0x2) == 0x2} break; if {[incr _eocd_n] > 1000} {error "timeout waiting for (0x40023800 & 0x2) == 0x2"}}
+    '''
+    out = []
+    for op in ops:
+        kind = op[0]
+        if kind == 'write':
+            (addr, value) = op[1:]
+            out.append('mww 0x%x 0x%x' % (addr, value))
+        elif kind in ('set', 'clear', 'modify'):
+            if kind == 'set':
+                (addr, mask) = op[1:]
+                expr = '$_eocd(0) | 0x%x' % (mask,)
+            elif kind == 'clear':
+                (addr, mask) = op[1:]
+                expr = '$_eocd(0) & ~0x%x' % (mask,)
+            else:
+                (addr, mask, value) = op[1:]
+                expr = '($_eocd(0) & ~0x%x) | 0x%x' % (mask, value)
+            out.append('mem2array _eocd 32 0x%x 1; mww 0x%x [expr {%s}]' % (addr, addr, expr))
+        elif kind == 'wait':
+            (addr, mask, value) = op[1:]
+            cond = '(0x%x & 0x%x) == 0x%x' % (addr, mask, value)
+            out.append('set _eocd_n 0; while {1} {mem2array _eocd 32 0x%x 1; '
+                       'if {($_eocd(0) & 0x%x) == 0x%x} break; '
+                       'if {[incr _eocd_n] > %d} {error "timeout waiting for %s"}}' % (
+                           addr, mask, value, WAIT_TRIES, cond))
+        else:
+            raise ValueError('unknown register operation %r' % (kind,))
+    return '\n'.join(out)
+
+def read_words_tcl(addrs):
+    r'''
+    TCL script reading one 32 bit word from each address, "x" in place of words that can't be read
+
+    >>> print(read_words_tcl([0xe000ed00, 0x40015800]))
+    set _eocd_out {}; foreach _eocd_a {0xe000ed00 0x40015800} {if {[catch {mem2array _eocd 32 $_eocd_a 1}]} {lappend _eocd_out x} else {lappend _eocd_out $_eocd(0)}}; set _eocd_out
+    '''
+    return ('set _eocd_out {}; foreach _eocd_a {%s} '
+            '{if {[catch {mem2array _eocd 32 $_eocd_a 1}]} {lappend _eocd_out x} else {lappend _eocd_out $_eocd(0)}}; '
+            'set _eocd_out' % (' '.join('0x%x' % (a,) for a in addrs),))
+
+def repeat_read_tcl(addr, count):
+    r'''
+    TCL script reading the 32 bit word at "addr" "count" times, e.g. sampling a register
+
+    >>> print(repeat_read_tcl(0xe000101c, 4))
+    set _eocd_out {}; for {set _eocd_i 0} {$_eocd_i < 4} {incr _eocd_i} {if {[catch {mem2array _eocd 32 0xe000101c 1}]} {lappend _eocd_out x} else {lappend _eocd_out $_eocd(0)}}; set _eocd_out
+    '''
+    return ('set _eocd_out {}; for {set _eocd_i 0} {$_eocd_i < %d} {incr _eocd_i} '
+            '{if {[catch {mem2array _eocd 32 0x%x 1}]} {lappend _eocd_out x} else {lappend _eocd_out $_eocd(0)}}; '
+            'set _eocd_out' % (count, addr))
+
+def parse_read_words_response(r):
+    '''
+    >>> parse_read_words_response(b'3759136784 x 0')
+    [3759136784, None, 0]
+    '''
+    return [ None if x == b'x' else int(x) for x in r.split() ]
+
+# Target notifications
+#
+# With "tcl_notifications on" OpenOCD sends asynchronous messages on a TCL RPC connection:
+#   type target_event event halted
+#   type target_state state running
+#   type target_reset mode halt
+# They can show up between a command and its reply, so they are read from a connection of their own,
+# the broker's side channel or, without a broker, a second TCP connection.
+
+NOTIFICATION_PREFIX = b'type target_'
+
+# target state after an event, events not listed don't change it
+EVENT_STATES = {
+    'halted': 'halted',
+    'resumed': 'running',
+    'reset-start': 'reset',
+    'reset-assert-pre': 'reset',
+}
+
+def is_notification(msg):
+    return msg.startswith(NOTIFICATION_PREFIX)
+
+def parse_notification(msg):
+    r'''
+    -> (kind, name), kind is "event", "state" or "reset". None for messages that aren't notifications
+
+    >>> parse_notification(b'type target_event event halted\r\n')
+    ('event', 'halted')
+    >>> parse_notification(b'type target_reset mode halt\r\n')
+    ('reset', 'halt')
+    >>> parse_notification(b'target state: halted\n') is None
+    True
+    '''
+    if not is_notification(msg):
+        return None
+    parts = msg.split()
+    if len(parts) != 4:
+        return None
+    kind = parts[1][len(b'target_'):].decode('ascii', 'replace')
+    return (kind, parts[3].decode('ascii', 'replace'))
+
+class TargetNotifications(object):
+    '''
+    Target state and events as announced by OpenOCD, kept up to date by a reader thread
+
+    callbacks: cb(kind, name) for every notification, called from the reader thread
+    '''
+    def __init__(self, openocd_rpc):
+        o = openocd_rpc
+        if o.path is not None:
+            self.o = OpenOcdRpc(path=o.path, pid=o.pid)
+            self.o.send_msg('eocd_broker notifications on')
+        else:
+            self.o = OpenOcdRpc(host=o.host, port=o.port, pid=o.pid)
+            self.o.send_msg('tcl_notifications on')
+        self.state = None
+        # bumped by every state change, see set_state()
+        self.seq = 0
+        self.closed = False
+        self.callbacks = []
+        self.cond = threading.Condition()
+
+        # notifications may already arrive ahead of the reply
+        while True:
+            m = self.o.recv_msg()
+            if not is_notification(m):
+                break
+            self.handle(m)
+
+        self.thread = threading.Thread(target=self._reader, name='OpenOCD notifications')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, msg):
+        n = parse_notification(msg)
+        if n is None:
+            return
+        (kind, name) = n
+        if kind == 'state':
+            state = name
+        elif kind == 'event':
+            state = EVENT_STATES.get(name)
+        else:
+            state = None
+        with self.cond:
+            if state is not None:
+                self.state = state
+                self.seq += 1
+            self.cond.notify_all()
+        for cb in list(self.callbacks):
+            try:
+                cb(kind, name)
+            except Exception:
+                logging.exception('target notification callback %r' % (cb,))
+
+    def _reader(self):
+        try:
+            while True:
+                self.handle(self.o.recv_msg())
+        except (OSError, ConnectionError):
+            pass
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def set_state(self, state, seq):
+        'state found by asking the target, dropped if a notification came in since "seq"'
+        with self.cond:
+            if self.seq == seq:
+                self.state = state
+
+    def wait_for_state(self, state, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.state == state or self.closed, timeout)
+            if self.state == state:
+                return True
+            if self.closed:
+                raise ConnectionError('OpenOCD notification connection closed')
+            return False
+
+    def close(self):
+        self.o.close()
+        self.thread.join()
+
+# Target polling
+#
+# Monitors poll many targets continuously, "ocd_poll" replies are parsed by one precompiled pattern
+# in a single pass over the undecoded reply.
+
+_POLL_RE = re.compile(
+    br'target state: (?P<state>[\w-]+)'
+    br'|current mode: (?P<mode>\w+)'
+    br'|xPSR: 0x(?P<xpsr>[0-9a-fA-F]+) pc: 0x(?P<pc>[0-9a-fA-F]+) (?P<sp_name>[mp]sp): 0x(?P<sp>[0-9a-fA-F]+)'
+    br'|(?P<failure>\scommunication failure\s)')
+
+# Scatter reads
+#
+# read_many() sorts the requested ranges and merges those closer than a gap into word aligned runs.
+# Short runs are read by one TCL script, long ones by "dump_image" (binary, less to parse),
+# all commands are sent before the first reply is read.
+
+READ_MANY_GAP = 32
+READ_MANY_BULK = 1024
+
+# easierocd.memorymap region kinds read by words only
+PERIPHERAL_KINDS = ('peripheral', 'ppb')
+
+def coalesce_ranges(ranges, gap=READ_MANY_GAP, memory_map=None):
+    '''
+    [(addr, size), ...] -> [(start, end), ...] sorted, word aligned, ranges less than "gap" bytes apart merged.
+    With an easierocd.memorymap.MemoryMap runs don't cross region boundaries.
+
+    >>> [ (hex(s), hex(e)) for (s, e) in coalesce_ranges([(0x20000010, 4), (0x20000002, 2), (0x20000100, 1), (0x20000012, 8)]) ]
+    [('0x20000000', '0x2000001c'), ('0x20000100', '0x20000104')]
+    '''
+    runs = []
+    region = None
+    for (addr, size) in sorted(ranges):
+        if size <= 0:
+            continue
+        (start, end) = (addr & ~3, (addr + size + 3) & ~3)
+        if memory_map is None:
+            same_region = True
+        else:
+            r = memory_map.find(start)
+            (same_region, region) = (r is region, r)
+        if runs and same_region and start <= runs[-1][1] + gap:
+            runs[-1][1] = max(runs[-1][1], end)
+        else:
+            runs.append([start, end])
+    return [ tuple(x) for x in runs ]
+
+def read_runs_tcl(runs):
+    r'''
+    TCL script reading all words of each (start, end) run, a single "x" in place of runs that can't be read
+
+    >>> print(read_runs_tcl([(0x20000000, 0x20000008)]))
+    set _eocd_out {}; foreach {_eocd_a _eocd_n} {0x20000000 2} {if {[catch {mem2array _eocd 32 $_eocd_a $_eocd_n}]} {lappend _eocd_out x} else {for {set _eocd_i 0} {$_eocd_i < $_eocd_n} {incr _eocd_i} {lappend _eocd_out $_eocd($_eocd_i)}}}; set _eocd_out
+    '''
+    return ('set _eocd_out {}; foreach {_eocd_a _eocd_n} {%s} '
+            '{if {[catch {mem2array _eocd 32 $_eocd_a $_eocd_n}]} {lappend _eocd_out x} '
+            'else {for {set _eocd_i 0} {$_eocd_i < $_eocd_n} {incr _eocd_i} {lappend _eocd_out $_eocd($_eocd_i)}}}; '
+            'set _eocd_out' % (' '.join('0x%x %d' % (s, (e - s) // 4) for (s, e) in runs),))
+
+def repeat_runs_tcl(runs, count):
+    r'''
+    read_runs_tcl() "count" times over, all rounds in one reply
+
+    >>> print(repeat_runs_tcl([(0x20000000, 0x20000008)], 10))
+    set _eocd_out {}; for {set _eocd_k 0} {$_eocd_k < 10} {incr _eocd_k} {foreach {_eocd_a _eocd_n} {0x20000000 2} {if {[catch {mem2array _eocd 32 $_eocd_a $_eocd_n}]} {lappend _eocd_out x} else {for {set _eocd_i 0} {$_eocd_i < $_eocd_n} {incr _eocd_i} {lappend _eocd_out $_eocd($_eocd_i)}}}}; set _eocd_out
+    '''
+    return ('set _eocd_out {}; for {set _eocd_k 0} {$_eocd_k < %d} {incr _eocd_k} '
+            '{foreach {_eocd_a _eocd_n} {%s} '
+            '{if {[catch {mem2array _eocd 32 $_eocd_a $_eocd_n}]} {lappend _eocd_out x} '
+            'else {for {set _eocd_i 0} {$_eocd_i < $_eocd_n} {incr _eocd_i} {lappend _eocd_out $_eocd($_eocd_i)}}}}; '
+            'set _eocd_out' % (count, ' '.join('0x%x %d' % (s, (e - s) // 4) for (s, e) in runs)))
+
+def parse_read_runs_response(runs, r):
+    '''
+    -> [ array('I') or None if the run faulted, ...]
+
+    >>> parse_read_runs_response([(0, 8), (0x100, 0x104)], b'1 4294967295 x')
+    [array('I', [1, 4294967295]), None]
+    '''
+    words = r.split()
+    (out, i) = ([], 0)
+    for (s, e) in runs:
+        if i < len(words) and words[i] == b'x':
+            out.append(None)
+            i += 1
+            continue
+        n = (e - s) // 4
+        out.append(array.array('I', [ int(x) & 0xffffffff for x in words[i:i+n] ]))
+        i += n
+    return out
+
+def pipelined_replies(openocd_rpc, cmd, done, in_flight=2, pace=None):
+    '''
+    Send "cmd" over and over, "in_flight" of them queued so OpenOCD never waits for the next one,
+    until done() returns True
+    -> iterator over (reply, t_start, t_end), host time.time() between which the command ran
+
+    pace: pace(n) is called before the n-th (from 0) command is sent, it may sleep to hold a rate
+    '''
+    o = openocd_rpc
+    # send times of the commands whose replies are outstanding
+    sent = []
+
+    def send(n):
+        if pace is not None:
+            pace(n)
+        o.send_msg(cmd)
+        sent.append(time.time())
+
+    try:
+        t_prev = time.time()
+        for n in range(in_flight):
+            send(n)
+        n = in_flight
+        while sent:
+            r = o.recv_msg()
+            now = time.time()
+            t_start = max(t_prev, sent.pop(0))
+            if not done():
+                send(n)
+                n += 1
+            t_prev = now
+            yield (r, t_start, now)
+    finally:
+        # replies still on their way would be taken for the answers to later commands.
+        # An interrupted recv_msg() leaves the connection unusable, there is nothing to drain then.
+        try:
+            while sent:
+                o.recv_msg()
+                sent.pop(0)
+        except (OSError, ConnectionError):
+            pass
+
+def _check_dump_image_response(r):
+    # response: address option value ('0x100000000') is not valid
+    if (b'address option value ' in r) and (b' is not valid' in r):
+        raise OpenOcdValueError(r)
+    # response: 'dumped 4 bytes in 0.000724s (5.395 KiB/s)\n'
+    if not r.startswith(b'dumped '):
+        raise OpenOcdError(cmd='ocd_dump_image', response=r)
+
+class PollState(object):
+    '''
+    Target CPU state as reported by "ocd_poll", fields OpenOCD didn't report are None
+
+    >>> PollState('halted', 'thread', 0x81000000, 0x8000ede, msp=0x20014000)
+    PollState(state='halted', current_mode='thread', xpsr=0x81000000, pc=0x8000ede, msp=0x20014000)
+    >>> PollState('running') == PollState('running')
+    True
+    '''
+    __slots__ = ('state', 'current_mode', 'xpsr', 'pc', 'msp', 'psp')
+
+    def __init__(self, state=None, current_mode=None, xpsr=None, pc=None, msp=None, psp=None):
+        self.state = state
+        self.current_mode = current_mode
+        self.xpsr = xpsr
+        self.pc = pc
+        self.msp = msp
+        self.psp = psp
+
+    def _key(self):
+        return (self.state, self.current_mode, self.xpsr, self.pc, self.msp, self.psp)
+
+    def __eq__(self, other):
+        return isinstance(other, PollState) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        fields = []
+        for (k, v) in zip(self.__slots__, self._key()):
+            if v is None:
+                continue
+            fields.append('%s=%s' % (k, repr(v) if isinstance(v, str) else '0x%x' % (v,)))
+        return 'PollState(%s)' % (', '.join(fields),)
+
+def parse_poll(r):
+    r'''
+    "ocd_poll" reply -> PollState, None on a target communication failure
+
+    >>> parse_poll(b'background polling: on\nTAP: stm32l1.cpu (enabled)\ntarget state: halted\ntarget halted due to breakpoint, current mode: Thread \nxPSR: 0x81000000 pc: 0x08000ede msp: 0x20014000\n')
+    PollState(state='halted', current_mode='thread', xpsr=0x81000000, pc=0x8000ede, msp=0x20014000)
+    >>> parse_poll(b'background polling: on\nTAP: stm32l1.cpu (enabled)\nPrevious state query failed, trying to reconnect\njtag status contains invalid mode value - communication failure\n') is None
+    True
+    '''
+    out = PollState()
+    for m in _POLL_RE.finditer(r):
+        g = m.lastgroup
+        if g == 'state':
+            out.state = m.group('state').decode('ascii')
+        elif g == 'mode':
+            out.current_mode = m.group('mode').decode('ascii').lower()
+        elif g == 'failure':
+            return None
+        else:
+            out.xpsr = int(m.group('xpsr'), 16)
+            out.pc = int(m.group('pc'), 16)
+            if m.group('sp_name') == b'msp':
+                out.msp = int(m.group('sp'), 16)
+            else:
+                out.psp = int(m.group('sp'), 16)
+    return out
+
+class PollWatcher(object):
+    '''
+    Poll the target every "interval" seconds from a thread of its own, on_change(poll_state) when the
+    state differs from the last one. On_change(None) when the target can't be reached.
+    The watcher needs an OpenOcdRpc of its own, e.g. a background priority broker client.
+
+    w = PollWatcher(openocd_rpc, on_change, interval=0.1)
+    ...
+    w.stop()
+    '''
+    def __init__(self, openocd_rpc, on_change, interval=0.1):
+        (self.o, self.on_change, self.interval) = (openocd_rpc, on_change, interval)
+        # no change is reported until the first poll
+        self.last = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name='OpenOCD poll watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            t = time.time()
+            try:
+                s = self.o.poll()
+            except TargetCommunicationError:
+                s = None
+            except (OSError, ConnectionError) as e:
+                logging.debug('poll watcher: OpenOCD connection lost: %r' % (e,))
+                return
+            if s != self.last:
+                self.last = s
+                self.on_change(s)
+            self.stopping.wait(max(0, self.interval - (time.time() - t)))
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+# Core registers
+#
+# The register file is read by one TCL script, registers the core doesn't have (FP registers
+# without an FPU) come back as "x" and are left out.
+
+CORE_REGISTERS = tuple('r%d' % (i,) for i in range(13)) + (
+    'sp', 'lr', 'pc', 'xPSR', 'msp', 'psp', 'primask', 'basepri', 'faultmask', 'control')
+FP_REGISTERS = tuple('d%d' % (i,) for i in range(16)) + ('fpscr',)
+
+def read_registers_tcl(names):
+    r'''
+    >>> print(read_registers_tcl(['r0', 'pc']))
+    set _eocd_out {}; foreach _eocd_r {r0 pc} {if {[catch {ocd_reg $_eocd_r} _eocd_v]} {lappend _eocd_out x} else {lappend _eocd_out [lindex $_eocd_v end]}}; set _eocd_out
+    '''
+    # "ocd_reg r0" -> "r0 (/32): 0x20000400"
+    return ('set _eocd_out {}; foreach _eocd_r {%s} '
+            '{if {[catch {ocd_reg $_eocd_r} _eocd_v]} {lappend _eocd_out x} else {lappend _eocd_out [lindex $_eocd_v end]}}; '
+            'set _eocd_out' % (' '.join(names),))
+
+def parse_read_registers_response(names, r):
+    '''
+    >>> parse_read_registers_response(['r0', 'pc', 'd0'], b'0x20000400 0x08000ede x')
+    {'r0': 536871936, 'pc': 134221534}
+    '''
+    out = {}
+    for (name, v) in zip(names, r.split()):
+        if v != b'x':
+            out[name] = int(v, 16)
+    return out
+
 class OpenOcdRpc(object):
     SEPARATOR = b'\x1a'
     BUFSIZE = 4096
 
-    def __init__(self, host='127.0.0.1', port=6666, pid=None):
-        logging.debug('OpenOcdRrc connect: host: %s, port: %d' % (host, port))
-        (self.host, self.port) = (host, port)
+    def __init__(self, host='127.0.0.1', port=6666, pid=None, path=None):
+        '"path": Unix socket of an easierocd.broker instead of OpenOCD\'s TCP port'
+        (self.host, self.port, self.path) = (host, port, path)
         self.msg_iter = None
         self.pid = pid
+        self._notifications = None
+        # (registers, notification seq) from read_core_registers(), valid while the target stays halted
+        self._core_registers = None
+        # easierocd.memorymap.MemoryMap, when set accesses outside of it are refused
+        # and peripherals are read word by word
+        self.memory_map = None
         self.ocd_transport = None # what OpenOCD's "transport select" command would return, i.e. 'jtag', 'swd', 'hla_swd' etc
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect((host, port))
+        if path is not None:
+            logging.debug('OpenOcdRrc connect: path: %s' % (path,))
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.conn.connect(path)
+            except OSError:
+                self.conn.close()
+                raise
+        else:
+            logging.debug('OpenOcdRrc connect: host: %s, port: %d' % (host, port))
+            self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.conn.connect((host, port))
 
     def send_msg(self, cmd):
         if isinstance(cmd, str):
@@ -132,7 +630,16 @@ class OpenOcdRpc(object):
             raise TargetDapError(cmd, r)
         return idcode
 
+    def check_range(self, addr, size):
+        'OpenOcdValueError if addr..addr+size is outside of the memory map'
+        if self.memory_map is not None:
+            try:
+                self.memory_map.check(addr, size)
+            except ValueError as e:
+                raise OpenOcdValueError(str(e))
+
     def read_word(self, addr):
+        self.check_range(addr, 4)
         r = self.call('ocd_mdw 0x%x' % (addr,))
         # response: b'0xe0042000: 10036419 \n'
         # response: b''
@@ -141,18 +648,123 @@ class OpenOcdRpc(object):
         except IndexError:
             raise TargetMemoryAccessError(cmd='ocd_mdw', response=r)
 
+    def read_words(self, addrs):
+        '-> [ word or None if the read faulted, ...] in one round trip'
+        if not addrs:
+            return []
+        cmd = read_words_tcl(addrs)
+        r = self.call(cmd)
+        out = parse_read_words_response(r)
+        if len(out) != len(addrs):
+            raise OpenOcdError(cmd=cmd, response=r)
+        return [ None if x is None else x & 0xffffffff for x in out ]
+
+    def run_register_ops(self, ops):
+        'Carry out register operations (see register_ops_tcl()) in one round trip'
+        if not ops:
+            return
+        self.run_commands([register_ops_tcl(ops)], TargetMemoryAccessError)
+
+    def run_commands(self, cmds, error=OpenOcdError):
+        'Run TCL commands in one round trip, "error" (an OpenOcdError class) is raised if one fails'
+        cmd = 'if {[catch {\n%s\n} _eocd_err]} {set _eocd_err} else {set _eocd_ok ok}' % ('\n'.join(cmds),)
+        r = self.call(cmd)
+        if r != b'ok':
+            raise error(cmd=cmd, response=r)
+
+    def write_words(self, addr_value_pairs):
+        self.run_register_ops([ ('write', a, v) for (a, v) in addr_value_pairs ])
+
+    def read_halfword(self, addr):
+        r = self.call('ocd_mdh 0x%x' % (addr,))
+        # response: b'0x1fff7a22: 0800 \n'
+        try:
+            return int(r.split(b': ')[1], base=16)
+        except IndexError:
+            raise TargetMemoryAccessError(cmd='ocd_mdh', response=r)
+
     def read_mem_into(self, addr, bytearray_out):
+        self.check_range(addr, len(bytearray_out))
+        m = self.memory_map
+        if m is not None and bytearray_out and m.find(addr).kind in PERIPHERAL_KINDS:
+            # dump_image may use byte accesses, peripherals want words
+            bytearray_out[:] = self.read_many([(addr, len(bytearray_out))])[0]
+            return
         with tempfile.NamedTemporaryFile(mode='rb') as tf:
             r = self.call('ocd_dump_image %(tfile)s 0x%(addr)x %(n)d' % dict(tfile=tf.name, addr=addr, n=len(bytearray_out)))
-            # response: address option value ('0x100000000') is not valid
-            if ('address option value ' in r) and (' is not valid' in r):
-                raise OpenOcdValueError(r)
-            # response: 'dumped 4 bytes in 0.000724s (5.395 KiB/s)\n'
-            if not r.startswith('dumped '):
-                raise OpenOcdError(cmd='ocd_dump_image', response=r)
-
+            _check_dump_image_response(r)
             tf.readinto(bytearray_out)
 
+    def read_many(self, ranges, gap=READ_MANY_GAP):
+        '''
+        [(addr, size), ...] -> [ memoryview of "size" bytes, ...] in request order
+
+        Ranges are coalesced (see coalesce_ranges()), views of the same run share its buffer.
+        Views of word aligned ranges can be turned into words with .cast('I').
+        '''
+        m = self.memory_map
+        for (addr, size) in ranges:
+            self.check_range(addr, size)
+        runs = coalesce_ranges(ranges, gap, m)
+        buf = bytearray(sum(e - s for (s, e) in runs))
+        offsets = []
+        n = 0
+        for (s, e) in runs:
+            offsets.append(n)
+            n += e - s
+
+        def bulk(run):
+            (s, e) = run
+            if e - s < READ_MANY_BULK:
+                return False
+            return m is None or m.find(s).kind not in PERIPHERAL_KINDS
+        small = [ i for (i, r) in enumerate(runs) if not bulk(r) ]
+        big = [ i for (i, r) in enumerate(runs) if bulk(r) ]
+
+        files = []
+        try:
+            cmds = []
+            if small:
+                cmds.append(read_runs_tcl([ runs[i] for i in small ]))
+            for i in big:
+                tf = tempfile.NamedTemporaryFile(mode='rb')
+                files.append(tf)
+                (s, e) = runs[i]
+                cmds.append('ocd_dump_image %s 0x%x %d' % (tf.name, s, e - s))
+            for cmd in cmds:
+                self.send_msg(cmd)
+            # every reply is collected before looking at any, the connection stays in step on errors
+            replies = [ self.recv_msg() for cmd in cmds ]
+
+            if small:
+                r = replies.pop(0)
+                for (i, words) in zip(small, parse_read_runs_response([ runs[i] for i in small ], r)):
+                    if words is None:
+                        raise TargetMemoryAccessError(cmd='mem2array 0x%x' % (runs[i][0],), response=r)
+                    if sys.byteorder != 'little':
+                        words.byteswap()
+                    b = words.tobytes()
+                    buf[offsets[i]:offsets[i] + len(b)] = b
+            for (i, tf, r) in zip(big, files, replies):
+                _check_dump_image_response(r)
+                (s, e) = runs[i]
+                tf.readinto(memoryview(buf)[offsets[i]:offsets[i] + e - s])
+        finally:
+            for tf in files:
+                tf.close()
+
+        view = memoryview(buf)
+        starts = [ s for (s, e) in runs ]
+        out = []
+        for (addr, size) in ranges:
+            if size <= 0:
+                out.append(memoryview(b''))
+                continue
+            i = bisect.bisect_right(starts, addr) - 1
+            o = offsets[i] + addr - starts[i]
+            out.append(view[o:o + size])
+        return out
+
     def read_mem(self, addr, byte_count):
         '''
         # Exapmle: unpack one int32 in native byte order
@@ -176,18 +788,61 @@ class OpenOcdRpc(object):
         return b
 
     def write_mem(self, addr, bytearray_in):
+        self.check_range(addr, len(bytearray_in))
         with tempfile.NamedTemporaryFile(mode='wb+') as tf:
             tf.write(bytearray_in)
+            tf.flush()
             r = self.call('ocd_load_image %(tfile)s 0x%(addr)x bin' % dict(tfile=tf.name, addr=addr))
             # response: address option value ('0x100000000') is not valid
-            if ('addr option value ' in r) and (' is not valid' in r):
+            if (b'addr option value ' in r) and (b' is not valid' in r):
                 raise OpenOcdValueError(r)
 
             # response: '196608 bytes written at address 0x20000000\n'
             # 'downloaded 196608 bytes in 4.008617s (47.897 KiB/s)\n'
-            if ('downloaded ' not in r) or (' bytes in ' not in r):
+            if (b'downloaded ' not in r) or (b' bytes in ' not in r):
                 raise OpenOcdError(cmd='ocd_load_image', response=r)
 
+    def write_mem_many(self, writes, ops=()):
+        '''
+        [ (addr, bytes), ...] written in one round trip, followed by register "ops" (see register_ops_tcl()),
+        e.g. to publish what was written. TargetMemoryAccessError if any of it fails.
+        '''
+        for (addr, data) in writes:
+            self.check_range(addr, len(data))
+        files = []
+        try:
+            cmds = []
+            for (addr, data) in writes:
+                tf = tempfile.NamedTemporaryFile(mode='wb+')
+                files.append(tf)
+                tf.write(data)
+                tf.flush()
+                cmds.append('ocd_load_image %s 0x%x bin' % (tf.name, addr))
+            if ops:
+                cmds.append(register_ops_tcl(ops))
+            self.run_commands(cmds, TargetMemoryAccessError)
+        finally:
+            for tf in files:
+                tf.close()
+
+    def flash_erase_sector(self, bank, first, last):
+        cmd = 'ocd_flash erase_sector %d %d %d' % (bank, first, last)
+        r = self.call(cmd)
+        # response: 'erased sectors 0 through 3 on flash bank 0 in 1.108327s\n'
+        if not r.startswith(b'erased sectors '):
+            raise OpenOcdError(cmd=cmd, response=r)
+
+    def flash_write_bank(self, bank, bytes_in, offset):
+        'write to already erased flash, "offset" is relative to the start of the bank'
+        with tempfile.NamedTemporaryFile(mode='wb+') as tf:
+            tf.write(bytes_in)
+            tf.flush()
+            cmd = 'ocd_flash write_bank %d %s 0x%x' % (bank, tf.name, offset)
+            r = self.call(cmd)
+            # response: 'wrote 4096 bytes from file /tmp/x to flash bank 0 at offset 0x00004000 in 0.203151s (19.689 KiB/s)\n'
+            if not r.startswith(b'wrote '):
+                raise OpenOcdError(cmd=cmd, response=r)
+
     def openocd_shutdown(self):
         try:
             r = self.call('ocd_shutdown')
@@ -226,7 +881,7 @@ class OpenOcdRpc(object):
         return [ x.decode('ascii') for x in r.split() if x ]
 
     def poll(self):
-        'poll target CPU'
+        '-> PollState of the target CPU, TargetCommunicationError when it can\'t be reached'
 
         # Success
         # <- b'ocd_poll'
@@ -236,25 +891,10 @@ class OpenOcdRpc(object):
         # -> b'background polling: on\nTAP: stm32l1.cpu (enabled)\nPrevious state query failed, trying to reconnect\njtag status contains invalid mode value - communication failure\n'
 
         r = self.call('ocd_poll')
-        r_str = r.decode('ascii')
-        #import IPython; IPython.embed()
-        if re.search(r'[\s]communication failure[\s]', r_str):
-            #assert(0)
+        out = parse_poll(r)
+        if out is None:
             logging.debug('ocd_poll: communication error')
             raise TargetCommunicationError('ocd_poll', r)
-        
-        # s = b'target halted due to breakpoint, current mode: Thread '
-        out = {}
-
-        current_mode_re = r'[\s]current mode: ([\w]*)'
-        m = re.search(current_mode_re, r_str, re.DOTALL)
-        if m:
-            out['current_mode'] = m.groups()[0].lower()
-
-        pc_regs_re = r'.*[\s]xPSR: 0x(?P<xPSR>[\w]*) pc: 0x(?P<pc>[\w]*) msp: 0x(?P<msp>[\w]*)'
-        m = re.search(pc_regs_re, r_str, re.DOTALL)
-        if m:
-            out.update(m.groupdict())
         return out
 
     def set_arm_semihosting(self, enable):
@@ -265,7 +905,7 @@ class OpenOcdRpc(object):
         cmd_str = 'ocd_arm semihosting %s' % (enable_str,)
         r = self.call(cmd_str)
         # -> b'semihosting is enabled\n'
-        if b'semihosting is enabled' not in r:
+        if ('semihosting is %sd' % (enable_str,)).encode('ascii') not in r:
             raise OpenOcdError(cmd_str, r)
 
     def openocd_init(self):
@@ -284,24 +924,148 @@ class OpenOcdRpc(object):
         elif [ x for x in lines if x.endswith(b' failed') ]:
             raise OpenOcdError('ocd_init: something failed', r)
 
+    def read_core_registers(self, fp=True):
+        r'''
+        -> { register name: int } of the halted core: CORE_REGISTERS and, with "fp", FP_REGISTERS the core has
+
+        Cached until the target changes state, as told by target notifications, so that resumes and steps
+        of other clients (gdb, broker clients) are noticed too. Without notifications, i.e. on OpenOCD's
+        TCP port with notifications() never used, nothing is cached.
+
+        >>> import os, socket, tempfile, threading
+        >>> path = os.path.join(tempfile.mkdtemp(), 'broker')
+        >>> srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM); srv.bind(path); srv.listen(2)
+        >>> o = OpenOcdRpc(path=path); (c, _) = srv.accept()
+        >>> def side_channel():
+        ...     (side_channel.conn, _) = srv.accept(); side_channel.conn.recv(4096); side_channel.conn.sendall(b'\x1a')
+        >>> t = threading.Thread(target=side_channel); t.start()
+        >>> regs = lambda pc: ' '.join(['0x0'] * 15 + ['0x%x' % (pc,)] + ['0x0'] * 6).encode('ascii') + b'\x1a'
+        >>> c.sendall(regs(0x8000100)); hex(o.read_core_registers(fp=False)['pc'])
+        '0x8000100'
+        >>> t.join()
+        >>> hex(o.read_core_registers(fp=False)['pc'])      # cached, not asked again
+        '0x8000100'
+        >>> # another client resumes the target, it halts somewhere else
+        >>> side_channel.conn.sendall(b'type target_event event resumed\r\n\x1atype target_event event halted\r\n\x1a')
+        >>> o.notifications().wait_for_state('halted', timeout=5)
+        True
+        >>> c.sendall(regs(0x8000200)); hex(o.read_core_registers(fp=False)['pc'])
+        '0x8000200'
+        >>> o.close(); c.close(); side_channel.conn.close(); srv.close()
+        '''
+        names = CORE_REGISTERS + (FP_REGISTERS if fp else ())
+        if self._notifications is None and self.path is None:
+            seq = None
+        else:
+            seq = self.notifications().seq
+        c = self._core_registers
+        if seq is not None and c is not None and c[1] == seq and set(names) <= c[2]:
+            return dict((k, v) for (k, v) in c[0].items() if k in names)
+
+        cmd = read_registers_tcl(names)
+        r = self.call(cmd)
+        regs = parse_read_registers_response(names, r)
+        if 'pc' not in regs:
+            # most likely not halted
+            raise OpenOcdError(cmd, r)
+        # the names asked for, FP registers the core lacks needn't be asked for again
+        self._core_registers = (regs, seq, set(names))
+        return dict(regs)
+
+    def write_core_registers(self, regs, resume=False):
+        '[ (register name, value), ...] of the halted core, written in one round trip, then "resume" it'
+        self._core_registers = None
+        cmds = [ 'ocd_reg %s 0x%x' % (name, v) for (name, v) in regs ]
+        if resume:
+            cmds.append('ocd_resume')
+        self.run_commands(cmds)
+
+    def step(self):
+        self._core_registers = None
+        self.call('ocd_step')
+
     def reset(self):
+        self._core_registers = None
         self.command('ocd_reset')
 
     def reset_halt(self):
+        self._core_registers = None
         r = self.call('ocd_reset halt')
         if b'target state: halted' not in r:
             raise OpenOcdResetError('ocd_reset halt', r)
 
     def reset_init(self):
+        self._core_registers = None
         r = self.call('ocd_reset init')
         if b'target state: halted' not in r:
             raise OpenOcdResetError('ocd_reset init', r)
 
     def halt(self):
+        self._core_registers = None
         self.command('ocd_halt')
         #r = self.call('ocd_halt')
 
+    def resume(self):
+        self._core_registers = None
+        self.command('ocd_resume')
+
+    def adapter_khz(self, khz=None):
+        '-> adapter speed in kHz, as selected by OpenOCD which may round "khz" down'
+        if khz is None:
+            cmd = 'ocd_adapter_khz'
+        else:
+            cmd = 'ocd_adapter_khz %d' % (khz,)
+        r = self.call(cmd)
+        # -> b'adapter speed: 1800 kHz\n'
+        m = re.search(br'(adapter|clock) speed: ?([\d]+) kHz', r)
+        if m is None:
+            raise OpenOcdError(cmd, r)
+        return int(m.group(2))
+
+    def notifications(self):
+        '-> TargetNotifications, set up on first use'
+        if self._notifications is None:
+            self._notifications = TargetNotifications(self)
+        return self._notifications
+
+    def add_event_callback(self, cb):
+        '''
+        cb(kind, name) on every target notification, e.g. ('event', 'halted'), ('reset', 'halt').
+        Called from a background thread, commands have to go through another connection.
+        '''
+        self.notifications().callbacks.append(cb)
+
+    def remove_event_callback(self, cb):
+        self.notifications().callbacks.remove(cb)
+
+    def wait_for_state(self, state, timeout=None):
+        '''
+        Block until the target is in "state" ('halted', 'running', 'reset')
+        -> True, False once "timeout" seconds have passed
+        '''
+        n = self.notifications()
+        # the side channel is up before the state is asked for, no change in between gets lost
+        seq = n.seq
+        n.set_state(self.poll().state, seq)
+        return n.wait_for_state(state, timeout)
+
+    # only available through easierocd.broker
+
+    def broker_priority(self, priority):
+        '"interactive" or "background"'
+        self.command('eocd_broker priority %s' % (priority,))
+
+    def transaction(self):
+        '''
+        with openocd_rpc.transaction():
+            ... # no other broker client's commands run in between
+        '''
+        return _BrokerTransaction(self)
+
     def close(self):
+        if self._notifications is not None:
+            self._notifications.close()
+            self._notifications = None
         try:
             self.conn.shutdown(socket.SHUT_RDWR)
         except OSError as e:
@@ -326,6 +1090,22 @@ class OpenOcdRpc(object):
             raise OpenOcdCommandNotSupportedError
         return r.strip().decode('ascii')
 
+class _BrokerTransaction(object):
+    def __init__(self, openocd_rpc):
+        self.o = openocd_rpc
+
+    def __enter__(self):
+        self.o.command('eocd_broker begin')
+        return self.o
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.o.command('eocd_broker %s' % ('commit' if exc_type is None else 'abort',))
+        except (OpenOcdError, OSError, ConnectionError):
+            if exc_type is None:
+                raise
+        return False
+
 def test():
     logging.basicConfig(level=logging.DEBUG)
     o = OpenOcdRpc(port=6666)
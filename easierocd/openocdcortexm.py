@@ -7,11 +7,17 @@ import logging
 import usb.core
 
 from easierocd.arm import dpidr_decode
-import easierocd.stm32 as stm32
-from easierocd.openocd import (OpenOcdError, TargetMemoryAccessError, TargetDapError)
+import easierocd.devicedb as devicedb
+import easierocd.identify as identify
+import easierocd.clockboost as clockboost
+from easierocd.openocd import (OpenOcdError, TargetDapError)
 from easierocd.util import (hex_str_literal_double_quoted)
+from easierocd.adapterspeed import DEFAULT_ADAPTER_KHZ
 import easierocd.usb
 
+# Start of the Cortex-M SRAM region, on-chip RAM of most MCUs starts here ("sram_base" in mcu_info otherwise)
+CORTEX_M_SRAM_ORIGIN = 0x20000000
+
 class OpenOcdCortexMDetectError(Exception):
     pass
 
@@ -36,11 +42,83 @@ class OpenOcdDoesntSupportTransportForAdapter(OpenOcdCortexMDetectError):
 class OpenOcdOpenFailedDuringInit(OpenOcdCortexMDetectError):
     pass
 
+class UnknownMcuError(OpenOcdCortexMDetectError):
+    'the identification registers were read, the part is missing from the device database'
+    pass
+
 def chip_name_from_mcu_info(mcu_info):
-    if mcu_info['silicon_vendor'] == 'st':
-        return mcu_info['stm32_family']
+    return mcu_info['family']
+
+# Used when the RAM size of the MCU is unknown, fits every supported part
+DEFAULT_WORK_AREA_SIZE = 4*1024
+
+def parse_memory_ranges(s):
+    '''
+    "ADDR:SIZE[,ADDR:SIZE...]" -> [ (start, end), ...]
+
+    >>> [ (hex(s), hex(e)) for (s, e) in parse_memory_ranges('0x20000000:1K,0x2001fc00:0x400') ]
+    [('0x20000000', '0x20000400'), ('0x2001fc00', '0x20020000')]
+    '''
+    out = []
+    for item in s.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (addr, size) = item.split(':')
+        size = size.strip()
+        scale = 1
+        if size[-1:] in ('K', 'k'):
+            (size, scale) = (size[:-1], 1024)
+        (addr, size) = (int(addr, 0), int(size, 0) * scale)
+        out.append((addr, addr + size))
+    return out
+
+def work_area_for_mcu(mcu_info, reserved=()):
+    '''
+    Largest block of on-chip SRAM not overlapping the "reserved" [ (start, end), ...] ranges
+    -> (phys_addr, size)
+
+    >>> work_area_for_mcu({'sram_size': 192*1024})
+    (536870912, 196608)
+    >>> # keep the top 1K (main stack) and an RTT control block at 0x20000100 untouched
+    >>> (phys, size) = work_area_for_mcu({'sram_size': 16*1024}, [(0x20003c00, 0x20004000), (0x20000100, 0x20000200)])
+    >>> (hex(phys), size)
+    ('0x20000200', 14848)
+    >>> work_area_for_mcu({})
+    (536870912, 4096)
+    '''
+    sram_size = mcu_info.get('sram_size')
+    sram_base = mcu_info.get('sram_base', CORTEX_M_SRAM_ORIGIN)
+    if sram_size is None:
+        return (sram_base, DEFAULT_WORK_AREA_SIZE)
+    free = [(sram_base, sram_base + sram_size)]
+    for (rs, re) in reserved:
+        next_free = []
+        for (fs, fe) in free:
+            if re <= fs or rs >= fe:
+                next_free.append((fs, fe))
+                continue
+            if fs < rs:
+                next_free.append((fs, rs))
+            if re < fe:
+                next_free.append((re, fe))
+        free = next_free
+    # flash loaders want word aligned buffers
+    free = [ ((fs + 7) & ~7, fe & ~7) for (fs, fe) in free ]
+    free = [ x for x in free if x[1] > x[0] ]
+    if not free:
+        raise OpenOcdCortexMDetectError('no RAM left for the OpenOCD work area')
+    (fs, fe) = max(free, key=lambda x: x[1] - x[0])
+    return (fs, fe - fs)
+
+def work_area_from_options(options, mcu_info):
+    '-> (phys_addr, size)'
+    reserved = getattr(options, 'work_area_reserve', None)
+    if reserved:
+        reserved = parse_memory_ranges(reserved)
     else:
-        assert(0)
+        reserved = []
+    return work_area_for_mcu(mcu_info, reserved)
 
 def openocd_low_level_transport_to_trasnport(t):
     # An example of an low level details of OpenOCD that we know and care about
@@ -125,7 +203,18 @@ class OpenOcdCortexMDetect(object):
 
         # adding adapter_khz to make OpenOCD happy, otherwise you'll see
         # Error: 156 6 core.c:1380 adapter_init(): An adapter speed is not selected in the init script. Insert a call to adapter_khz or jtag_rclk to proceed.
-        orpc.command('adapter_khz 300')
+        # EASIEROCD_RESET_ADAPTER_KHZ: the speed known to work at the reset clock, restored by reset-start handlers
+        # EASIEROCD_ADAPTER_KHZ: the selected (tuned) speed, only valid once the clocks are set up,
+        #                        reset-init handlers raise the speed to it after boosting the clock
+        orpc.call('set ::EASIEROCD_RESET_ADAPTER_KHZ %d' % (DEFAULT_ADAPTER_KHZ,))
+        orpc.call('set ::EASIEROCD_ADAPTER_KHZ %d' % (DEFAULT_ADAPTER_KHZ,))
+        orpc.command('adapter_khz $::EASIEROCD_RESET_ADAPTER_KHZ')
+
+    def set_adapter_khz(self, khz):
+        '-> adapter speed in effect, also used after reset-init boosted the clock'
+        khz = self.orpc.adapter_khz(khz)
+        self.orpc.call('set ::EASIEROCD_ADAPTER_KHZ %d' % (khz,))
+        return khz
 
     def openocd_init_for_detection(self, transport):
         '-> adapter'
@@ -189,32 +278,24 @@ class OpenOcdCortexMDetect(object):
         return info
 
     def detect_mcu(self, dap_info):
-        'differentiate Cortex-M mcu families'
+        'differentiate Cortex-M mcu families, one batched read (see easierocd.identify)'
         # See documentation/cortex-M-autodetection
-        o = self.orpc
         try:
-            stm32_idcode = o.read_word(stm32.DBGMCU_IDCODE_ADDR)
-        except TargetMemoryAccessError:
+            return identify.identify(self.orpc)
+        except identify.IdentifyError as e:
+            raise UnknownMcuError(e.args[0])
+        except OpenOcdError:
             raise OpenOcdCortexMDetectError
 
-        if stm32_idcode != 0 and stm32_idcode != 0xffffffff:
-            # FIXME: may be too tolerant
-            m = stm32.dbgmcu_idcode_decode(stm32_idcode)
-            m['silicon_vendor'] = 'st'
-            # e.g. 'STM32F405xx/07xx and STM32F415xx/17xx',
-            m['stm32_family'] = (m['dev'].split()[0][:len('stm32**')]).lower()
-            return m
-
-        assert(0)
-        # FIXME: handle this failure case, where there will be no flash algorithm
-        return None
-
     def declare_flash_bank(self, dap_info, mcu_info):
-        if mcu_info['silicon_vendor'] != 'st':
-            assert(0)
-        flash_algo = stm32.openocd_stm32_family_flash_algorithm(mcu_info['stm32_family'])
-        self.orpc.call('flash bank %(chip_name)s.flash %(flash_algo)s 0 0 0 0 %(chip_name)s.cpu' % 
-                      dict(chip_name=chip_name_from_mcu_info(mcu_info), flash_algo=flash_algo))
+        family = devicedb.family(mcu_info['family'])
+        if family is None or 'flash_driver' not in family:
+            raise OpenOcdCortexMDetectError('no OpenOCD flash driver known for %s' % (mcu_info['family'],))
+        chip_name = chip_name_from_mcu_info(mcu_info)
+        # "flash bank" arguments after the bank name, most drivers find everything out by themselves
+        args = family.get('flash_bank', '{name} {driver} 0 0 0 0 {target}')
+        self.orpc.call('flash bank ' + args.format(name=chip_name + '.flash', driver=family['flash_driver'],
+                                                   target=chip_name + '.cpu', flash_size=mcu_info.get('flash_size') or 0))
 
     def set_target_reset_config(self, dap_info, mcu_info):
         if not self.openocd_low_level_transport.startswith('hla_'):
@@ -245,15 +326,15 @@ class OpenOcdCortexMDetect(object):
         self.orpc.command(newdap_cmd)
 
     def configure_reset_handlers(self, dap_info, mcu_info):
-        # bin/easierocd-XX -> share/easierocd/
-        # TODO: database of whether a chip has helper functions
-        data_dir = os.path.realpath(os.path.join(os.path.dirname(sys.argv[0]), '..', 'share', 'easierocd'))
-        if mcu_info['silicon_vendor'] == 'st' and mcu_info['stm32_family'] == 'stm32l1':
-            self.orpc.call('source %s' % (os.path.join(data_dir, 'stm32l_helpers.cfg')))
-            self.orpc.call('set _TARGETNAME %s.cpu' % (chip_name_from_mcu_info(mcu_info)))
-            #  reset-start, restart-end handlers only fire on "openocd -c reset" (including 'reset init')
-            #  reset-init handlers only fire on "openocd -c 'reset init'"
-            self.orpc.call('source %s' % (os.path.join(data_dir, 'stm32l_handlers.cfg')))
+        #  reset-start, restart-end handlers only fire on "openocd -c reset" (including 'reset init')
+        #  reset-init handlers only fire on "openocd -c 'reset init'"
+        target_name = '%s.cpu' % (chip_name_from_mcu_info(mcu_info),)
+        # the MCU is back on its reset clock (e.g. STM32L1: ~2 MHz MSI), fall back to the speed known to work there
+        self.orpc.call('%s configure -event reset-start {adapter_khz $::EASIEROCD_RESET_ADAPTER_KHZ}' % (target_name,))
+        recipe = clockboost.recipe_for_mcu(mcu_info)
+        if recipe is not None:
+            self.orpc.call('%s configure -event reset-init {\n%s\n}' % (
+                target_name, clockboost.reset_init_handler_tcl(recipe)))
 
     def openocd_init_for_cortex_m(self, transport, dap_info, mcu_info):
         # see documentation/stlink-v2-1-swd-stm32l.cfg
@@ -267,11 +348,14 @@ class OpenOcdCortexMDetect(object):
         # Target CPU
         r = orpc.call('target create %(chip_name)s.cpu cortex_m -chain-position %(chip_name)s.cpu' % dict(chip_name=chip_name))
         logging.debug('target create -> %r' % (r,))
-        # Work Area
-        # FIXME: hard coding work_area_length
+        # Work Area: flash loaders and algorithms get buffers as large as the part allows
+        (work_area_phys, work_area_size) = work_area_from_options(self.options, mcu_info)
+        work_area_backup = int(bool(getattr(self.options, 'work_area_backup', False)))
+        logging.debug('work area: 0x%x, size 0x%x, backup %d' % (work_area_phys, work_area_size, work_area_backup))
         r = orpc.call('%(chip_name)s.cpu configure -work-area-phys 0x%(ram_origin)x -work-area-size 0x%(work_area_size)x '
-                      '-work-area-backup 0' % 
-                      dict(chip_name=chip_name, ram_origin=0x2*0x1000*0x10000, work_area_size=10*1024))
+                      '-work-area-backup %(backup)d' %
+                      dict(chip_name=chip_name, ram_origin=work_area_phys, work_area_size=work_area_size,
+                           backup=work_area_backup))
 
         # Declaring flash regsions effectively determines the memory map for single MCU boards
         # with no external memory.
@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+
+# Statistical profiling from PC samples
+#
+# Samplers (SWO periodic PC sampling, see easierocd.swo, or PcsrSampler) feed PCs into a PcHistogram: one counter per
+# halfword (Thumb instructions are halfword aligned) of the firmware's code in an array('I'),
+# a dict for PCs outside of it. Samples are attributed to functions through the ELF symbol table
+# (easierocd.elf.SymbolIndex) and reported as a flat profile or as folded stacks for flame graph tools.
+# PC samples carry no call stacks, folded stacks are one frame deep below the program.
+
+import os
+import array
+
+from easierocd.elf import (PF_X, PT_LOAD, SymbolIndex)
+from easierocd.openocd import (TargetMemoryAccessError, repeat_read_tcl, parse_read_words_response,
+                               pipelined_replies)
+from easierocd.swo import (DEMCR, DEMCR_TRCENA)
+
+SLEEP = '[sleep]'
+UNKNOWN = '[unknown]'
+
+def code_range(elf):
+    '-> (start, end) of the executable load segments'
+    segs = [ ph for ph in elf.program_headers() if ph.type == PT_LOAD and ph.flags & PF_X and ph.memsz ]
+    if not segs:
+        return (0, 0)
+    return (min(ph.vaddr for ph in segs), max(ph.vaddr + ph.memsz for ph in segs))
+
+class PcHistogram(object):
+    '''
+    >>> h = PcHistogram(0x08000000, 0x08000100)
+    >>> h.add([0x08000010, 0x08000010, 0x08000012, 0x20000000])
+    >>> h.add_sleep(2)
+    >>> [ (hex(pc), n) for (pc, n) in sorted(h.items()) ]
+    [('0x8000010', 2), ('0x8000012', 1), ('0x20000000', 1)]
+    >>> (h.total, h.sleep)
+    (6, 2)
+    '''
+    def __init__(self, start=0, end=0):
+        self.base = start
+        self.counts = array.array('I', bytes(4 * ((end - start + 1) // 2)))
+        self.other = {}
+        self.sleep = 0
+        self.total = 0
+
+    def add(self, pcs):
+        (counts, base, n, other) = (self.counts, self.base, len(self.counts), self.other)
+        k = 0
+        for pc in pcs:
+            i = (pc - base) >> 1
+            if 0 <= i < n:
+                counts[i] += 1
+            else:
+                other[pc] = other.get(pc, 0) + 1
+            k += 1
+        self.total += k
+
+    def add_sleep(self, n):
+        self.sleep += n
+        self.total += n
+
+    def items(self):
+        '-> iterator over (pc, count) of the PCs sampled'
+        base = self.base
+        for (i, c) in enumerate(self.counts):
+            if c:
+                yield (base + 2 * i, c)
+        for item in self.other.items():
+            yield item
+
+def symbolize(histogram, index):
+    '''
+    -> [ (function name, samples), ...], most samples first
+
+    index: easierocd.elf.SymbolIndex or None for a per PC profile
+    '''
+    out = {}
+    for (pc, c) in histogram.items():
+        s = index.lookup(pc) if index is not None else None
+        if s is not None:
+            name = s.name
+        elif index is None:
+            name = '0x%08x' % (pc,)
+        else:
+            name = UNKNOWN
+        out[name] = out.get(name, 0) + c
+    if histogram.sleep:
+        out[SLEEP] = histogram.sleep
+    return sorted(out.items(), key=lambda x: (-x[1], x[0]))
+
+def function_index(elf):
+    '-> SymbolIndex of the functions in easierocd.elf.ElfFile "elf"'
+    return SymbolIndex(elf.symbols()).functions()
+
+def flat_profile(profile, total, top=None):
+    '''
+    -> report lines
+
+    >>> for l in flat_profile([('main', 75), ('[sleep]', 25)], 100): print(l)
+         %    samples  function
+      75.00        75  main
+      25.00        25  [sleep]
+    '''
+    out = ['     %    samples  function']
+    for (name, c) in profile[:top]:
+        out.append('%7.2f %9d  %s' % (100.0 * c / max(total, 1), c, name))
+    return out
+
+def folded_stacks(profile, root):
+    '''
+    -> lines in the "folded" format of flame graph tools
+
+    >>> folded_stacks([('main', 75), ('[sleep]', 25)], 'blinky.elf')
+    ['blinky.elf;main 75', 'blinky.elf;[sleep] 25']
+    '''
+    root = root.replace(';', '_').replace(' ', '_')
+    return [ '%s;%s %d' % (root, name.replace(';', '_').replace(' ', '_'), c) for (name, c) in profile ]
+
+def histogram_for_elf(elf):
+    '-> PcHistogram covering the code of "elf" (easierocd.elf.ElfFile or None)'
+    if elf is None:
+        return PcHistogram()
+    return PcHistogram(*code_range(elf))
+
+def report(histogram, elf, top=None, folded_path=None):
+    '-> flat profile lines, folded stacks go to "folded_path"'
+    index = function_index(elf) if elf is not None else None
+    profile = symbolize(histogram, index)
+    if folded_path is not None:
+        root = os.path.basename(elf.path) if elf is not None else 'firmware'
+        with open(folded_path, 'w') as f:
+            for line in folded_stacks(profile, root):
+                f.write(line + '\n')
+    return flat_profile(profile, histogram.total, top)
+
+# Sampling without SWO: DWT_PCSR holds the address of a recently executed instruction and can be
+# read through the debug port while the core runs. Each command reads it PCSR_BATCH times and
+# PCSR_IN_FLIGHT commands are kept queued so OpenOCD never waits for the next one.
+DWT_PCSR = 0xe000101c
+# what DWT_PCSR reads while the core is halted
+PCSR_HALTED = 0xffffffff
+PCSR_BATCH = 256
+PCSR_IN_FLIGHT = 2
+
+class PcsrSampler(object):
+    '''
+    sampler = PcsrSampler(openocd_rpc)
+    for (times, pcs) in sampler.batches(lambda: time.time() > deadline):
+        histogram.add(pcs)
+
+    times: host time.time() of each sample, interpolated within a batch
+    '''
+    def __init__(self, openocd_rpc, batch=PCSR_BATCH, in_flight=PCSR_IN_FLIGHT):
+        self.o = openocd_rpc
+        (self.batch, self.in_flight) = (batch, in_flight)
+        self.halted = 0
+
+    def batches(self, done):
+        '-> iterator over (array("d") times, array("I") PCs) until done() returns True'
+        self.o.run_register_ops([('set', DEMCR, DEMCR_TRCENA)])
+        cmd = repeat_read_tcl(DWT_PCSR, self.batch)
+        for (r, t_start, t_end) in pipelined_replies(self.o, cmd, done, self.in_flight):
+            words = parse_read_words_response(r)
+            if len(words) != self.batch or None in words:
+                raise TargetMemoryAccessError(cmd='mem2array 0x%x' % (DWT_PCSR,), response=r)
+            (times, pcs) = (array.array('d'), array.array('I'))
+            step = (t_end - t_start) / len(words)
+            for (i, w) in enumerate(words):
+                w &= 0xffffffff
+                if w == PCSR_HALTED:
+                    self.halted += 1
+                    continue
+                pcs.append(w)
+                times.append(t_start + step * (i + 1))
+            yield (times, pcs)
@@ -0,0 +1,373 @@
+from __future__ import absolute_import
+
+# RAM ring buffer console (SEGGER RTT layout)
+#
+# The firmware keeps a control block in RAM:
+#   char id[16]              "SEGGER RTT"
+#   int32 max_up, max_down   number of buffer descriptors that follow
+#   descriptor up[max_up], down[max_down], 24 bytes each:
+#     name, buffer, size, write offset, read offset, flags
+# Up buffers carry target -> host data, the target advances the write offset, we the read offset.
+# Down buffers the other way around. The core keeps running, nothing is halted.
+#
+# The control block is found with one bulk read of RAM and bytes.find() or taken from the ELF
+# symbol "_SEGGER_RTT". Each poll is one round trip reading every buffer's offsets (plus the read
+# offset updates of the poll before), and one read_many() of the new data if there is any.
+# Polling backs off while the target is quiet.
+
+import os
+import sys
+import socket
+import struct
+import selectors
+
+from easierocd.openocd import (OpenOcdError, TargetMemoryAccessError, register_ops_tcl,
+                               read_words_tcl, parse_read_words_response)
+import easierocd.memorymap as memorymap
+
+RTT_ID = b'SEGGER RTT'
+ELF_SYMBOL = '_SEGGER_RTT'
+
+HEADER_SIZE = 24
+DESCRIPTOR_SIZE = 24
+(DESC_NAME, DESC_BUFFER, DESC_SIZE, DESC_WR, DESC_RD, DESC_FLAGS) = range(0, 24, 4)
+MAX_BUFFERS = 32
+
+# RAM searched for the control block at most
+MAX_SCAN_BYTES = 512 * 1024
+
+# polling interval: MIN_INTERVAL after data moved, doubling up to MAX_INTERVAL while idle
+MIN_INTERVAL = 0.001
+MAX_INTERVAL = 0.05
+
+# bytes written to a down buffer per poll
+MAX_DOWN_WRITE = 256
+
+class RttError(Exception):
+    pass
+
+def scan_ranges(memory_map):
+    '-> [ (start, end), ...] of on-chip RAM to look for the control block in'
+    out = []
+    for r in memory_map:
+        if r.kind == memorymap.RAM and r.name in ('sram', 'ccm'):
+            out.append((r.start, min(r.end, r.start + MAX_SCAN_BYTES)))
+    return out
+
+def find_in_buffer(buf, base):
+    r'''
+    -> address of the first plausible control block in "buf" (read from "base"), None if there is none
+
+    >>> b = bytearray(64) + b'SEGGER RTT\0\0\0\0\0\0' + struct.pack('<ii', 3, 3)
+    >>> hex(find_in_buffer(b, 0x20000000))
+    '0x20000040'
+    '''
+    i = buf.find(RTT_ID)
+    while i >= 0:
+        if i % 4 == 0 and i + HEADER_SIZE <= len(buf):
+            (n_up, n_down) = struct.unpack_from('<ii', buf, i + 16)
+            if 0 < n_up <= MAX_BUFFERS and 0 <= n_down <= MAX_BUFFERS:
+                return base + i
+        i = buf.find(RTT_ID, i + 1)
+    return None
+
+def find_control_block(openocd_rpc, ranges):
+    '-> control block address, RttError if none is found. One bulk read per range.'
+    for (start, end) in ranges:
+        buf = openocd_rpc.read_mem(start, end - start)
+        a = find_in_buffer(buf, start)
+        if a is not None:
+            return a
+    raise RttError('no RTT control block in %s' % (
+        ', '.join('0x%x-0x%x' % r for r in ranges) or 'RAM'))
+
+def control_block_from_elf(elf):
+    '-> address of "_SEGGER_RTT" in easierocd.elf.ElfFile "elf" or None'
+    s = elf.symbol(ELF_SYMBOL)
+    return s.value if s is not None else None
+
+class RingBuffer(object):
+    __slots__ = ('index', 'up', 'desc', 'name', 'buffer', 'size', 'wr', 'rd')
+
+    def __init__(self, index, up, desc, name, buffer, size):
+        (self.index, self.up, self.desc, self.name, self.buffer, self.size) = (index, up, desc, name, buffer, size)
+        (self.wr, self.rd) = (0, 0)
+
+    def __repr__(self):
+        return 'RingBuffer(%s%d %r, 0x%x, %d)' % ('up' if self.up else 'down', self.index, self.name,
+                                                 self.buffer, self.size)
+
+def pending_ranges(b):
+    '''
+    -> [ (addr, size), ...] of the data between read and write offset of an up buffer
+
+    >>> b = RingBuffer(0, True, 0, 'Terminal', 0x20000100, 256)
+    >>> (b.rd, b.wr) = (250, 4)
+    >>> [ (hex(a), n) for (a, n) in pending_ranges(b) ]
+    [('0x200001fa', 6), ('0x20000100', 4)]
+    '''
+    if b.wr >= b.rd:
+        return [(b.buffer + b.rd, b.wr - b.rd)] if b.wr > b.rd else []
+    return [ r for r in [(b.buffer + b.rd, b.size - b.rd), (b.buffer, b.wr)] if r[1] ]
+
+def down_free(b):
+    '''
+    >>> b = RingBuffer(0, False, 0, 'Terminal', 0x20000200, 16)
+    >>> (b.rd, b.wr) = (0, 0)
+    >>> down_free(b)
+    15
+    '''
+    return (b.rd - b.wr - 1) % b.size
+
+class RttChannel(object):
+    '''
+    rtt = RttChannel(openocd_rpc, control_block_addr)
+    for (index, data) in rtt.poll():
+        ...
+    rtt.write(0, b'command\\n')
+    '''
+    def __init__(self, openocd_rpc, address):
+        self.o = openocd_rpc
+        self.address = address
+        # read offset updates, sent along with the next offset read
+        self._updates = []
+        self.read_layout()
+
+    def read_layout(self):
+        o = self.o
+        head = o.read_mem(self.address, HEADER_SIZE)
+        if bytes(head[:len(RTT_ID)]) != RTT_ID:
+            raise RttError('no RTT control block at 0x%x' % (self.address,))
+        (n_up, n_down) = struct.unpack_from('<ii', head, 16)
+        if not (0 <= n_up <= MAX_BUFFERS and 0 <= n_down <= MAX_BUFFERS):
+            raise RttError('RTT control block at 0x%x: %d up, %d down buffers?' % (self.address, n_up, n_down))
+        descs = o.read_mem(self.address + HEADER_SIZE, (n_up + n_down) * DESCRIPTOR_SIZE)
+        (self.up, self.down) = ([], [])
+        names = []
+        for i in range(n_up + n_down):
+            (name_addr, buf, size, wr, rd, flags) = struct.unpack_from('<IIIIII', descs, i * DESCRIPTOR_SIZE)
+            up = i < n_up
+            b = RingBuffer(i if up else i - n_up, up, self.address + HEADER_SIZE + i * DESCRIPTOR_SIZE,
+                           None, buf, size)
+            (b.wr, b.rd) = (wr, rd)
+            (self.up if up else self.down).append(b)
+            if size:
+                names.append((b, name_addr))
+        # names are for display only, a bad pointer doesn't make the buffer unusable
+        for (b, a) in names:
+            b.name = self._cstring(a)
+
+    def _cstring(self, addr, limit=32):
+        if addr == 0:
+            return None
+        try:
+            s = bytes(self.o.read_mem(addr, limit))
+        except OpenOcdError:
+            return None
+        return s.split(b'\0', 1)[0].decode('ascii', 'replace')
+
+    def buffers(self):
+        return [ b for b in self.up + self.down if b.size ]
+
+    def _index_addrs(self):
+        out = []
+        for b in self.buffers():
+            out.extend([b.desc + DESC_WR, b.desc + DESC_RD])
+        return out
+
+    def refresh(self):
+        'read every buffer\'s offsets, sending the pending read offset updates along, one round trip'
+        addrs = self._index_addrs()
+        cmd = read_words_tcl(addrs)
+        if self._updates:
+            cmd = register_ops_tcl(self._updates) + '\n' + cmd
+            self._updates = []
+        r = self.o.call(cmd)
+        try:
+            words = parse_read_words_response(r)
+        except ValueError:
+            # a read offset update failed, the reply is the error message
+            words = []
+        if len(words) != len(addrs) or None in words:
+            raise TargetMemoryAccessError(cmd='RTT offsets', response=r)
+        for (b, i) in zip(self.buffers(), range(0, len(words), 2)):
+            (wr, rd) = (words[i], words[i + 1])
+            if wr >= b.size or rd >= b.size:
+                raise RttError('%r: offsets out of range (write %d, read %d), control block overwritten?' % (b, wr, rd))
+            (b.wr, b.rd) = (wr, rd)
+
+    def poll(self):
+        '-> [ (up buffer index, bytes), ...] of the data the target wrote since the last poll'
+        self.refresh()
+        ready = [ b for b in self.up if b.size and b.wr != b.rd ]
+        if not ready:
+            return []
+        ranges = []
+        for b in ready:
+            ranges.extend(pending_ranges(b))
+        views = iter(self.o.read_many(ranges, gap=0))
+        out = []
+        for b in ready:
+            data = b''.join(bytes(next(views)) for r in pending_ranges(b))
+            out.append((b.index, data))
+            b.rd = b.wr
+            self._updates.append(('write', b.desc + DESC_RD, b.rd))
+        return out
+
+    def flush(self):
+        'send pending read offset updates now'
+        if self._updates:
+            self.o.run_register_ops(self._updates)
+            self._updates = []
+
+    def write(self, index, data):
+        '''
+        -> number of bytes of "data" put into down buffer "index", as much as there is room for.
+        The buffer's offsets are the ones from the last refresh() or poll().
+        '''
+        b = self.down[index]
+        n = min(len(data), down_free(b), MAX_DOWN_WRITE)
+        if n <= 0:
+            return 0
+        # at most two pieces, the second one after wrapping around
+        first = min(n, b.size - b.wr)
+        writes = [(b.buffer + b.wr, data[:first])]
+        if n > first:
+            writes.append((b.buffer, data[first:n]))
+        wr = (b.wr + n) % b.size
+        # data first, the target may look at the write offset any time
+        self.o.write_mem_many(writes, [('write', b.desc + DESC_WR, wr)])
+        b.wr = wr
+        return n
+
+def _read_all(fd):
+    out = []
+    while True:
+        d = os.read(fd, 65536)
+        if not d:
+            return b''.join(out)
+        out.append(d)
+
+class RttServer(object):
+    '''
+    Moves data between an RttChannel and local endpoints until stopped:
+      up buffer 0 -> stdout, stdin -> down buffer 0 (stdio=True)
+      up/down buffer N <-> clients of the Unix socket "socket_dir/rtt-N" (socket_dir given)
+
+    stdin: file descriptor, sys.stdin by default. Regular files and /dev/null (e.g. under CI) can't be
+    waited for, they are read to the end right away.
+
+    >>> import types
+    >>> with open(os.devnull, 'rb') as f:
+    ...     s = RttServer(types.SimpleNamespace(up=[], down=[None]), stdin=f.fileno())
+    >>> (s.down_pending, s.close())
+    ({}, None)
+    '''
+    def __init__(self, channel, stdio=True, socket_dir=None, stdin=None):
+        self.rtt = channel
+        self.sel = selectors.DefaultSelector()
+        # down buffer index -> bytes waiting for room
+        self.down_pending = {}
+        # buffer index -> [ client socket, ...]
+        self.clients = {}
+        self.listeners = []
+        self.stdio = stdio
+        self.bytes_up = 0
+        if stdio:
+            if stdin is None:
+                stdin = sys.stdin.fileno()
+            try:
+                self.sel.register(stdin, selectors.EVENT_READ, ('stdin', 0))
+            except PermissionError:
+                # epoll refuses files that are always readable
+                d = _read_all(stdin)
+                if d and channel.down:
+                    self.down_pending[0] = d
+        if socket_dir is not None:
+            n = max(len(channel.up), len(channel.down))
+            for i in range(n):
+                path = os.path.join(socket_dir, 'rtt-%d' % (i,))
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                s.bind(path)
+                s.listen(4)
+                s.setblocking(False)
+                self.listeners.append((s, path))
+                self.sel.register(s, selectors.EVENT_READ, ('listener', i))
+
+    def _local_events(self, timeout):
+        for (key, events) in self.sel.select(timeout):
+            (kind, i) = key.data
+            if kind == 'listener':
+                try:
+                    (c, addr) = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                self.clients.setdefault(i, []).append(c)
+                self.sel.register(c, selectors.EVENT_READ, ('client', i))
+                continue
+            if kind == 'stdin':
+                d = os.read(key.fd, 4096)
+                if not d:
+                    self.sel.unregister(key.fd)
+            else:
+                try:
+                    d = key.fileobj.recv(4096)
+                except OSError:
+                    d = b''
+                if not d:
+                    self._drop(i, key.fileobj)
+            if d and i < len(self.rtt.down):
+                self.down_pending[i] = self.down_pending.get(i, b'') + d
+
+    def _drop(self, i, c):
+        self.sel.unregister(c)
+        c.close()
+        self.clients[i].remove(c)
+
+    def _deliver(self, i, data):
+        self.bytes_up += len(data)
+        if self.stdio and i == 0:
+            out = sys.stdout.buffer
+            out.write(data)
+            out.flush()
+        for c in list(self.clients.get(i, [])):
+            try:
+                c.sendall(data)
+            except OSError:
+                self._drop(i, c)
+
+    def serve(self, done=lambda: False):
+        interval = MIN_INTERVAL
+        try:
+            while not done():
+                moved = False
+                for (i, data) in self.rtt.poll():
+                    self._deliver(i, data)
+                    moved = True
+                for (i, d) in list(self.down_pending.items()):
+                    n = self.rtt.write(i, d)
+                    moved = moved or n > 0
+                    if n == len(d):
+                        del self.down_pending[i]
+                    else:
+                        self.down_pending[i] = d[n:]
+                interval = MIN_INTERVAL if moved else min(interval * 2, MAX_INTERVAL)
+                self._local_events(interval)
+        finally:
+            self.rtt.flush()
+
+    def close(self):
+        for cs in self.clients.values():
+            for c in cs:
+                c.close()
+        for (s, path) in self.listeners:
+            s.close()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.sel.close()
@@ -0,0 +1,468 @@
+from __future__ import absolute_import
+
+# ARM semihosting serviced by easierocd instead of OpenOCD
+#
+# The firmware issues a call with "BKPT 0xAB", r0 = operation, r1 = parameter block (or value).
+# With OpenOCD's own semihosting disabled the core just halts there. We hear of the halt through
+# target notifications (OpenOcdRpc.add_event_callback()), then per call:
+#   1 round trip: r0, r1, pc, the instruction at pc and the first 4 words of the parameter block
+#   0 or 1: the data (read_mem() for SYS_WRITE, write_mem() for SYS_READ, ...)
+#   1: r0 = result, pc past the BKPT and resume
+# no matter how many bytes move. Output is buffered and flushed once the firmware stops making calls
+# for FLUSH_DELAY seconds, on SYS_READ from the console and at exit.
+#
+# Files the firmware opens live under a sandbox directory, paths can't leave it. ":tt" is the
+# console: stdin and the output sink.
+# See "Semihosting for AArch32 and AArch64", ARM DUI 0471 "Semihosting operations"
+
+import os
+import io
+import sys
+import time
+import errno
+import logging
+import threading
+
+from easierocd.openocd import TargetMemoryAccessError
+from easierocd.util import connect_endpoint
+
+SYS_OPEN = 0x01
+SYS_CLOSE = 0x02
+SYS_WRITEC = 0x03
+SYS_WRITE0 = 0x04
+SYS_WRITE = 0x05
+SYS_READ = 0x06
+SYS_READC = 0x07
+SYS_ISERROR = 0x08
+SYS_ISTTY = 0x09
+SYS_SEEK = 0x0a
+SYS_FLEN = 0x0c
+SYS_TMPNAM = 0x0d
+SYS_REMOVE = 0x0e
+SYS_RENAME = 0x0f
+SYS_CLOCK = 0x10
+SYS_TIME = 0x11
+SYS_SYSTEM = 0x12
+SYS_ERRNO = 0x13
+SYS_GET_CMDLINE = 0x15
+SYS_HEAPINFO = 0x16
+SYS_EXIT = 0x18
+SYS_EXIT_EXTENDED = 0x20
+
+# SYS_EXIT reason of a normal exit
+ADP_STOPPED_APPLICATION_EXIT = 0x20026
+
+# Thumb "BKPT 0xAB"
+BKPT_SEMIHOSTING = 0xbeab
+
+PARAM_WORDS = 4
+
+# parameter block words the operations use
+PARAM_COUNTS = {
+    SYS_OPEN: 3, SYS_CLOSE: 1, SYS_WRITE: 3, SYS_READ: 3, SYS_ISERROR: 1, SYS_ISTTY: 1, SYS_SEEK: 2,
+    SYS_FLEN: 1, SYS_REMOVE: 2, SYS_RENAME: 4, SYS_GET_CMDLINE: 2, SYS_HEAPINFO: 1, SYS_EXIT_EXTENDED: 2,
+}
+
+CONSOLE = ':tt'
+# SYS_OPEN modes 0..11, "b" makes no difference on the host
+OPEN_MODES = ('rb', 'rb', 'r+b', 'r+b', 'wb', 'wb', 'w+b', 'w+b', 'ab', 'ab', 'a+b', 'a+b')
+
+BUFFER_SIZE = 64 * 1024
+FLUSH_DELAY = 0.05
+# SYS_WRITE0 reads the string this much at a time
+STRING_CHUNK = 64
+
+def state_tcl():
+    '''
+    TCL script reading r0, r1, pc (hex), the halfword at pc and PARAM_WORDS words at r1 (decimal, "x" if
+    unreadable)
+    '''
+    return ('set _eocd_s {}; foreach _eocd_r {r0 r1 pc} {lappend _eocd_s [lindex [ocd_reg $_eocd_r] end]}; '
+            'if {[catch {mem2array _eocd 16 [lindex $_eocd_s 2] 1}]} {lappend _eocd_s x} '
+            'else {lappend _eocd_s $_eocd(0)}; '
+            'if {[catch {mem2array _eocd 32 [lindex $_eocd_s 1] %d}]} {lappend _eocd_s %s} '
+            'else {for {set _eocd_i 0} {$_eocd_i < %d} {incr _eocd_i} {lappend _eocd_s $_eocd($_eocd_i)}}; '
+            'set _eocd_s' % (PARAM_WORDS, ' '.join(['x'] * PARAM_WORDS), PARAM_WORDS))
+
+def parse_state_response(r):
+    '''
+    -> (r0, r1, pc, instruction, [ parameter word or None, ...]), None if the core isn't halted
+
+    >>> parse_state_response(b'0x00000005 0x20001ff0 0x08000226 48811 1 536870912 12 0')
+    (5, 536879088, 134218278, 48811, [1, 536870912, 12, 0])
+    >>> parse_state_response(b'0x00000003 0x20001ff3 0x08000226 48811 x x x x')[4]
+    [None, None, None, None]
+    >>> parse_state_response(b'target not halted') is None
+    True
+    '''
+    parts = r.split()
+    if len(parts) != 4 + PARAM_WORDS:
+        return None
+    try:
+        (r0, r1, pc) = [ int(x, 16) for x in parts[:3] ]
+        rest = [ None if x == b'x' else int(x) & 0xffffffff for x in parts[3:] ]
+    except ValueError:
+        return None
+    return (r0, r1, pc, rest[0], rest[1:])
+
+def sandbox_path(root, name):
+    '''
+    -> host path of "name" inside the sandbox directory "root", None if it would lead outside of it
+
+    >>> sandbox_path('/tmp/fw', 'logs/run1.txt')
+    '/tmp/fw/logs/run1.txt'
+    >>> sandbox_path('/tmp/fw', '/logs/run1.txt')
+    '/tmp/fw/logs/run1.txt'
+    >>> sandbox_path('/tmp/fw', '../../etc/passwd') is None
+    True
+    '''
+    root = os.path.realpath(root)
+    p = os.path.realpath(os.path.join(root, name.lstrip('/')))
+    if p != root and not p.startswith(root + os.sep):
+        return None
+    return p
+
+def open_output(spec):
+    '''
+    -> binary file object, buffered
+    spec: "-" (stdout), FILE (appended to), tcp:HOST:PORT or unix:PATH (connects to a listener)
+    '''
+    if spec == '-':
+        return io.BufferedWriter(io.FileIO(os.dup(sys.stdout.fileno()), 'wb'), BUFFER_SIZE)
+    s = connect_endpoint(spec)
+    if s is not None:
+        f = s.makefile('wb', buffering=BUFFER_SIZE)
+        # the file object keeps the connection open
+        s.close()
+        return f
+    return open(spec, 'ab', buffering=BUFFER_SIZE)
+
+class _Console(object):
+    'a ":tt" handle: reads stdin, writes the output sink'
+    pass
+
+class SemihostingService(object):
+    '''
+    s = SemihostingService(openocd_rpc, root='build/semihosting', output=open_output('-'))
+    s.start()
+    openocd_rpc.reset()
+    exit_code = s.serve()
+
+    cmdline: returned by SYS_GET_CMDLINE
+    '''
+    def __init__(self, openocd_rpc, root, output, cmdline='', stdin_fd=0):
+        self.o = openocd_rpc
+        self.root = root
+        self.output = output
+        self.cmdline = cmdline
+        self.stdin_fd = stdin_fd
+        self.handles = {}
+        self.next_handle = 1
+        self.errno = 0
+        self.exit_code = None
+        # operation being serviced
+        self.op = None
+        self.t0 = time.time()
+        self.calls = 0
+        self.bytes_out = 0
+        self.unsupported = set()
+        # set by start(), halt notifications set it
+        self._halted = None
+        self.syscalls = {
+            SYS_OPEN: self.sys_open,
+            SYS_CLOSE: self.sys_close,
+            SYS_WRITEC: self.sys_writec,
+            SYS_WRITE0: self.sys_write0,
+            SYS_WRITE: self.sys_write,
+            SYS_READ: self.sys_read,
+            SYS_READC: self.sys_readc,
+            SYS_ISERROR: lambda r1, p: 1 if p[0] is not None and p[0] & 0x80000000 else 0,
+            SYS_ISTTY: self.sys_istty,
+            SYS_SEEK: self.sys_seek,
+            SYS_FLEN: self.sys_flen,
+            SYS_REMOVE: self.sys_remove,
+            SYS_RENAME: self.sys_rename,
+            SYS_CLOCK: lambda r1, p: int((time.time() - self.t0) * 100),
+            SYS_TIME: lambda r1, p: int(time.time()),
+            SYS_ERRNO: lambda r1, p: self.errno,
+            SYS_GET_CMDLINE: self.sys_get_cmdline,
+            SYS_HEAPINFO: self.sys_heapinfo,
+            SYS_EXIT: self.sys_exit,
+            SYS_EXIT_EXTENDED: self.sys_exit,
+        }
+
+    # target memory
+
+    def _read(self, addr, n):
+        return bytes(self.o.read_mem(addr, n)) if n > 0 else b''
+
+    def _string(self, addr, n):
+        return self._read(addr, n).decode('utf-8', 'replace')
+
+    def _write_out(self, data):
+        self.output.write(data)
+        self.bytes_out += len(data)
+
+    def _file(self, h):
+        f = self.handles.get(h)
+        if f is None:
+            self.errno = errno.EBADF
+        return f
+
+    def _os_error(self, e):
+        self.errno = e.errno or errno.EIO
+        return -1
+
+    # operations: (r1, parameter words) -> r0, None leaves r0 alone
+
+    def sys_open(self, r1, p):
+        (name_addr, mode, n) = p[:3]
+        name = self._string(name_addr, n)
+        if mode >= len(OPEN_MODES):
+            self.errno = errno.EINVAL
+            return -1
+        if name == CONSOLE:
+            f = _Console()
+        else:
+            path = sandbox_path(self.root, name)
+            if path is None:
+                logging.warning('semihosting: %r is outside of %s' % (name, self.root))
+                self.errno = errno.EACCES
+                return -1
+            try:
+                f = open(path, OPEN_MODES[mode], buffering=BUFFER_SIZE)
+            except OSError as e:
+                return self._os_error(e)
+        h = self.next_handle
+        self.next_handle += 1
+        self.handles[h] = f
+        return h
+
+    def sys_close(self, r1, p):
+        f = self._file(p[0])
+        if f is None:
+            return -1
+        del self.handles[p[0]]
+        if not isinstance(f, _Console):
+            f.close()
+        return 0
+
+    def sys_writec(self, r1, p):
+        self._write_out(self._read(r1, 1))
+        return None
+
+    def sys_write0(self, r1, p):
+        out = []
+        addr = r1
+        while True:
+            # don't read across a 1K boundary, the next block may be unmapped
+            n = min(STRING_CHUNK, 0x400 - (addr & 0x3ff))
+            d = self._read(addr, n)
+            i = d.find(b'\0')
+            if i >= 0:
+                out.append(d[:i])
+                break
+            out.append(d)
+            addr += n
+        self._write_out(b''.join(out))
+        return None
+
+    def sys_write(self, r1, p):
+        (h, buf, n) = p[:3]
+        f = self._file(h)
+        if f is None:
+            return n
+        data = self._read(buf, n)
+        if isinstance(f, _Console):
+            self._write_out(data)
+            return 0
+        try:
+            f.write(data)
+        except OSError as e:
+            self._os_error(e)
+            return n
+        return 0
+
+    def _console_read(self, n):
+        self.output.flush()
+        try:
+            return os.read(self.stdin_fd, n)
+        except OSError as e:
+            self._os_error(e)
+            return b''
+
+    def sys_read(self, r1, p):
+        (h, buf, n) = p[:3]
+        f = self._file(h)
+        if f is None:
+            return n
+        if isinstance(f, _Console):
+            d = self._console_read(n)
+        else:
+            try:
+                d = f.read(n)
+            except OSError as e:
+                self._os_error(e)
+                return n
+        if d:
+            self.o.write_mem(buf, bytearray(d))
+        return n - len(d)
+
+    def sys_readc(self, r1, p):
+        d = self._console_read(1)
+        return d[0] if d else -1
+
+    def sys_istty(self, r1, p):
+        f = self._file(p[0])
+        if f is None:
+            return -1
+        return 1 if isinstance(f, _Console) else 0
+
+    def sys_seek(self, r1, p):
+        f = self._file(p[0])
+        if f is None or isinstance(f, _Console):
+            self.errno = errno.ESPIPE if f is not None else self.errno
+            return -1
+        try:
+            f.seek(p[1])
+        except OSError as e:
+            return self._os_error(e)
+        return 0
+
+    def sys_flen(self, r1, p):
+        f = self._file(p[0])
+        if f is None or isinstance(f, _Console):
+            return -1
+        f.flush()
+        return os.fstat(f.fileno()).st_size
+
+    def sys_remove(self, r1, p):
+        path = sandbox_path(self.root, self._string(p[0], p[1]))
+        if path is None:
+            return errno.EACCES
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self._os_error(e)
+            return self.errno
+        return 0
+
+    def sys_rename(self, r1, p):
+        old = sandbox_path(self.root, self._string(p[0], p[1]))
+        new = sandbox_path(self.root, self._string(p[2], p[3]))
+        if old is None or new is None:
+            self.errno = errno.EACCES
+            return -1
+        try:
+            os.rename(old, new)
+        except OSError as e:
+            return self._os_error(e)
+        return 0
+
+    def sys_get_cmdline(self, r1, p):
+        (buf, n) = p[:2]
+        d = self.cmdline.encode('utf-8') + b'\0'
+        if len(d) > n:
+            return -1
+        self.o.write_mem(buf, bytearray(d))
+        self.o.write_words([(r1 + 4, len(d) - 1)])
+        return 0
+
+    def sys_heapinfo(self, r1, p):
+        # all zero: the C library uses its linker script defaults
+        self.o.write_words([ (p[0] + 4 * i, 0) for i in range(4) ])
+        return 0
+
+    def sys_exit(self, r1, p):
+        if self.op == SYS_EXIT_EXTENDED:
+            (reason, code) = p[:2]
+        else:
+            (reason, code) = (r1, 0)
+        if reason != ADP_STOPPED_APPLICATION_EXIT:
+            code = code or 1
+        self.exit_code = code
+        return None
+
+    def handle_halt(self):
+        '-> True if the core halted on a semihosting call, it has been serviced and resumed then'
+        r = self.o.call(state_tcl())
+        st = parse_state_response(r)
+        if st is None:
+            return False
+        (r0, r1, pc, insn, params) = st
+        if insn != BKPT_SEMIHOSTING:
+            return False
+        self.op = r0
+        f = self.syscalls.get(r0)
+        self.calls += 1
+        if f is None:
+            if r0 not in self.unsupported:
+                logging.warning('semihosting: operation 0x%x not supported' % (r0,))
+                self.unsupported.add(r0)
+            self.errno = errno.ENOSYS
+            result = -1
+        else:
+            if None in params[:PARAM_COUNTS.get(r0, 0)]:
+                raise TargetMemoryAccessError(cmd='semihosting 0x%x parameters at 0x%x' % (r0, r1), response=r)
+            result = f(r1, params)
+        if self.exit_code is not None:
+            # stays halted at the call
+            return True
+        regs = [('pc', pc + 2)]
+        if result is not None:
+            regs.insert(0, ('r0', result & 0xffffffff))
+        self.o.write_core_registers(regs, resume=True)
+        return True
+
+    def start(self):
+        '''
+        Take over semihosting: turn off OpenOCD's and listen for halts. Called by serve(), call it
+        before resetting the target so not even the firmware's first calls are missed.
+        '''
+        if self._halted is not None:
+            return
+        self._halted = threading.Event()
+        self.o.add_event_callback(self._on_event)
+        self.o.set_arm_semihosting(False)
+
+    def _on_event(self, kind, name):
+        if kind == 'event' and name == 'halted':
+            self._halted.set()
+
+    def serve(self, done=lambda: False):
+        '''
+        Service calls until the firmware calls SYS_EXIT or done() returns True -> firmware exit code or None
+
+        Halts that aren't semihosting calls (breakpoints, someone halting the core) are left alone.
+        '''
+        try:
+            self.start()
+            halted = self._halted
+            if self.o.poll().state == 'halted':
+                halted.set()
+            while self.exit_code is None and not done():
+                if not halted.wait(FLUSH_DELAY):
+                    self.output.flush()
+                    continue
+                halted.clear()
+                if not self.handle_halt():
+                    logging.info('semihosting: core halted outside of a semihosting call, waiting for it to resume')
+        finally:
+            self.close()
+        return self.exit_code
+
+    def close(self):
+        if self._halted is not None:
+            self.o.remove_event_callback(self._on_event)
+            self._halted = None
+        for f in self.handles.values():
+            if not isinstance(f, _Console):
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.handles = {}
+        try:
+            self.output.flush()
+        except OSError:
+            pass
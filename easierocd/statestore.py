@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+# Per debug adapter state files with fcntl advisory locking
+#
+# Whoever starts or stops the OpenOCD daemon for an adapter holds the adapter's lock while doing so,
+# others block on the lock and then find the winner's result in the file instead of starting
+# a daemon of their own.
+# Files are truncated instead of removed so that every locker always locks the same inode.
+
+import os
+import json
+import fcntl
+import errno
+import logging
+
+def pid_alive(pid):
+    '''
+    >>> pid_alive(os.getpid())
+    True
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, owned by someone else
+        return True
+    return True
+
+class LockedState(object):
+    '''
+    with store.locked(name) as st:
+        d = st.read()    # -> dict or None
+        st.write(d)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except:
+            os.close(self.fd)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+    def read(self):
+        data = []
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        while True:
+            t = os.read(self.fd, 4096)
+            if not t:
+                break
+            data.append(t)
+        data = b''.join(data)
+        if not data.strip():
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            logging.warning('%s: corrupt state, ignoring' % (self.path,))
+            return None
+
+    def write(self, d):
+        data = json.dumps(d, sort_keys=True).encode('utf-8') + b'\n'
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, data)
+
+    def clear(self):
+        os.ftruncate(self.fd, 0)
+
+class StateStore(object):
+    '''
+    >>> import tempfile
+    >>> s = StateStore(tempfile.mkdtemp())
+    >>> with s.locked('ST-LinkV2-usb-1-5') as st:
+    ...     st.read()
+    ...     st.write({'openocd_pid': 1234})
+    >>> with s.locked('ST-LinkV2-usb-1-5') as st:
+    ...     st.read()
+    {'openocd_pid': 1234}
+    >>> s.names()
+    ['ST-LinkV2-usb-1-5']
+    '''
+    SUFFIX = '.state'
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.SUFFIX)
+
+    def locked(self, name):
+        return LockedState(self.path(name))
+
+    def names(self):
+        return sorted(x[:-len(self.SUFFIX)] for x in os.listdir(self.directory) if x.endswith(self.SUFFIX))
@@ -1,13 +1,33 @@
 from __future__ import absolute_import
 
-# DID1
-# DID0
+import easierocd.devicedb as devicedb
+
+# Device identification registers in the System Control block
+DID0_ADDR = 0x400fe000
+DID1_ADDR = 0x400fe004
+
+def did0_decode(v):
+    '''
+    >>> sorted(did0_decode(0x18050102).items())
+    [('class_', 5), ('major', 1), ('minor', 2), ('ver', 1)]
+    '''
+    # tm4c123gh6pm.pdf p.238
+    # 0: register format 0, Stellaris LM3S1xx parts ("Sandstorm"), class is 0
+    # 1: register format 1
+    ver = (v >> 28) & 0x7
+    # 0x05: TM4C123x and LM4F ("Blizzard"), 0x0a: TM4C129x ("Snowflake")
+    class_ = (v >> 16) & 0xff if ver != 0 else 0
+    # silicon revision
+    major = (v >> 8) & 0xff
+    minor = (v >> 0) & 0xff
+    return dict(ver=ver, class_=class_, major=major, minor=minor)
 
 def did1_decode(v):
     '''
-    > tm4c123gh6pm_did1 = 0x10A1606e
-    > did1_decode(tm4c123gh6pm_did1)
-    None
+    >>> tm4c123gh6pm_did1 = 0x10A1606e
+    >>> d = did1_decode(tm4c123gh6pm_did1)
+    >>> (hex(d['partno']), d['pincount'])
+    ('0xa1', 3)
     '''
     # tm4c123gh6pm.pdf p.240
     # See also: OpenOCD: stellaris_read_part_info()
@@ -25,4 +45,19 @@ def did1_decode(v):
     pkg = (v >> 3) & 0x3
     rohs = (v >> 2) & 0x1
     qual = (v >> 0) & 0x3
-    return locals()
+    out = dict(locals())
+    del out['v']
+    return out
+
+def device_id(did0, did1):
+    '''
+    -> device database ID: DID0 class and DID1 part number
+
+    >>> hex(device_id(0x18050102, 0x10a1606e))
+    '0x5a1'
+    '''
+    return (did0_decode(did0)['class_'] << 8) | did1_decode(did1)['partno']
+
+def device(did0, did1):
+    '-> device database entry or None'
+    return devicedb.device('ti', device_id(did0, did1))
@@ -2,6 +2,11 @@ from __future__ import absolute_import
 
 import doctest
 
+import easierocd.devicedb as devicedb
+
+# Device data (names, revisions, memory sizes, flash geometry, clock boost recipes) lives in the
+# device database (easierocd/devices.json), this module interprets it for STM32s.
+
 # In addition to the standard Cortex-M debug hardware, ST has a DBG_MCU component with IDCODE and debug time clock control functionality
 # PPB Bus
 
@@ -11,102 +16,322 @@ DBGMCU_IDCODE_ADDR = 0xe0042000
 # NOTE: STM32 L0 and F0's DBGMCU_IDCODE_ADDR is different
 DBGMCU_IDCODE_ADDR_STM32L0F0 = 0x40015800
 
-def dbgmcu_idcode_decode(v):
-    # References
-    # RM0090 for STM32F405xx/07xx and STM32F415xx/17xx, 38.6.1 "MCU device ID code", p. 1667
-    # RM0038 for STM32L1, 38.6.1
-    # RM0383 for STM32F411xC/E, 23.6.1 "MCU device ID code", p. 804
-    # RM0367 for STM32L0, 33.4.1 "MCU device ID code", p. 876
+def device(dev_id):
+    '-> device database entry or None'
+    return devicedb.device('st', dev_id)
 
-    # "MCU device ID code"
+def dbgmcu_idcode_decode(v):
+    '''
+    >>> d = dbgmcu_idcode_decode(0x10036419)
+    >>> (d['dev'], d['rev'])
+    ('STM32F42xxx and STM32F43xxx', 'Rev Y')
+    '''
+    # "MCU device ID code", the reference manual of each device is its "ref" in the database
     rev_id   = (v >> 16) & 0xffff
     reserved = (v >> 12) & 0x0f
     dev_id   = (v >> 0)  & 0xfff
 
-    device_categories = {
-        # RM0090, 38.6.1 "MCU device ID code", p. 1667
-        0x413: 'STM32F405xx/07xx and STM32F415xx/17xx',
-        0x419: 'STM32F42xxx and STM32F43xxx',
-        # RM0038 for STM32L1 
-        0x416: 'STM32L1 Cat.1',
-        0x429: 'STM32L1 Cat.2',
-        0x427: 'STM32L1 Cat.3',
-        0x436: 'STM32L1 Cat.4 or Cat.3', # Special Cat.3 devices: STM32L15xxC or STM3216xxC devices with RPN ending with letter 'A', in WLCSP64 packages or with more then 100 pin.
-        0x437: 'STM32L1 Cat.5',
-        # RM0383 23.6.1 "MCU device ID code", p. 804
-        0x431: 'STM32F411xC/E',
-        # RM0367 for STM32L0, 33.4.1 "MCU device ID code", p. 876
-        0x417: 'STM32L0x3',
-        # RM0360 for STM32F030x4/6/8/C and STM32F070x6/B, 26.4.1 "MCU device ID code", p. 710
-        0x444: 'STM32F030x4 and STM32F070x6',
-        0x445: 'STM32F070x6',
-        0x440: 'STM32F070x8',
-        0x448: 'STM32F070xB',
-        0x442: 'STM32F070xC',
-        # RM0368 for STM32F401xB/C and STM32F401xD/E, 23.6.1 "MCU device ID code", p. 807
-        0x423: 'STM32F401xB/C',
-        0x433: 'STM32F401xD/E',
-        # RM0008 for STM32F101xx, STM32F102xx, STM32F103xx, STM32F105xx and STM32F107xx, 31.6.1 "MCU device ID code", p. 1076
-        0x412: 'STM32F1 low-density devices',
-        0x410: 'STM32F1 medium-density devices',
-        0x414: 'STM32F1 high-density devices',
-        0x430: 'STM32F1 XL-density devices',
-        0x418: 'STM32F1 connectivity devices',
-        # RM0316 for STM32F303xB/C/D/E, STM32F303x6/8, STM32F328x8, STM32F358xC, STM32F398xE, 33.6.1 "MCU device ID code", p. 1100
-        0x422: 'STM32F303xB/C and STM32F358',
-        0x438: 'STM32F303x6/8 and STM32F328',
-        0x446: 'STM32F303xD/E and STM32F398xE',
-
-
-    }
-    revisions = {}
-    # RM0090
-    if dev_id == 0x413 or dev_id == 0x419:
-        revisions = { 0x1000: 'Rev A', 0x1001: 'Rev Z', 0x1003: 'Rev Y', 0x1007: 'Rev 1', 0x2001: 'Rev 3' } 
-    # RM0038
-    elif dev_id == 0x416:
-        revisions = { 0x1000: 'Rev A', 0x1008: 'Rev Y', 0x1038: 'Rev W', 0x1078: 'Rev V' }
-    elif dev_id == 0x429:
-        revisions = { 0x1000: 'Rev A', 0x1018: 'Rev Z' }
-    elif dev_id == 0x427:
-        revisions = { 0x1018: 'Rev A', 0x1038: 'Rev X' }
-    elif dev_id == 0x436:
-        revisions = { 0x1000: 'Rev A', 0x1008: 'Rev Z', 0x1018: 'Rev Y' }
-    elif dev_id == 0x437:
-        revisions = { 0x1000: 'Rev A' }
-    # RM0383
-    elif dev_id == 0x431:
-        revisions = { 0x1000: 'Rev A' }
-    # RM0367
-    elif dev_id == 0x417:
-        revisions = { 0x1000: 'Rev A', 0x1008: 'Rev Z' }
-    # RM0360   
-    elif dev_id in [0x444, 0x445, 0x440, 0x448, 0x442]:
-        revisions = { 0x1000: 'Rev 1.0', 0x2000: 'Rev 2.0'}
-    # RM0368
-    elif dev_id == 0x423:
-        revisions = { 0x1000: 'Rev Z', 0x1001: 'Rev A'}
-    elif dev_id == 0x433:
-        revisions = { 0x1000: 'Rev A', 0x1001: 'Rev Z'}
-    # RM0008
-    elif dev_id == 0x412:
-        revisions = { 0x1000: 'Rev A'}
-    elif dev_id == 0x410:
-        revisions = { 0x0000: 'Rev A', 0x2000: 'Rev B', 0x2001: 'Rev Z', 0x2003: 'Rev Y, 1, 2 or X'}
-    elif dev_id == 0x414:
-        revisions = { 0x1000: 'Rev A or 1', 0x1001: 'Rev Z', 0x1003: 'Rev Y, 1, 2 or X'}
-    elif dev_id == 0x430:
-        revisions = { 0x1000: 'Rev A'}
-    elif dev_id == 0x418:
-        revisions = { 0x1000: 'Rev A', 0x1001: 'Rev Z'}
-    # RM0316
-    elif dev_id in [0x422, 0x438, 0x446]:
-        revisions = {0x1000: 'Rev A'}
-
-    
-    dev = device_categories.get(dev_id)
-    rev = revisions.get(rev_id)
-    return dict(dev_id=dev_id, rev_id=rev_id, dev=dev, rev=rev)
+    d = device(dev_id)
+    if d is None:
+        return dict(dev_id=dev_id, rev_id=rev_id, dev=None, rev=None)
+    return dict(dev_id=dev_id, rev_id=rev_id, dev=d['name'], rev=d.get('revisions', {}).get(rev_id))
+
+def _entry(stm32_family, dev_id):
+    '-> device entry, family entry for unknown devices, ValueError for unknown families'
+    d = device(dev_id)
+    if d is not None and d.get('family') == devicedb.db().aliases.get(stm32_family, stm32_family):
+        return d
+    f = devicedb.family(stm32_family)
+    if f is None:
+        raise ValueError
+    return f
+
+# Flash memory geometry
+
+FLASH_BASE = 0x08000000
+
+def flash_size_reg_addr(stm32_family, dev_id):
+    '''
+    Flash size register ("F_SIZE", flash size in KiB, 16 bits) in system memory
+
+    >>> hex(flash_size_reg_addr('stm32f4', 0x419))
+    '0x1fff7a22'
+    >>> hex(flash_size_reg_addr('stm32l1', 0x429))
+    '0x1ff8004c'
+    >>> hex(flash_size_reg_addr('stm32l1', 0x437))
+    '0x1ff800cc'
+    '''
+    try:
+        return _entry(stm32_family, dev_id)['flash_size_reg']
+    except KeyError:
+        raise ValueError
+
+def flash_size_decode(dev_id, v):
+    '''
+    F_SIZE register value -> flash size in bytes
+
+    >>> flash_size_decode(0x419, 0x800)
+    2097152
+    >>> flash_size_decode(0x436, 0)
+    393216
+    '''
+    v &= 0xffff
+    # e.g. Cat.3 and Cat.4 STM32L1 parts share dev_id 0x436, F_SIZE reads 0 for 384K and 1 for 256K
+    d = device(dev_id) or {}
+    codes = d.get('flash_size_codes', {})
+    if v in codes:
+        return codes[v]
+    return v * 1024
+
+def flash_sectors(stm32_family, dev_id, flash_size):
+    '''
+    Flash erase units as exposed by OpenOCD's flash driver for the family ("flash erase_sector" indices)
+    -> [ (address, size), ...]
+
+    NOTE: stm32lx hardware erases 256 byte (L1) or 128 byte (L0) pages,
+    but OpenOCD's stm32lx driver groups 16 pages into one 4 KiB sector
+
+    >>> [ (hex(a), s) for (a, s) in flash_sectors('stm32f4', 0x423, 256*1024) ]
+    [('0x8000000', 16384), ('0x8004000', 16384), ('0x8008000', 16384), ('0x800c000', 16384), ('0x8010000', 65536), ('0x8020000', 131072)]
+    >>> len(flash_sectors('stm32f4', 0x419, 2048*1024))
+    24
+    >>> flash_sectors('stm32f1', 0x410, 128*1024)[1]
+    (134218752, 1024)
+    >>> flash_sectors('stm32f1', 0x414, 512*1024)[1]
+    (134219776, 2048)
+    '''
+    e = _entry(stm32_family, dev_id)
+    if 'sectors' in e:
+        # non-uniform sectors, "sectors" is the layout of each flash megabyte: [ [count, size], ...]
+        pattern = [ size for (count, size) in e['sectors'] for i in range(count) ]
+        sizes = []
+        while sum(sizes) < flash_size:
+            sizes.extend(pattern)
+    else:
+        unit = flash_erase_unit(stm32_family, dev_id)
+        sizes = [unit] * (flash_size // unit)
+
+    out = []
+    addr = e.get('flash_base', FLASH_BASE)
+    end = addr + flash_size
+    for s in sizes:
+        if addr + s > end:
+            break
+        out.append((addr, s))
+        addr += s
+    return out
+
+def flash_bank_size(stm32_family, dev_id):
+    '''
+    -> size of the first flash bank for parts whose OpenOCD driver exposes the rest as another bank,
+    None when the whole flash is one bank
+
+    >>> flash_bank_size('stm32f1', 0x430) // 1024
+    512
+    >>> flash_bank_size('stm32f1', 0x414) is None
+    True
+    '''
+    return _entry(stm32_family, dev_id).get('bank_size')
+
+def flash_erase_unit(stm32_family, dev_id):
+    '''
+    erase unit size for families with uniform pages
+
+    >>> flash_erase_unit('stm32f0', 0x444)
+    1024
+    >>> flash_erase_unit('stm32f0', 0x448)
+    2048
+    '''
+    try:
+        return _entry(stm32_family, dev_id)['erase_unit']
+    except KeyError:
+        raise ValueError
+
+def flash_write_align(stm32_family):
+    '''
+    Smallest unit the flash driver programs, writes are padded to this alignment
+
+    >>> flash_write_align('stm32l0')
+    4
+    '''
+    f = devicedb.family(stm32_family)
+    if f is None:
+        raise ValueError
+    return f.get('write_align', 2)
+
+class FlashPlanError(Exception):
+    pass
+
+class FlashPlan(object):
+    '''
+    Minimal set of sectors to erase and the writes to issue afterwards, in address order
+
+    erase: [ (first_sector_index, last_sector_index), ...]
+    writes: [ (address, memoryview), ...]
+    '''
+    def __init__(self, sectors, erase, writes, base=FLASH_BASE):
+        (self.sectors, self.erase, self.writes, self.base) = (sectors, erase, writes, base)
+
+    def erase_bytes(self):
+        return sum(self.sectors[i][1] for (first, last) in self.erase for i in range(first, last + 1))
+
+    def write_bytes(self):
+        return sum(len(x[1]) for x in self.writes)
+
+    def __repr__(self):
+        return 'FlashPlan(erase=%r, writes=%r)' % (
+            self.erase, [ (hex(a), len(v)) for (a, v) in self.writes ])
+
+    def execute(self, openocd_rpc, bank=0):
+        o = openocd_rpc
+        for (first, last) in self.erase:
+            o.flash_erase_sector(bank, first, last)
+        for (addr, data) in self.writes:
+            o.flash_write_bank(bank, data, addr - self.base)
+
+def flash_program_plan(image, sectors, write_align=2, merge_gap=1024, read_flash=None, fill=0xff, bank_size=None):
+    '''
+    image: easierocd.image.SparseImage
+    sectors: [ (address, size), ...] from flash_sectors()
+    bank_size: from flash_bank_size(), only the first bank is programmed (flash bank 0 in OpenOCD)
+    merge_gap: writes separated by fewer erased bytes than this are issued as one write
+    read_flash: optional function (address, size) -> bytes of current flash contents.
+                Sectors where every image byte already matches are left alone.
+
+    >>> from easierocd.image import SparseImage
+    >>> im = SparseImage()
+    >>> im.add(0x08004010, b'\x01' * 3)
+    >>> im.add(0x08010000, b'\x02' * 0x10)
+    >>> flash_program_plan(im, flash_sectors('stm32f4', 0x413, 1024*1024))
+    FlashPlan(erase=[(1, 1), (4, 4)], writes=[('0x8004010', 4), ('0x8010000', 16)])
+    >>> im.add(0x08080000, b'\x03' * 4)
+    >>> flash_program_plan(im, flash_sectors('stm32f1', 0x430, 1024*1024), bank_size=512*1024)
+    Traceback (most recent call last):
+    ...
+    easierocd.stm32.FlashPlanError: image data in the second flash bank: 0x8080000-0x8080004, only the first 512 KiB can be programmed
+    '''
+    segments = image.segments()
+    if not segments:
+        return FlashPlan(sectors, [], [])
+    if sectors:
+        (flash_start, flash_end) = (sectors[0][0], sectors[-1][0] + sectors[-1][1])
+    else:
+        (flash_start, flash_end) = (0, 0)
+    outside = [ (s, e) for (s, e) in segments if s < flash_start or e > flash_end ]
+    if outside:
+        raise FlashPlanError('image data outside flash: %s' %
+                             ', '.join('0x%x-0x%x' % x for x in outside))
+    if bank_size is not None:
+        # OpenOCD's driver addresses the rest of the flash as a second bank, its sector indices restart
+        bank_end = flash_start + bank_size
+        second = [ (max(s, bank_end), e) for (s, e) in segments if e > bank_end ]
+        if second:
+            raise FlashPlanError('image data in the second flash bank: %s, only the first %d KiB can be programmed' %
+                                 (', '.join('0x%x-0x%x' % x for x in second), bank_size // 1024))
+
+    # sectors touched by the image
+    touched = []
+    for (i, (addr, size)) in enumerate(sectors):
+        if not image.overlaps(addr, addr + size):
+            continue
+        if read_flash is not None and _sector_unchanged(image, addr, size, read_flash):
+            continue
+        touched.append(i)
+
+    erase = []
+    for i in touched:
+        if erase and erase[-1][1] == i - 1:
+            erase[-1] = (erase[-1][0], i)
+        else:
+            erase.append((i, i))
+
+    # write ranges: image data clipped to erased sectors, aligned outwards and merged across small gaps
+    ranges = []
+    for (first, last) in erase:
+        (lo, hi) = (sectors[first][0], sectors[last][0] + sectors[last][1])
+        for (s, e) in segments:
+            (s, e) = (max(s, lo), min(e, hi))
+            if s >= e:
+                continue
+            s -= (s - lo) % write_align
+            e = min(hi, e + (-(e - lo) % write_align))
+            if ranges and ranges[-1][1] + merge_gap >= s and ranges[-1][2] == first:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], e), first)
+            else:
+                ranges.append((s, e, first))
+
+    writes = [ (s, image.read(s, e - s, fill)) for (s, e, _) in ranges ]
+    return FlashPlan(sectors, erase, writes)
+
+def _sector_unchanged(image, addr, size, read_flash):
+    current = read_flash(addr, size)
+    for (s, e) in image.segments():
+        (s, e) = (max(s, addr), min(e, addr + size))
+        if s >= e:
+            continue
+        if bytes(image.read(s, e - s)) != bytes(current[s - addr:e - addr]):
+            return False
+    return True
+
+# On-chip SRAM
+#
+# STM32s have no register reporting the RAM size so "sram_size" in the database is the smallest main SRAM
+# among the parts sharing a dev_id. Banks that are contiguous at 0x20000000 count as one (e.g. SRAM1 + SRAM2 on F4).
+
+def sram_size(dev_id):
+    '''
+    -> size of the SRAM starting at 0x20000000 or None if unknown
+
+    >>> sram_size(0x419) // 1024
+    192
+    >>> sram_size(0x999) is None
+    True
+    '''
+    return (device(dev_id) or {}).get('sram_size')
+
+# Core coupled memory, only reachable by the CPU's data bus. Like "sram_size", "ccm_size" is only given when
+# every part sharing the dev_id has it: STM32F302s share dev_ids 0x422 and 0x446 with CCM-equipped F303s.
+CCM_BASE = 0x10000000
+
+def ccm_size(dev_id):
+    '''
+    -> size of the CCM SRAM, None for MCUs without one
+
+    >>> ccm_size(0x413) // 1024
+    64
+    >>> ccm_size(0x423) is None
+    True
+    '''
+    return (device(dev_id) or {}).get('ccm_size')
+
+# Clock boost recipes
+#
+# Switch from the reset clock to a faster one built from the internal oscillator only,
+# so that no assumptions about external crystals are needed.
+# Recipes are "clock_boost" in the database, per family with per device overrides.
+# See easierocd.openocd.register_ops_tcl() for the 'ops' format.
+#   adapter_khz: adapter speed usable once boosted
+
+def clock_boost_recipe(stm32_family, dev_id):
+    '''
+    -> recipe dict or None
+
+    >>> clock_boost_recipe('stm32f4', 0x419)['sysclk_hz']
+    84000000
+    >>> clock_boost_recipe('stm32f1', 0x418)['sysclk_hz']
+    36000000
+    >>> clock_boost_recipe('stm32f7', 0x449) is None
+    True
+    '''
+    try:
+        r = _entry(stm32_family, dev_id).get('clock_boost')
+    except ValueError:
+        return None
+    if r is None:
+        return None
+    r = dict(r)
+    r['ops'] = [ tuple(op) for op in r['ops'] ]
+    return r
 
 def openocd_stm32_family_flash_algorithm(stm32_family):
     '''
@@ -130,21 +355,10 @@ def openocd_stm32_family_flash_algorithm(stm32_family):
     ...     assert(0)
     '''
     # http://www.st.com/web/en/catalog/mmc/FM141/SC1169?sc=stm32
-    flash_algos = {
-        'stm32f0': 'stm32f1x',
-        'stm32l0': 'stm32lx',
-        'stm32l1': 'stm32lx',
-        'stm32f1': 'stm32f1x',
-        'stm32f2': 'stm32f2x',
-        'stm32f3': 'stm32f1x',
-        'stm32f4': 'stm32f2x',
-        'stm32l' : 'stm32lx',
-    }
-    try:
-        a = flash_algos[stm32_family]
-    except KeyError:
+    f = devicedb.family(stm32_family)
+    if f is None or 'flash_driver' not in f:
         raise ValueError
-    return a
+    return f['flash_driver']
 
 def openocd_stm32_target_file(mcu_info):
     '''
@@ -158,23 +372,17 @@ def openocd_stm32_target_file(mcu_info):
     ...     assert(0)
     '''
     # see documentation/openocd-stm32-target-files
-    target_cfg = {
-        'stm32f0': 'stm32f0x.cfg',
-        'stm32l0': 'stm32l.cfg',
-        'stm32l1': 'stm32l.cfg',
-        'stm32f1': 'stm32f1x.cfg',
-        'stm32f2': 'stm32f2x.cfg',
-        'stm32f3': 'stm32f3x.cfg',
-        'stm32f4': 'stm32f4x.cfg',
-    }
-    # 'STM32L1 Cat.5'
-    # 'STM32F405xx/07xx and STM32F415xx/17xx',
-    family = (mcu_info['dev'].split()[0][:len('stm32**')]).lower()
-    try:
-        c = target_cfg[family]
-    except KeyError:
+    d = device(mcu_info.get('dev_id'))
+    if d is not None:
+        family = d['family']
+    else:
+        # 'STM32L1 Cat.5'
+        # 'STM32F405xx/07xx and STM32F415xx/17xx',
+        family = (mcu_info['dev'].split()[0][:len('stm32**')]).lower()
+    f = devicedb.family(family)
+    if f is None or 'target_cfg' not in f:
         raise ValueError
-    return c
+    return f['target_cfg']
 
 def test():
     stm32l152re = 0x10006437 # ST Nucleo L152RE board
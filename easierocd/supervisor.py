@@ -0,0 +1,691 @@
+from __future__ import absolute_import
+
+# easierocd supervisor: one long running process that owns the OpenOCD daemons
+#
+# For every debug adapter in use the supervisor
+# * spawns OpenOCD and waits for its TCL port to answer
+# * keeps the most recent output of OpenOCD (and so of target semihosting) in a ring buffer
+# * runs the adapter's command broker (see easierocd.broker) in a thread
+# * stops the daemon when the adapter is unplugged
+# * optionally (--prewarm) sets up a daemon as soon as an adapter is plugged in, so the first
+#   eocd-gdb or eocd-program finds OpenOCD initialized and the target detected
+# * optionally (--idle-timeout) stops daemons nobody has used for a while to release the USB device
+#
+# Starting is race free: concurrent clients block on a lock while one of them spawns the supervisor,
+# concurrent requests for one adapter wait for the first one's daemon to be ready, and every daemon is
+# recorded in a locked per-adapter state file (easierocd.statestore) so that daemons orphaned by a
+# supervisor that died are found by liveness checks and stopped before a new one takes the USB device.
+#
+# Commands ask for an adapter's daemon with one request over the supervisor's Unix socket,
+# the supervisor itself is started on first use.
+# Requests and replies are single lines of JSON:
+#   {"op": "endpoint", "adapter": {"name": ..., "bus": ..., "address": ...}}
+#     -> {"ok": true, "pid": ..., "tcl_port": ..., "gdb_port": ..., "telnet_port": ..., "broker": PATH, "new": BOOL}
+#   {"op": "output", "adapter": ..., "since": OFFSET}  -> {"ok": true, "data": TEXT, "next": OFFSET}
+#   {"op": "stop", "adapter": ...}, {"op": "list"}, {"op": "shutdown"}, {"op": "ping"}
+#   errors: {"ok": false, "error": MESSAGE}
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import random
+import signal
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+
+import easierocd.usb
+from easierocd.openocd import OpenOcdRpc
+from easierocd.broker import Broker
+from easierocd.util import path_safe_str
+from easierocd.statestore import (StateStore, pid_alive)
+
+# Plugged in and unplugged adapters are noticed this often
+SCAN_INTERVAL = 2.0
+
+OUTPUT_RING_SIZE = 64*1024
+
+# OpenOCD's TCL port has to answer within this time after spawning
+OPENOCD_START_TIMEOUT = 5.0
+OPENOCD_STOP_TIMEOUT = 2.0
+OPENOCD_START_ATTEMPTS = 5
+
+SUPERVISOR_START_TIMEOUT = 5.0
+
+DEFAULT_PORTS = (3333, 4444, 6666)
+
+class SupervisorError(Exception):
+    pass
+
+def runtime_dir():
+    d = os.environ.get('XDG_RUNTIME_DIR')
+    if d:
+        d = os.path.join(d, 'easierocd')
+    else:
+        d = os.path.join(tempfile.gettempdir(), 'easierocd-uid%d' % (os.getuid(),))
+    try:
+        os.makedirs(d, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return d
+
+def socket_path():
+    return os.path.join(runtime_dir(), 'supervisor.sock')
+
+def adapter_key(adapter):
+    '-> JSON serializable identification of "adapter" for requests'
+    (info, device) = adapter
+    return dict(name=info['name'], bus=device.bus, address=device.address)
+
+def adapter_key_str(key):
+    '''
+    >>> adapter_key_str(dict(name='ST-Link/V2-1', bus=2, address=109))
+    'ST-LinkV2-1-usb-2-109'
+    '''
+    return '%s-usb-%d-%d' % (path_safe_str(key['name']), key['bus'], key['address'])
+
+class RingBuffer(object):
+    '''
+    Most recent "capacity" bytes written, addressed by absolute offsets
+
+    >>> r = RingBuffer(8)
+    >>> r.write(b'0123456789')
+    >>> r.read(0)
+    (b'23456789', 10)
+    >>> r.write(b'ab')
+    >>> r.read(10)
+    (b'ab', 12)
+    '''
+    def __init__(self, capacity=OUTPUT_RING_SIZE):
+        self.capacity = capacity
+        self.buf = bytearray()
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.buf += data
+            self.end += len(data)
+            excess = len(self.buf) - self.capacity
+            if excess > 0:
+                del self.buf[:excess]
+
+    def read(self, since=0):
+        '-> (bytes written since offset "since" that are still kept, offset to continue from)'
+        with self.lock:
+            start = self.end - len(self.buf)
+            since = min(max(since, start), self.end)
+            return (bytes(self.buf[since - start:]), self.end)
+
+def _ports_free(ports):
+    socks = []
+    try:
+        for p in ports:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            socks.append(s)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(('127.0.0.1', p))
+        return True
+    except OSError:
+        return False
+    finally:
+        for s in socks:
+            s.close()
+
+class Daemon(object):
+    'One OpenOCD process and its broker'
+    def __init__(self, key):
+        self.key = key
+        self.name = adapter_key_str(key)
+        self.proc = None
+        (self.gdb_port, self.telnet_port, self.tcl_port) = (None, None, None)
+        self.output = RingBuffer()
+        self.broker = None
+        self.broker_path = os.path.join(runtime_dir(), 'broker-%s.sock' % (self.name,))
+        self.last_used = time.time()
+
+    def idle_since(self):
+        '-> time of last use or None while a broker client or gdb is connected'
+        b = self.broker
+        if b is not None:
+            if b.clients:
+                return None
+            last = max(self.last_used, b.last_activity)
+        else:
+            last = self.last_used
+        if gdb_connected(self.gdb_port):
+            return None
+        return last
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        openocd_exe = os.environ.get('OPENOCD', 'openocd')
+        ports = DEFAULT_PORTS
+        for attempt in range(OPENOCD_START_ATTEMPTS):
+            if not _ports_free(ports):
+                base = random.randrange(1025, 65533)
+                ports = (base, base + 1, base + 2)
+                continue
+            (gdb_port, telnet_port, tcl_port) = ports
+            cmd = [openocd_exe,
+                   '-c', 'tcl_port %d' % (tcl_port,),
+                   '-c', 'gdb_port %d' % (gdb_port,),
+                   '-c', 'telnet_port %d' % (telnet_port,),
+                   '-c', 'noinit']
+            try:
+                self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT, start_new_session=True)
+            except FileNotFoundError:
+                raise SupervisorError('OpenOCD executable %r not found' % (openocd_exe,))
+            (self.gdb_port, self.telnet_port, self.tcl_port) = ports
+            t = threading.Thread(target=self._capture_output, args=(self.proc,), name='output ' + self.name)
+            t.daemon = True
+            t.start()
+            if self._wait_ready():
+                break
+            # port taken in between or OpenOCD failed, try elsewhere
+            self.stop()
+            base = random.randrange(1025, 65533)
+            ports = (base, base + 1, base + 2)
+        else:
+            (out, n) = self.output.read()
+            raise SupervisorError("OpenOCD didn't start: %s" % (out[-1024:].decode('latin-1'),))
+
+        self.broker = Broker(self.broker_path, self._upstream)
+        t = threading.Thread(target=self._run_broker, name='broker ' + self.name)
+        t.daemon = True
+        t.start()
+        logging.info('supervisor: %s: OpenOCD pid %d, tcl port %d' % (self.name, self.pid, self.tcl_port))
+
+    def _wait_ready(self):
+        deadline = time.time() + OPENOCD_START_TIMEOUT
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                return False
+            try:
+                o = OpenOcdRpc(port=self.tcl_port, pid=self.pid)
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+                continue
+            try:
+                # the process answering on tcl_port isn't necessarily the one we started
+                return o.getpid() == self.pid
+            except (OSError, ConnectionError, ValueError):
+                return False
+            finally:
+                o.close()
+        return False
+
+    def _capture_output(self, proc):
+        fd = proc.stdout.fileno()
+        while True:
+            try:
+                d = os.read(fd, 4096)
+            except OSError:
+                break
+            if not d:
+                break
+            self.output.write(d)
+        proc.stdout.close()
+        proc.wait()
+
+    def _upstream(self):
+        if not self.alive():
+            return None
+        return (self.pid, self.tcl_port)
+
+    def _run_broker(self):
+        b = self.broker
+        try:
+            b.serve_forever()
+        finally:
+            b.close()
+
+    def stop(self):
+        p = self.proc
+        if p is None:
+            return
+        if p.poll() is None:
+            p.send_signal(signal.SIGTERM)
+            try:
+                p.wait(OPENOCD_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+
+    def endpoint(self, new):
+        return dict(ok=True, pid=self.pid, tcl_port=self.tcl_port, gdb_port=self.gdb_port,
+                    telnet_port=self.telnet_port, broker=self.broker_path, new=new)
+
+def gdb_connected(port):
+    '-> whether a TCP connection to local "port" is established, True when this can\'t be told'
+    hex_port = ':%04X' % (port,)
+    found_table = False
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table, 'r') as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        found_table = True
+        for line in lines:
+            fields = line.split()
+            # local_address rem_address st, 01: ESTABLISHED
+            if len(fields) > 3 and fields[1].endswith(hex_port) and fields[3] == '01':
+                return True
+    return not found_table
+
+def eocd_setup_command(key):
+    '-> command line that sets up the OpenOCD daemon for adapter "key" and probes the target'
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return [sys.executable, os.path.join(package_dir, 'bin', 'eocd-setup'),
+            '--eocd-adapter-usb-bus-addr', '%d:%d' % (key['bus'], key['address']),
+            '--eocd-non-interactive']
+
+class Supervisor(object):
+    '''
+    prewarm: set up daemons for adapters as they are plugged in
+    idle_timeout: seconds after which unused daemons are stopped, None to keep them
+    '''
+    def __init__(self, path, prewarm=False, idle_timeout=None):
+        self.path = path
+        (self.prewarm, self.idle_timeout) = (prewarm, idle_timeout)
+        # adapters seen by the last scan, prewarming only happens on arrival
+        self.seen = None
+        self.prewarming = {}
+        self.daemons = {}
+        self.lock = threading.Lock()
+        # held while a daemon is being started or stopped, per adapter
+        self.adapter_locks = {}
+        self.store = StateStore(os.path.join(runtime_dir(), 'adapters'))
+        self.quit = threading.Event()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.listener.bind(path)
+        self.listener.listen(16)
+
+    def adapter_lock(self, name):
+        with self.lock:
+            return self.adapter_locks.setdefault(name, threading.Lock())
+
+    def endpoint(self, key):
+        name = adapter_key_str(key)
+        with self.adapter_lock(name):
+            with self.lock:
+                d = self.daemons.get(name)
+            if d is not None and d.alive():
+                d.last_used = time.time()
+                return d.endpoint(False)
+            with self.store.locked(name) as st:
+                self.reap_stale(name, st.read())
+                d = Daemon(key)
+                d.start()
+                st.write(dict(supervisor_pid=os.getpid(), openocd_pid=d.pid, tcl_port=d.tcl_port))
+            with self.lock:
+                self.daemons[name] = d
+            return d.endpoint(True)
+
+    def stop(self, name):
+        with self.adapter_lock(name):
+            with self.lock:
+                d = self.daemons.pop(name, None)
+            with self.store.locked(name) as st:
+                if d is not None:
+                    d.stop()
+                st.clear()
+
+    def reap_stale(self, name, state):
+        '''
+        Make sure no OpenOCD recorded in "state" is still driving the adapter
+        state: contents of the adapter's state file, the caller holds its lock
+        '''
+        if state is None:
+            return
+        (owner, pid) = (state.get('supervisor_pid'), state.get('openocd_pid'))
+        if owner == os.getpid() or pid is None or not pid_alive(pid):
+            return
+        if owner is not None and pid_alive(owner):
+            raise SupervisorError('%s is in use by easierocd supervisor pid %d' % (name, owner))
+        # the pid could have been reused, only stop it if it still is the OpenOCD we recorded
+        try:
+            o = OpenOcdRpc(port=state['tcl_port'], pid=pid)
+            try:
+                is_openocd = (o.getpid() == pid)
+            finally:
+                o.close()
+        except (OSError, ConnectionError, ValueError, KeyError):
+            is_openocd = False
+        if not is_openocd:
+            return
+        logging.info('supervisor: %s: stopping orphaned OpenOCD pid %d' % (name, pid))
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                return
+            deadline = time.time() + OPENOCD_STOP_TIMEOUT
+            # not our child, so all we can do is watch for it to go away
+            while pid_alive(pid) and time.time() < deadline:
+                time.sleep(0.01)
+            if not pid_alive(pid):
+                return
+        logging.warning('supervisor: %s: OpenOCD pid %d is still around' % (name, pid))
+
+    def reap_all_stale(self):
+        'release adapters held by daemons of a previous supervisor'
+        for name in self.store.names():
+            try:
+                with self.store.locked(name) as st:
+                    self.reap_stale(name, st.read())
+                    st.clear()
+            except (SupervisorError, OSError) as e:
+                logging.warning('supervisor: %s: %s' % (name, e))
+
+    def output(self, name, since):
+        with self.lock:
+            d = self.daemons.get(name)
+        if d is None:
+            raise SupervisorError('no OpenOCD daemon for %s' % (name,))
+        (data, next_offset) = d.output.read(since)
+        # latin-1 maps bytes 1:1, the output isn't necessarily valid UTF-8
+        return dict(ok=True, data=data.decode('latin-1'), next=next_offset)
+
+    def list(self):
+        with self.lock:
+            ds = list(self.daemons.values())
+        return dict(ok=True, daemons=[ dict(d.endpoint(False), adapter=d.key, alive=d.alive()) for d in ds ])
+
+    def handle(self, req):
+        op = req.get('op')
+        if op == 'ping':
+            return dict(ok=True, pid=os.getpid())
+        if op == 'list':
+            return self.list()
+        if op == 'shutdown':
+            self.quit.set()
+            return dict(ok=True)
+        try:
+            key = req['adapter']
+            name = adapter_key_str(key)
+        except (KeyError, TypeError):
+            raise SupervisorError('request needs an "adapter"')
+        if op == 'endpoint':
+            return self.endpoint(key)
+        if op == 'stop':
+            self.stop(name)
+            return dict(ok=True)
+        if op == 'output':
+            return self.output(name, int(req.get('since', 0)))
+        raise SupervisorError('unknown request %r' % (op,))
+
+    def serve_client(self, conn):
+        f = conn.makefile('rwb')
+        try:
+            for line in f:
+                try:
+                    reply = self.handle(json.loads(line.decode('utf-8')))
+                except (SupervisorError, ValueError) as e:
+                    reply = dict(ok=False, error=str(e))
+                f.write(json.dumps(reply).encode('utf-8') + b'\n')
+                f.flush()
+        except OSError:
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def scan(self):
+        'react to adapters being plugged in and unplugged, stop idle daemons'
+        connected = {}
+        for a in easierocd.usb.connected_debug_adapters():
+            key = adapter_key(a)
+            connected[adapter_key_str(key)] = key
+        with self.lock:
+            gone = [ name for name in self.daemons if name not in connected ]
+        for name in gone:
+            logging.info('supervisor: %s: adapter unplugged, stopping OpenOCD' % (name,))
+            self.stop(name)
+
+        # adapters already plugged in when the supervisor starts count as arrivals
+        arrived = [ name for name in connected if self.seen is None or name not in self.seen ]
+        self.seen = set(connected)
+        if self.prewarm:
+            for name in arrived:
+                self.start_prewarm(connected[name])
+        for (name, p) in list(self.prewarming.items()):
+            if p.poll() is not None:
+                del self.prewarming[name]
+                logging.info('supervisor: %s: prewarm %s' % (name, 'done' if p.returncode == 0 else 'failed'))
+
+        if self.idle_timeout is not None:
+            now = time.time()
+            with self.lock:
+                ds = list(self.daemons.values())
+            for d in ds:
+                if d.name in self.prewarming:
+                    continue
+                t = d.idle_since()
+                if t is not None and now - t > self.idle_timeout:
+                    logging.info('supervisor: %s: idle for %ds, stopping OpenOCD' % (d.name, now - t))
+                    self.stop(d.name)
+
+    def start_prewarm(self, key):
+        name = adapter_key_str(key)
+        with self.lock:
+            if name in self.daemons or name in self.prewarming:
+                return
+        logging.info('supervisor: %s: plugged in, setting up' % (name,))
+        # eocd-setup asks us for the endpoint like any other command
+        self.prewarming[name] = subprocess.Popen(eocd_setup_command(key), stdin=subprocess.DEVNULL,
+                                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _scan_loop(self):
+        while not self.quit.wait(SCAN_INTERVAL):
+            try:
+                self.scan()
+            except Exception as e:
+                logging.warning('supervisor: scan: %r' % (e,))
+
+    def _accept_loop(self):
+        while True:
+            try:
+                (conn, addr) = self.listener.accept()
+            except OSError:
+                return
+            t = threading.Thread(target=self.serve_client, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def serve_forever(self):
+        self.reap_all_stale()
+        for target in (self._accept_loop, self._scan_loop):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        self.quit.wait()
+
+    def close(self):
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            names = list(self.daemons)
+        for name in names:
+            self.stop(name)
+
+# client side
+
+def _connect(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+def start_supervisor():
+    'spawn the supervisor process in the background'
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + [ x for x in [env.get('PYTHONPATH')] if x ])
+    log_path = os.path.join(runtime_dir(), 'supervisor.log')
+    with open(log_path, 'ab') as log:
+        p = subprocess.Popen([sys.executable, '-m', 'easierocd.supervisor'],
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                             env=env, start_new_session=True)
+    logging.debug('start_supervisor: pid: %d' % (p.pid,))
+
+def connect(start=True):
+    '-> socket connected to the supervisor, started if needed and "start" is true'
+    path = socket_path()
+    try:
+        return _connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if not start:
+            raise SupervisorError('supervisor not running')
+
+    # one starter at a time, the others wait here and then find the supervisor running
+    with open(os.path.join(runtime_dir(), 'supervisor-start.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            return _connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        start_supervisor()
+        deadline = time.time() + SUPERVISOR_START_TIMEOUT
+        while True:
+            try:
+                return _connect(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise SupervisorError("supervisor didn't start, see %s" % (
+                        os.path.join(runtime_dir(), 'supervisor.log'),))
+                time.sleep(0.01)
+
+def request(req, start=True):
+    '-> reply dict, raises SupervisorError on errors'
+    s = connect(start)
+    try:
+        s.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        f = s.makefile('rb')
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    if not line:
+        raise SupervisorError('supervisor closed the connection')
+    reply = json.loads(line.decode('utf-8'))
+    if not reply.get('ok'):
+        raise SupervisorError(reply.get('error', 'request failed'))
+    return reply
+
+def endpoint(adapter):
+    '-> dict with the OpenOCD pid, ports and broker socket path for "adapter", starting OpenOCD if needed'
+    return request(dict(op='endpoint', adapter=adapter_key(adapter)))
+
+def stop(adapter):
+    'stop the OpenOCD daemon for "adapter" and wait for it to exit'
+    try:
+        request(dict(op='stop', adapter=adapter_key(adapter)), start=False)
+    except SupervisorError:
+        pass
+
+def shutdown():
+    '-> True if a running supervisor was told to stop all daemons and exit'
+    try:
+        request(dict(op='shutdown'), start=False)
+    except SupervisorError:
+        return False
+    return True
+
+class DaemonOutput(object):
+    'Output of the OpenOCD daemon for "adapter" (e.g. target semihosting output) as kept by the supervisor'
+    def __init__(self, adapter):
+        self.key = adapter_key(adapter)
+        self.offset = None
+
+    def clear(self):
+        'forget output so far, read() only returns what arrives after this'
+        self.offset = request(dict(op='output', adapter=self.key, since=1 << 62))['next']
+
+    def read(self):
+        '-> bytes received since the last read()'
+        if self.offset is None:
+            self.clear()
+        r = request(dict(op='output', adapter=self.key, since=self.offset))
+        self.offset = r['next']
+        return r['data'].encode('latin-1')
+
+def options_from_environment():
+    '''
+    -> (prewarm, idle_timeout) from EOCD_PREWARM and EOCD_IDLE_TIMEOUT (seconds)
+    The supervisor is usually started by the first command, which passes its environment on.
+    '''
+    prewarm = os.environ.get('EOCD_PREWARM', '') not in ('', '0')
+    idle_timeout = os.environ.get('EOCD_IDLE_TIMEOUT')
+    if idle_timeout:
+        try:
+            idle_timeout = float(idle_timeout)
+        except ValueError:
+            logging.warning('EOCD_IDLE_TIMEOUT=%r is not a number, ignoring' % (idle_timeout,))
+            idle_timeout = None
+    else:
+        idle_timeout = None
+    return (prewarm, idle_timeout)
+
+def main(args=()):
+    '''
+    python -m easierocd.supervisor [--prewarm] [--idle-timeout SECONDS]
+    '''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    (prewarm, idle_timeout) = options_from_environment()
+    args = list(args)
+    while args:
+        a = args.pop(0)
+        if a == '--prewarm':
+            prewarm = True
+        elif a == '--idle-timeout' and args:
+            try:
+                idle_timeout = float(args.pop(0))
+            except ValueError:
+                sys.stderr.write('--idle-timeout requires a number of seconds\n')
+                return 2
+        else:
+            sys.stderr.write('usage: python -m easierocd.supervisor [--prewarm] [--idle-timeout SECONDS]\n')
+            return 2
+    # only one supervisor per user, later starters just exit
+    lock_file = open(os.path.join(runtime_dir(), 'supervisor.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.stderr.write('supervisor already running, its options stay in effect, stop it first with eocd-stop\n')
+        return 1
+    s = Supervisor(socket_path(), prewarm, idle_timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: s.quit.set())
+    try:
+        s.serve_forever()
+    finally:
+        s.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,423 @@
+from __future__ import absolute_import
+
+# SWO trace decoding: ITM and DWT packets (ARMv7-M Appendix D4, "Debug ITM and DWT Packet Protocol")
+#
+# ItmDecoder is fed the raw SWO byte stream in chunks of any size, whatever the adapter and OpenOCD
+# write it to (file, FIFO, socket), and keeps only the few bytes of a packet cut off at the end of
+# a chunk. Decoded data goes to bounded buffers the caller drains:
+#   stimulus ports: per port byte streams, read_port()
+#   periodic PC samples: take_pc_samples(), an array('I') (the profiler's input)
+#   everything else (timestamps, exception trace, event counters, data trace, overflows): packets
+# When a buffer is full the oldest data goes and "dropped" counts it.
+#
+# Packets are told apart by their header byte alone, a regular expression built from the header
+# table matches one whole packet at a time so the per byte work is done by the re module.
+
+import re
+import os
+import shutil
+import tempfile
+import time
+import struct
+import array
+import collections
+
+from easierocd.util import connect_endpoint
+
+ITM_SYNC = b'\x00\x00\x00\x00\x00\x80'
+
+# packets other than stimulus port data and PC samples
+TracePacket = collections.namedtuple('TracePacket', 'kind timestamp source value')
+
+# TracePacket kinds, "source" and "value" are:
+OVERFLOW = 'overflow'             # None, None
+LOCAL_TIMESTAMP = 'timestamp'     # TC (relation to the packet before), delta in trace clocks
+GLOBAL_TIMESTAMP = 'global_timestamp' # 1 (low bits) or 2 (high bits), value
+EXTENSION = 'extension'           # source bit, value
+EVENT_COUNTER = 'event'           # None, counter wrap bits: CPI, EXC, SLEEP, LSU, FOLD, CYC
+EXCEPTION = 'exception'           # exception number, 1 entered, 2 exited, 3 returned
+DATA_PC = 'data_pc'               # comparator, PC
+DATA_ADDRESS = 'data_address'     # comparator, address bits 15:0
+DATA_READ = 'data_read'           # comparator, value
+DATA_WRITE = 'data_write'         # comparator, value
+HARDWARE = 'hardware'             # discriminator ID, raw payload of IDs without a meaning here
+
+# DWT hardware source discriminator IDs
+(DWT_EVENT, DWT_EXCEPTION, DWT_PC_SAMPLE) = (0, 1, 2)
+
+DEFAULT_MAX_PORT_BYTES = 1024 * 1024
+DEFAULT_MAX_PC_SAMPLES = 1024 * 1024
+DEFAULT_MAX_PACKETS = 64 * 1024
+
+# regular expression alternatives, in the order of the groups they are numbered by
+(_SYNC, _IDLE, _OVERFLOW, _LTS2, _LTS1, _GTS, _EXT_LONG, _EXT_SHORT,
+ _SW1, _SW2, _SW4, _HW1, _HW2, _HW4) = range(1, 15)
+
+# payload size from the two low header bits of source packets
+_SOURCE_SIZE = {1: 1, 2: 2, 3: 4}
+
+# longest packet that can be cut off at the end of a chunk (GTS2: header + 6 bytes)
+_MAX_PARTIAL = 7
+
+def _byte_class(values):
+    return b'[' + b''.join(re.escape(bytes([v])) for v in values) + b']'
+
+def _packet_re():
+    sw = dict((n, [ h for h in range(256) if h & 0x7 == s ]) for (s, n) in _SOURCE_SIZE.items())
+    hw = dict((n, [ h for h in range(256) if h & 0x7 == s | 0x4 ]) for (s, n) in _SOURCE_SIZE.items())
+    ext = [ h for h in range(256) if h & 0x0b == 0x08 ]
+    cont = b'[\x80-\xff]'
+    last = b'[\x00-\x7f]'
+    alternatives = [
+        # synchronization: at least 47 zero bits and a one, shorter zero runs are idle padding
+        b'\x00+\x80',
+        b'\x00+(?=[^\x00\x80])',
+        b'\x70',
+        # local timestamp format 2 (single byte) and 1 (continued)
+        _byte_class([ 0x10 * i for i in range(1, 7) ]),
+        _byte_class([0xc0, 0xd0, 0xe0, 0xf0]) + cont + b'{0,3}' + last,
+        _byte_class([0x94, 0xb4]) + cont + b'{0,5}' + last,
+        _byte_class([ h for h in ext if h & 0x80 ]) + cont + b'{0,3}' + last,
+        _byte_class([ h for h in ext if not h & 0x80 ]),
+    ]
+    for kinds in (sw, hw):
+        for n in (1, 2, 4):
+            alternatives.append(_byte_class(kinds[n]) + b'.{%d}' % (n,))
+    return re.compile(b'|'.join(b'(' + a + b')' for a in alternatives), re.DOTALL)
+
+_PACKET_RE = _packet_re()
+_WORD = struct.Struct('<I')
+
+def _continued(b, start, end):
+    '7 bits per byte, least significant first'
+    v = 0
+    for (i, x) in enumerate(b[start:end]):
+        v |= (x & 0x7f) << (7 * i)
+    return v
+
+class ItmDecoder(object):
+    r'''
+    Incremental ITM/DWT packet decoder
+
+    >>> d = ItmDecoder()
+    >>> d.feed(b'\x00\x00\x00\x00\x00\x80\x01H\x01i')   # sync, "H" and "i" on stimulus port 0
+    >>> d.feed(b'\x17\x08\x02\x00')                   # PC sample, cut off
+    >>> d.feed(b'\x08\x30')                           # rest of it, local timestamp (delta 3)
+    >>> d.read_port(0)
+    bytearray(b'Hi')
+    >>> [ hex(pc) for pc in d.take_pc_samples() ]
+    ['0x8000208']
+    >>> list(d.packets)
+    [TracePacket(kind='timestamp', timestamp=3, source=0, value=3)]
+    '''
+    def __init__(self, max_port_bytes=DEFAULT_MAX_PORT_BYTES, max_pc_samples=DEFAULT_MAX_PC_SAMPLES,
+                 max_packets=DEFAULT_MAX_PACKETS):
+        self.max_port_bytes = max_port_bytes
+        self.max_pc_samples = max_pc_samples
+        # stimulus port -> bytearray
+        self.ports = {}
+        self.pc_samples = array.array('I')
+        # PC samples taken while the core was asleep
+        self.sleep_samples = 0
+        self.packets = collections.deque(maxlen=max_packets)
+        # sum of local timestamp deltas
+        self.timestamp = 0
+        self.syncs = 0
+        self.overflows = 0
+        # bytes that aren't a valid packet header, skipped to resynchronize
+        self.errors = 0
+        self.dropped = 0
+        self.bytes_in = 0
+        self._partial = b''
+
+    def feed(self, data):
+        self.bytes_in += len(data)
+        b = self._partial + bytes(data) if self._partial else bytes(data)
+        self._partial = b[self._decode(b):]
+
+    def _decode(self, b):
+        '-> position of the first byte not decoded'
+        (pos, n) = (0, len(b))
+        ports = self.ports
+        pc_samples = self.pc_samples
+        packets = self.packets
+        unpack_word = _WORD.unpack_from
+        for m in _PACKET_RE.finditer(b):
+            start = m.start()
+            if start != pos:
+                # not a valid packet header, skip to the next one
+                if start > n - _MAX_PARTIAL:
+                    # unless what's left may be a packet cut off
+                    self.errors += max(0, n - _MAX_PARTIAL - pos)
+                    return max(pos, n - _MAX_PARTIAL)
+                self.errors += start - pos
+                pos = start
+            k = m.lastindex
+            end = m.end()
+            if k == _SW1 or k == _SW2 or k == _SW4:
+                port = b[pos] >> 3
+                p = ports.get(port)
+                if p is None:
+                    p = ports[port] = bytearray()
+                p += b[pos + 1:end]
+                if len(p) > self.max_port_bytes:
+                    over = len(p) - self.max_port_bytes
+                    del p[:over]
+                    self.dropped += over
+            elif k == _HW4 and b[pos] >> 3 == DWT_PC_SAMPLE:
+                pc_samples.append(unpack_word(b, pos + 1)[0])
+                if len(pc_samples) > self.max_pc_samples:
+                    over = len(pc_samples) - self.max_pc_samples
+                    del pc_samples[:over]
+                    self.dropped += over
+            elif k == _LTS2:
+                delta = b[pos] >> 4
+                self.timestamp += delta
+                packets.append(TracePacket(LOCAL_TIMESTAMP, self.timestamp, 0, delta))
+            elif k == _LTS1:
+                delta = _continued(b, pos + 1, end)
+                self.timestamp += delta
+                packets.append(TracePacket(LOCAL_TIMESTAMP, self.timestamp, (b[pos] >> 4) & 0x3, delta))
+            elif k == _HW1 or k == _HW2 or k == _HW4:
+                self._hardware(b[pos] >> 3, b[pos + 1:end])
+            elif k == _SYNC:
+                self.syncs += 1
+            elif k == _OVERFLOW:
+                self.overflows += 1
+                packets.append(TracePacket(OVERFLOW, self.timestamp, None, None))
+            elif k == _GTS:
+                packets.append(TracePacket(GLOBAL_TIMESTAMP, self.timestamp, 1 if b[pos] == 0x94 else 2,
+                                           _continued(b, pos + 1, end)))
+            elif k == _EXT_LONG or k == _EXT_SHORT:
+                h = b[pos]
+                v = (h >> 4) & 0x7
+                if k == _EXT_LONG:
+                    v |= _continued(b, pos + 1, end) << 3
+                packets.append(TracePacket(EXTENSION, self.timestamp, (h >> 2) & 0x1, v))
+            # _IDLE: nothing to do
+            pos = end
+        if n - pos >= _MAX_PARTIAL:
+            if b.count(b'\x00', pos) != n - pos:
+                self.errors += n - _MAX_PARTIAL - pos
+            # else a long run of zeros: sync still being sent
+            pos = n - _MAX_PARTIAL
+        return pos
+
+    def _hardware(self, disc, payload):
+        v = int.from_bytes(payload, 'little')
+        t = self.timestamp
+        if disc == DWT_PC_SAMPLE:
+            # one byte sample: the core was sleeping
+            self.sleep_samples += 1
+            return
+        if disc == DWT_EVENT:
+            p = TracePacket(EVENT_COUNTER, t, None, v)
+        elif disc == DWT_EXCEPTION and len(payload) == 2:
+            p = TracePacket(EXCEPTION, t, v & 0x1ff, (v >> 12) & 0x3)
+        elif 8 <= disc <= 15:
+            kind = DATA_ADDRESS if disc & 1 else DATA_PC
+            p = TracePacket(kind, t, (disc >> 1) & 0x3, v)
+        elif 16 <= disc <= 23:
+            kind = DATA_WRITE if disc & 1 else DATA_READ
+            p = TracePacket(kind, t, (disc >> 1) & 0x3, v)
+        else:
+            p = TracePacket(HARDWARE, t, disc, v)
+        self.packets.append(p)
+
+    def read_port(self, port):
+        '-> bytearray of what stimulus port "port" received since the last call'
+        p = self.ports.get(port)
+        if not p:
+            return bytearray()
+        self.ports[port] = bytearray()
+        return p
+
+    def take_pc_samples(self):
+        '-> array("I") of PC samples since the last call'
+        s = self.pc_samples
+        self.pc_samples = array.array('I')
+        return s
+
+    def stats(self):
+        return dict(bytes_in=self.bytes_in, syncs=self.syncs, overflows=self.overflows, errors=self.errors,
+                    dropped=self.dropped, sleep_samples=self.sleep_samples)
+
+# Target side configuration (ARMv7-M C1.6-C1.10), applied as register operations in one round trip
+# (OpenOcdRpc.run_register_ops())
+
+DEMCR = 0xe000edfc
+DEMCR_TRCENA = 1 << 24
+
+ITM_TER0 = 0xe0000e00
+ITM_TPR = 0xe0000e40
+ITM_TCR = 0xe0000e80
+ITM_LAR = 0xe0000fb0
+# ITM_TCR: ITMENA, TSENA, SYNCENA, TXENA (forward DWT packets), trace bus ID 1
+ITM_TCR_ENABLE = 0x1 | 0x2 | 0x4 | 0x8 | (1 << 16)
+CORESIGHT_UNLOCK = 0xc5acce55
+
+DWT_CTRL = 0xe0001000
+DWT_CTRL_CYCCNTENA = 1 << 0
+DWT_CTRL_CYCTAP = 1 << 9
+DWT_CTRL_PCSAMPLENA = 1 << 12
+DWT_CTRL_EXCTRCENA = 1 << 16
+# POSTINIT, POSTPRESET, CYCTAP, SYNCTAP, PCSAMPLENA, EXCTRCENA, CYCCNTENA
+DWT_CTRL_TRACE_MASK = 0x1ffff
+
+# POSTPRESET counts CYCCNT tap transitions, bit 6 (CYCTAP 0) or bit 10 (CYCTAP 1)
+CYCCNT_TAPS = (64, 1024)
+
+TPIU_CSPSR = 0xe0040004
+TPIU_ACPR = 0xe0040010
+TPIU_SPPR = 0xe00400f0
+TPIU_FFCR = 0xe0040304
+(TPIU_SPPR_MANCHESTER, TPIU_SPPR_NRZ) = (1, 2)
+
+# STM32 DBGMCU_CR TRACE_IOEN: SWO pin driven by the TPIU, asynchronous trace
+STM32_DBGMCU_CR = 0xe0042004
+STM32_DBGMCU_CR_TRACE_IOEN = 1 << 5
+
+def pc_sampling_divider(cpu_hz, rate_hz):
+    '''
+    -> (cyctap, postpreset, actual rate) for the PC sampling rate closest to "rate_hz"
+
+    >>> pc_sampling_divider(72000000, 100000)
+    (0, 10, 102272.72727272728)
+    >>> pc_sampling_divider(16000000, 1000)
+    (1, 15, 976.5625)
+    '''
+    best = None
+    for (cyctap, tap) in enumerate(CYCCNT_TAPS):
+        for postpreset in range(16):
+            r = cpu_hz / float(tap * (postpreset + 1))
+            if best is None or abs(r - rate_hz) < abs(best[2] - rate_hz):
+                best = (cyctap, postpreset, r)
+    return best
+
+def trace_config_ops(cpu_hz, swo_hz, stimulus_ports=0x1, pc_sample_hz=None, exception_trace=False,
+                     stm32=False):
+    '''
+    -> register operations enabling SWO output (NRZ) of ITM stimulus ports and DWT packets
+
+    cpu_hz: trace clock, the core clock on all supported parts
+    stimulus_ports: ITM_TER0 bitmap
+    pc_sample_hz: periodic PC sampling rate, None to leave it off
+    stm32: also route the SWO pin through DBGMCU_CR
+
+    >>> ops = trace_config_ops(72000000, 2000000, pc_sample_hz=100000)
+    >>> [ (hex(op[1]), hex(op[-1])) for op in ops if op[1] in (TPIU_ACPR, DWT_CTRL) ]
+    [('0xe0040010', '0x23'), ('0xe0001000', '0x555'), ('0xe0001000', '0x1555')]
+    '''
+    prescaler = max(1, int(round(cpu_hz / float(swo_hz)))) - 1
+    ops = [('set', DEMCR, DEMCR_TRCENA)]
+    if stm32:
+        ops.append(('set', STM32_DBGMCU_CR, STM32_DBGMCU_CR_TRACE_IOEN))
+    ops.extend([
+        ('write', TPIU_CSPSR, 0x1),
+        ('write', TPIU_ACPR, prescaler),
+        ('write', TPIU_SPPR, TPIU_SPPR_NRZ),
+        # formatter off: ITM/DWT packets go out as they are
+        ('write', TPIU_FFCR, 0x100),
+        ('write', ITM_LAR, CORESIGHT_UNLOCK),
+        ('write', ITM_TCR, ITM_TCR_ENABLE),
+        ('write', ITM_TPR, 0x0),
+        ('write', ITM_TER0, stimulus_ports),
+    ])
+    # SYNCTAP: synchronization packets every 2**24 cycles
+    ctrl = DWT_CTRL_CYCCNTENA | (0x1 << 10)
+    if pc_sample_hz is not None:
+        (cyctap, postpreset, rate) = pc_sampling_divider(cpu_hz, pc_sample_hz)
+        ctrl |= (postpreset << 1) | (postpreset << 5) | (DWT_CTRL_CYCTAP if cyctap else 0)
+    if exception_trace:
+        ctrl |= DWT_CTRL_EXCTRCENA
+    # counter reload values first, sampling enabled once they are in place
+    ops.append(('modify', DWT_CTRL, DWT_CTRL_TRACE_MASK, ctrl))
+    if pc_sample_hz is not None:
+        ops.append(('modify', DWT_CTRL, DWT_CTRL_TRACE_MASK, ctrl | DWT_CTRL_PCSAMPLENA))
+    return ops
+
+def trace_disable_ops():
+    return [('clear', DWT_CTRL, DWT_CTRL_PCSAMPLENA | DWT_CTRL_EXCTRCENA), ('write', ITM_TER0, 0x0)]
+
+class SwoCapture(object):
+    '''
+    Capture SWO through the debug adapter (OpenOCD "tpiu config internal") into a file
+
+    with SwoCapture(openocd_rpc, cpu_hz, swo_hz, pc_sample_hz=10000) as path:
+        for d in trace_chunks(path, follow=...):
+            ...
+
+    The target's trace configuration (trace_config_ops()) goes out in one round trip,
+    it is undone and the capture stopped on exit.
+    '''
+    def __init__(self, openocd_rpc, cpu_hz, swo_hz, path=None, **config):
+        self.o = openocd_rpc
+        (self.cpu_hz, self.swo_hz, self.config) = (cpu_hz, swo_hz, config)
+        self.tmpdir = None
+        if path is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='eocd-swo-')
+            path = os.path.join(self.tmpdir, 'trace.swo')
+        self.path = path
+
+    def __enter__(self):
+        # the adapter appends to the file
+        open(self.path, 'wb').close()
+        self.o.run_register_ops(trace_config_ops(self.cpu_hz, self.swo_hz, **self.config))
+        self.o.command('tpiu config internal %s uart off %d %d' % (self.path, self.cpu_hz, self.swo_hz))
+        return self.path
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.o.command('tpiu config disable')
+            self.o.run_register_ops(trace_disable_ops())
+        finally:
+            if self.tmpdir is not None:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+# Trace sources
+#
+#   PATH              file or FIFO, e.g. what OpenOCD's "hla trace" / "tpiu config ... FILE" writes to
+#   -                 standard input
+#   tcp:HOST:PORT     TCP connection
+#   unix:PATH         Unix domain socket
+
+TRACE_CHUNK_SIZE = 64 * 1024
+
+# at end of file while following a file being written, look again after this long
+FOLLOW_INTERVAL = 0.02
+
+def trace_chunks(source, chunk_size=TRACE_CHUNK_SIZE, follow=None):
+    '''
+    -> iterator over the byte chunks of a trace source, ends at end of file or when the peer closes
+
+    follow: callable, files are read past their current end (like "tail -f") while it returns True
+    '''
+    s = connect_endpoint(source)
+    if s is not None:
+        with s:
+            while True:
+                d = s.recv(chunk_size)
+                if not d:
+                    return
+                yield d
+    fd = 0 if source == '-' else os.open(source, os.O_RDONLY)
+    try:
+        while True:
+            d = os.read(fd, chunk_size)
+            if not d:
+                if follow is not None and follow():
+                    time.sleep(FOLLOW_INTERVAL)
+                    continue
+                return
+            yield d
+    finally:
+        if fd != 0:
+            os.close(fd)
+
+def decode_source(source, decoder=None, chunk_size=TRACE_CHUNK_SIZE):
+    '-> ItmDecoder fed with everything read from "source"'
+    if decoder is None:
+        decoder = ItmDecoder()
+    for d in trace_chunks(source, chunk_size):
+        decoder.feed(d)
+    return decoder
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 import sys
 import os
 import errno
+import socket
 import string
 
 class HexDict(dict):
@@ -54,3 +55,65 @@ def hex_str_literal_double_quoted(s):
         return '"' + ''.join('\\x%x' % (ord(x),) for x in s) + '"'
     else:
         return '"' + s + '"'
+
+def path_safe_str(s):
+    '''
+    >>> path_safe_str('ST-Link/V2-1')
+    'ST-LinkV2-1'
+    >>> path_safe_str('TI ICDI')
+    'TIICDI'
+    >>> path_safe_str('LPC-Link 2')
+    'LPC-Link2'
+    '''
+    safe_chrs = set('-_.'
+                    'abcdefghijklmnopqrstuvwxyz'
+                    'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                    '0123456789')
+    out = []
+    for c in s:
+        if c in safe_chrs:
+            out.append(c)
+        else:
+            pass
+    return ''.join(out)
+
+def parse_endpoint(spec):
+    '''
+    "tcp:HOST:PORT" or "unix:PATH" -> (socket family, address), None for anything else (a file name)
+
+    >>> parse_endpoint('tcp:localhost:3443')
+    (<AddressFamily.AF_INET: 2>, ('localhost', 3443))
+    >>> parse_endpoint('unix:/run/swo.sock')
+    (<AddressFamily.AF_UNIX: 1>, '/run/swo.sock')
+    >>> parse_endpoint('trace.swo') is None
+    True
+    >>> parse_endpoint('tcp:localhost')
+    Traceback (most recent call last):
+    ...
+    ValueError: 'tcp:localhost' is not tcp:HOST:PORT
+    '''
+    if spec.startswith('tcp:'):
+        try:
+            (host, port) = spec[len('tcp:'):].rsplit(':', 1)
+            return (socket.AF_INET, (host, int(port)))
+        except ValueError:
+            raise ValueError('%r is not tcp:HOST:PORT' % (spec,))
+    if spec.startswith('unix:'):
+        return (socket.AF_UNIX, spec[len('unix:'):])
+    return None
+
+def connect_endpoint(spec):
+    '-> socket connected to "spec" (see parse_endpoint()), None if it isn\'t a socket endpoint'
+    e = parse_endpoint(spec)
+    if e is None:
+        return None
+    (family, addr) = e
+    if family == socket.AF_INET:
+        return socket.create_connection(addr)
+    s = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        s.connect(addr)
+    except OSError:
+        s.close()
+        raise
+    return s
@@ -0,0 +1,259 @@
+from __future__ import absolute_import
+
+# Live variable sampling
+#
+# Variables (ELF symbols or addresses with a type) are read while the core runs. Their addresses are
+# merged into word aligned runs (coalesce_ranges()) and one TCL script reads all runs "batch" times
+# over, a few scripts are kept queued so OpenOCD never waits for the next one (pipelined_replies()).
+# A reply is a block of raw sample records, one per sample, that is split into per variable columns
+# with byte slicing: no Python object per sample.
+#
+# Samples go to a RingStore, one fixed size column per variable plus host time, in a bytearray or
+# a memory mapped file for long captures. The oldest samples are overwritten once it is full.
+# Exports: CSV, NPZ (needs numpy).
+
+import re
+import sys
+import csv
+import mmap
+import time
+import array
+import collections
+
+from easierocd.openocd import (TargetMemoryAccessError, coalesce_ranges, repeat_runs_tcl, pipelined_replies,
+                               READ_MANY_GAP)
+
+# type name -> array/memoryview format
+TYPES = collections.OrderedDict([
+    ('u8', 'B'), ('i8', 'b'), ('u16', 'H'), ('i16', 'h'), ('u32', 'I'), ('i32', 'i'),
+    ('u64', 'Q'), ('i64', 'q'), ('f32', 'f'), ('f64', 'd'),
+])
+# symbol size -> type used when none is given
+DEFAULT_TYPES = {1: 'u8', 2: 'u16', 4: 'u32', 8: 'u64'}
+
+TIME_COLUMN = 'time'
+
+# samples per script: about BATCH_PERIOD seconds worth at the requested rate, at most MAX_BATCH
+BATCH_PERIOD = 0.05
+MAX_BATCH = 512
+IN_FLIGHT = 2
+
+Variable = collections.namedtuple('Variable', 'name addr type')
+
+class WatchError(ValueError):
+    pass
+
+def type_size(t):
+    return array.array(TYPES[t]).itemsize
+
+_SPEC_RE = re.compile(r'^(?P<where>[^:+]+)(\+(?P<offset>(0x)?[0-9a-fA-F]+))?(:(?P<type>\w+))?$')
+
+def parse_variable(spec, elf=None):
+    '''
+    SYMBOL[+OFFSET][:TYPE] or ADDR:TYPE -> Variable
+    TYPE: u8 i8 u16 i16 u32 i32 u64 i64 f32 f64, for symbols it defaults to the unsigned type of their size
+
+    >>> parse_variable('0x20000010:f32')
+    Variable(name='0x20000010', addr=536870928, type='f32')
+    >>> parse_variable('0x20000010')
+    Traceback (most recent call last):
+    ...
+    easierocd.watch.WatchError: 0x20000010: a type is needed, e.g. 0x20000010:u32
+    '''
+    m = _SPEC_RE.match(spec)
+    if m is None:
+        raise WatchError('%s: not SYMBOL[+OFFSET][:TYPE] or ADDR:TYPE' % (spec,))
+    (where, t) = (m.group('where'), m.group('type'))
+    if t is not None and t not in TYPES:
+        raise WatchError('%s: unknown type %r, one of %s' % (spec, t, ' '.join(TYPES)))
+    offset = int(m.group('offset'), 0) if m.group('offset') else 0
+    if re.match(r'^(0x[0-9a-fA-F]+|\d+)$', where):
+        if t is None:
+            raise WatchError('%s: a type is needed, e.g. %s:u32' % (spec, spec))
+        return Variable(spec.split(':', 1)[0], int(where, 0) + offset, t)
+    sym = elf.symbol(where) if elf is not None else None
+    if sym is None:
+        raise WatchError('%s: no symbol %r%s' % (spec, where, '' if elf is not None else ' (no ELF file given)'))
+    if t is None:
+        t = DEFAULT_TYPES.get(sym.size)
+        if t is None or offset:
+            raise WatchError('%s: %d byte symbol, give a type' % (spec, sym.size))
+    return Variable(spec.split(':', 1)[0], sym.value + offset, t)
+
+def gather(data, stride, offset, size):
+    r'''
+    -> bytes of the "size" byte field at "offset" of each "stride" byte record in "data"
+
+    >>> gather(b'\x01\x02AB\x03\x04CD', 4, 2, 2)
+    b'ABCD'
+    '''
+    n = len(data) // stride
+    if size == 1:
+        return bytes(data[offset::stride][:n])
+    out = bytearray(n * size)
+    for j in range(size):
+        out[j::size] = data[offset + j::stride][:n]
+    return bytes(out)
+
+class RingStore(object):
+    '''
+    Columns of samples: host time (f64) and one per Variable, the last "capacity" samples
+
+    >>> s = RingStore([Variable('a', 0, 'u16')], 3)
+    >>> s.append(array.array('d', [1.0, 2.0]), {'a': array.array('H', [10, 20]).tobytes()})
+    >>> s.append(array.array('d', [3.0, 4.0]), {'a': array.array('H', [30, 40]).tobytes()})
+    >>> (len(s), s.dropped, s.column('a').tolist(), s.column('time').tolist())
+    (3, 1, [20, 30, 40], [2.0, 3.0, 4.0])
+    '''
+    def __init__(self, variables, capacity, path=None):
+        self.variables = list(variables)
+        self.capacity = capacity
+        self.formats = collections.OrderedDict([(TIME_COLUMN, 'd')])
+        for v in self.variables:
+            self.formats[v.name] = TYPES[v.type]
+        self.offsets = {}
+        n = 0
+        for (name, fmt) in self.formats.items():
+            self.offsets[name] = n
+            # keep every column 8 byte aligned
+            n += (capacity * array.array(fmt).itemsize + 7) & ~7
+        self.path = path
+        self.file = None
+        if path is None:
+            self.buf = bytearray(n)
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(n)
+            self.buf = mmap.mmap(self.file.fileno(), n)
+        self.view = memoryview(self.buf)
+        # samples appended so far, the next goes to count % capacity
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def dropped(self):
+        return self.count - len(self)
+
+    def append(self, times, columns):
+        '''
+        times: array('d'), columns: {variable name: bytes, target (little endian) byte order}
+        '''
+        n = len(times)
+        if sys.byteorder != 'little':
+            times = array.array('d', times)
+            times.byteswap()
+        cols = dict(columns)
+        cols[TIME_COLUMN] = times.tobytes()
+        skip = max(0, n - self.capacity)
+        pos = (self.count + skip) % self.capacity
+        k = n - skip
+        for (name, fmt) in self.formats.items():
+            size = array.array(fmt).itemsize
+            data = memoryview(cols[name])[skip * size:]
+            base = self.offsets[name]
+            first = min(k, self.capacity - pos)
+            self.view[base + pos * size:base + (pos + first) * size] = data[:first * size]
+            if first < k:
+                self.view[base:base + (k - first) * size] = data[first * size:k * size]
+        self.count += n
+
+    def column(self, name):
+        '-> array of the column\'s samples, oldest first'
+        fmt = self.formats[name]
+        size = array.array(fmt).itemsize
+        base = self.offsets[name]
+        n = len(self)
+        start = (self.count - n) % self.capacity
+        out = array.array(fmt)
+        first = min(n, self.capacity - start)
+        out.frombytes(self.view[base + start * size:base + (start + first) * size])
+        out.frombytes(self.view[base:base + (n - first) * size])
+        if sys.byteorder != 'little':
+            out.byteswap()
+        return out
+
+    def export_csv(self, f):
+        'to the text file object "f", one row per sample'
+        w = csv.writer(f)
+        names = list(self.formats)
+        w.writerow(names)
+        cols = [ self.column(name) for name in names ]
+        cols[0] = [ '%.6f' % (t,) for t in cols[0] ]
+        w.writerows(zip(*cols))
+
+    def export_npz(self, path):
+        try:
+            import numpy
+        except ImportError:
+            raise WatchError('NPZ export needs numpy')
+        numpy.savez(path, **dict((name, numpy.frombuffer(self.column(name), dtype=fmt))
+                                 for (name, fmt) in self.formats.items()))
+
+    def close(self):
+        self.view.release()
+        if self.file is not None:
+            self.buf.flush()
+            self.buf.close()
+            self.file.close()
+
+class VariableSampler(object):
+    '''
+    sampler = VariableSampler(openocd_rpc, variables)
+    for (times, columns) in sampler.batches(lambda: time.time() > deadline, rate=1000):
+        store.append(times, columns)
+
+    Samples in a batch are taken back to back, batches are paced so the average is "rate" samples/s
+    (None: as fast as the adapter goes). times: host time.time() of each sample, interpolated within
+    a batch.
+    '''
+    def __init__(self, openocd_rpc, variables, in_flight=IN_FLIGHT):
+        self.o = openocd_rpc
+        self.variables = list(variables)
+        self.in_flight = in_flight
+        ranges = [ (v.addr, type_size(v.type)) for v in self.variables ]
+        self.runs = coalesce_ranges(ranges, READ_MANY_GAP, getattr(openocd_rpc, 'memory_map', None))
+        self.record_size = sum(e - s for (s, e) in self.runs)
+        # variable name -> offset in a sample record
+        self.fields = {}
+        for v in self.variables:
+            n = 0
+            for (s, e) in self.runs:
+                if s <= v.addr < e:
+                    self.fields[v.name] = (n + v.addr - s, type_size(v.type))
+                    break
+                n += e - s
+        self.samples = 0
+
+    def split(self, data):
+        '-> {variable name: column bytes} of the sample records in "data"'
+        return dict((name, gather(data, self.record_size, o, size)) for (name, (o, size)) in self.fields.items())
+
+    def _parse(self, r, count):
+        words = r.split()
+        if b'x' in words or len(words) != count * self.record_size // 4:
+            raise TargetMemoryAccessError(cmd='watch %s' % (' '.join(v.name for v in self.variables),), response=r)
+        a = array.array('I', [ int(x) & 0xffffffff for x in words ])
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a.tobytes()
+
+    def batches(self, done, rate=None):
+        '-> iterator over (array("d") times, {variable name: column bytes}) until done() returns True'
+        batch = MAX_BATCH if rate is None else max(1, min(MAX_BATCH, int(rate * BATCH_PERIOD)))
+        cmd = repeat_runs_tcl(self.runs, batch)
+        t0 = time.time()
+
+        def pace(n):
+            delay = t0 + n * batch / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        for (r, t_start, t_end) in pipelined_replies(self.o, cmd, done, self.in_flight,
+                                                     pace if rate is not None else None):
+            data = self._parse(r, batch)
+            self.samples += batch
+            step = (t_end - t_start) / batch
+            times = array.array('d', [ t_start + step * (i + 1) for i in range(batch) ])
+            yield (times, self.split(data))
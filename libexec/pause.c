@@ -1,7 +0,0 @@
-#include <unistd.h>
-
-int main()
-{
-	pause();
-	return 0;
-}